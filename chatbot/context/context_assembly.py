@@ -0,0 +1,143 @@
+from pathlib import Path
+from collections import defaultdict
+from typing import List
+from langchain_core.documents import Document
+
+
+class ContextAssembler:
+    def __init__(self,
+                 token_budget: int = 3000,
+                 min_overlap: int = 20,
+                 max_overlap: int = 300,
+                 encoding_name: str = "cl100k_base"
+                 ) -> None:
+        """
+        Turns retrieved chunks into the context block of the prompt.
+
+        Chunks of the same source that overlap or touch are merged into one passage: through their start_index /
+        end_index offsets when they have them (span chunking), otherwise when the end of one chunk is the beginning
+        of the other (between min_overlap and max_overlap characters, the chunk overlap of the splitter), so text
+        shared by neighbouring chunks is only sent once. Passages keep the rank of their best chunk and only show
+        the source file name and page, not the metadata.
+
+        Passages are then packed by rank into token_budget tokens, counted with tiktoken's encoding_name (a local
+        approximation of the model tokenizer). A passage that does not fit is skipped for smaller ones behind it.
+        """
+        self.token_budget = token_budget
+        self.min_overlap = min_overlap
+        self.max_overlap = max_overlap
+        self.encoding_name = encoding_name
+        self.encoding = None
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is None:
+            import tiktoken
+            self.encoding = tiktoken.get_encoding(self.encoding_name)
+        return len(self.encoding.encode_ordinary(text))
+
+    @staticmethod
+    def has_span(doc: Document) -> bool:
+        return "start_index" in doc.metadata and "end_index" in doc.metadata
+
+    def merge_spans(self, passages: List[dict]) -> List[dict]:
+        """
+        Merge passages by offsets, their text being exactly the source text from start to end.
+        """
+        merged = []
+        for passage in sorted(passages, key=lambda p: p["start"]):
+            if merged and passage["start"] <= merged[-1]["end"]:
+                current = merged[-1]
+                if passage["end"] > current["end"]:
+                    current["text"] += passage["text"][current["end"] - passage["start"]:]
+                    current["end"] = passage["end"]
+                self.absorb(current, passage)
+            else:
+                merged.append(dict(passage))
+        return merged
+
+    def text_overlap(self, first: str, second: str) -> int:
+        # Longest end of first that starts second.
+        for size in range(min(len(first), len(second), self.max_overlap), self.min_overlap - 1, -1):
+            if first.endswith(second[:size]):
+                return size
+        return 0
+
+    def merge_texts(self, passages: List[dict]) -> List[dict]:
+        merged = [dict(passage) for passage in passages]
+        while True:
+            pair = self.overlapping_pair(merged)
+            if pair is None:
+                return merged
+
+            i, j, text = pair
+            merged[i]["text"] = text
+            self.absorb(merged[i], merged[j])
+            del merged[j]
+
+    def overlapping_pair(self, passages: List[dict]):
+        for i, first in enumerate(passages):
+            for j, second in enumerate(passages):
+                if i == j:
+                    continue
+                if second["text"] in first["text"]:
+                    return i, j, first["text"]
+                overlap = self.text_overlap(first["text"], second["text"])
+                if overlap:
+                    return i, j, first["text"] + second["text"][overlap:]
+        return None
+
+    @staticmethod
+    def absorb(passage: dict, other: dict) -> None:
+        passage["rank"] = min(passage["rank"], other["rank"])
+        passage["pages"] = sorted(set(passage["pages"]) | set(other["pages"]), key=str)
+
+    def passages(self, documents: List[Document]) -> List[dict]:
+        """
+        Merged passages of the documents, best ranked first (documents are expected in retrieval order).
+        """
+        by_source = defaultdict(list)
+        for rank, doc in enumerate(documents):
+            # The text of a span chunk is its first end_index - start_index characters, the rest is the context
+            # added by contextual preprocessing, which helps the search but only repeats the chunk in a prompt.
+            # Pinecone returns numeric metadata as floats.
+            start, end = (int(doc.metadata["start_index"]), int(doc.metadata["end_index"])) if self.has_span(doc) \
+                                                                                             else (None, None)
+            text = doc.page_content[:end - start] if start is not None else doc.page_content.strip()
+            if not text.strip():
+                continue
+            page = doc.metadata.get("page", doc.metadata.get("page_number"))
+            by_source[str(doc.metadata.get("source", ""))].append({
+                "source": str(doc.metadata.get("source", "")),
+                "text": text,
+                "start": start,
+                "end": end,
+                "rank": rank,
+                "pages": [page] if page is not None else []
+            })
+
+        passages = []
+        for source_passages in by_source.values():
+            passages.extend(self.merge_spans([p for p in source_passages if p["start"] is not None]))
+            passages.extend(self.merge_texts([p for p in source_passages if p["start"] is None]))
+        return sorted(passages, key=lambda p: p["rank"])
+
+    @staticmethod
+    def format_passage(number: int, passage: dict) -> str:
+        header = f"[{number}] {Path(passage['source']).name}" if passage["source"] else f"[{number}]"
+        if passage["pages"]:
+            header += f" (page {', '.join(str(page) for page in passage['pages'])})"
+        return f"{header}\n{passage['text']}"
+
+    def assemble(self, documents: List[Document]) -> str:
+        """
+        Context block of the prompt: the best ranked passages that fit in the token budget.
+        """
+        blocks, used = [], 0
+        for passage in self.passages(documents):
+            block = self.format_passage(len(blocks) + 1, passage)
+            tokens = self.count_tokens(block)
+            if used + tokens > self.token_budget:
+                continue
+            blocks.append(block)
+            used += tokens
+        return "\n\n".join(blocks)
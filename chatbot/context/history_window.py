@@ -0,0 +1,128 @@
+from typing import List, Tuple
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+SUMMARY_PROMPT = """
+Here is the summary of a conversation between a user and an AI Engineering assistant so far:
+<summary>
+{summary}
+</summary>
+
+And here are the next turns of the conversation:
+<turns>
+{turns}
+</turns>
+
+Update the summary with the new turns. Keep the user's questions, the facts and answers given, and anything the user asked to remember. Answer only with the updated summary, in a few short paragraphs.
+"""
+
+
+class HistoryWindow:
+    def __init__(self,
+                 summarizer=None,
+                 max_turns: int = 4,
+                 max_tokens: int = 8000,
+                 encoding_name: str = "cl100k_base"
+                 ) -> None:
+        """
+        Bounds the conversation history replayed to the assistant at each turn.
+
+        The thinking stored with each answer is never replayed. Turns (a user message and the answers that follow
+        it) are sent verbatim until there are more than 2 * max_turns of them, then all but the last max_turns are
+        folded at once by the summarizer LLM into a summary updated incrementally: only the turns leaving the window
+        are summarized, once. The summarizer call (made before the answer) thus happens once every max_turns + 1
+        turns instead of at every turn, and the summary changes as seldom.
+
+        If the request would still be over max_tokens (counted with tiktoken's encoding_name), the window is folded
+        down to max_turns, then turn by turn down to the current message, which is truncated as a last resort.
+        """
+        self.summarizer = summarizer
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.encoding_name = encoding_name
+        self.encoding = None
+
+    def get_encoding(self):
+        if self.encoding is None:
+            import tiktoken
+            self.encoding = tiktoken.get_encoding(self.encoding_name)
+        return self.encoding
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.get_encoding().encode_ordinary(text))
+
+    @staticmethod
+    def message_text(message: BaseMessage) -> str:
+        if isinstance(message.content, str):
+            return message.content
+        return "".join(block.get("text", "") for block in message.content if isinstance(block, dict))
+
+    @staticmethod
+    def is_thinking(messages: List[BaseMessage], idx: int) -> bool:
+        message = messages[idx]
+        if not isinstance(message, AIMessage):
+            return False
+        if message.additional_kwargs.get("thinking"):
+            return True
+        # Threads stored before thinking was flagged: the thinking is the AIMessage right before the answer.
+        return idx + 1 < len(messages) and isinstance(messages[idx + 1], AIMessage) \
+            and not messages[idx + 1].additional_kwargs.get("thinking")
+
+    def replayable(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        return [message for idx, message in enumerate(messages) if not self.is_thinking(messages, idx)]
+
+    @staticmethod
+    def turns(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+        turns = []
+        for message in messages:
+            if isinstance(message, HumanMessage) or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return turns
+
+    def summarize(self, summary: str, messages: List[BaseMessage]) -> str:
+        turns = "\n\n".join(f"{'User' if isinstance(message, HumanMessage) else 'Assistant'}: "
+                            f"{self.message_text(message)}" for message in messages)
+        # Tagged nostream, so the summary is not streamed to the user with the answer.
+        response = self.summarizer.invoke(SUMMARY_PROMPT.format(summary=summary or "(empty)", turns=turns),
+                                          config={"tags": ["nostream"]})
+        return self.message_text(response).strip()
+
+    def truncate(self, message: BaseMessage, max_tokens: int) -> BaseMessage:
+        tokens = self.get_encoding().encode_ordinary(self.message_text(message))
+        return message.model_copy(update={"content": self.get_encoding().decode(tokens[:max(max_tokens, 0)])})
+
+    def window(self,
+               messages: List[BaseMessage],
+               summary: str = "",
+               summarized: int = 0,
+               reserved_tokens: int = 0) -> Tuple[List[BaseMessage], str, int]:
+        """
+        Messages to send for the thread messages, with reserved_tokens taken by the rest of the request (system
+        prompt and context). summary covers the first summarized replayable messages of the thread, the updated
+        (messages, summary, summarized) are returned.
+        """
+        turns = self.turns(self.replayable(messages)[summarized:])
+        keep, fold = turns, []
+        if len(turns) > 2 * self.max_turns:
+            keep, fold = turns[-self.max_turns:], turns[:-self.max_turns]
+
+        def request_tokens():
+            summary_tokens = self.count_tokens(summary) if summary else 0
+            return reserved_tokens + summary_tokens + sum(self.count_tokens(self.message_text(message))
+                                                          for turn in keep for message in turn)
+
+        while len(keep) > 1 and request_tokens() > self.max_tokens:
+            n_fold = len(keep) - self.max_turns if len(keep) > self.max_turns else 1
+            fold.extend(keep[:n_fold])
+            keep = keep[n_fold:]
+
+        folded = [message for turn in fold for message in turn]
+        if folded:
+            summary = self.summarize(summary, folded)
+            summarized += len(folded)
+
+        window = [message for turn in keep for message in turn]
+        overflow = request_tokens() - self.max_tokens
+        if overflow > 0 and window:
+            window[-1] = self.truncate(window[-1], self.count_tokens(self.message_text(window[-1])) - overflow)
+        return window, summary, summarized
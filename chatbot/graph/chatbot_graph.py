@@ -14,8 +14,11 @@ memory = MemorySaver()
 builder = StateGraph(ChatbotState)
 builder.add_node("assistant", ChatbotsNodes.assistant)
 builder.add_node("retrieval", ChatbotsNodes.retrieval)
+builder.add_node("route", ChatbotsNodes.route)
 
-builder.add_edge(START, "retrieval")
+# Retrieval only when the router says the turn needs fresh context.
+builder.add_edge(START, "route")
+builder.add_conditional_edges("route", ChatbotsNodes.next_node, ["retrieval", "assistant"])
 builder.add_edge("retrieval", "assistant")
 graph = builder.compile(checkpointer=memory)
 
@@ -1,8 +1,22 @@
+import os
+import time
+import asyncio
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from chatbot.states.chatbot_states import ChatbotState
-from chatbot.prompts.prompt_v0 import CHATBOT_PROMPT
+from chatbot.prompts.prompt_v1 import CHATBOT_INSTRUCTIONS, CONVERSATION_SUMMARY, CHATBOT_TURN
+from chatbot.context.context_assembly import ContextAssembler
+from chatbot.context.history_window import HistoryWindow
+from chatbot.routing.query_router import QueryRouter
 from llm_config.llm_model_config import LLMModelConfig
-from langchain_core.messages import SystemMessage, AIMessage
+from langchain_core.messages import SystemMessage, AIMessage, HumanMessage
 from vector_database.hybrid_retrieval import HybridSearchRetriever
+from vector_database.federated_retrieval import FederatedRetriever
+
+# Part of the retrieval budget left to the federated retriever once its deadline is hit: fusing the backends that
+# answered and handing the result back to the node must fit in it.
+FEDERATION_MARGIN_SECONDS = 0.3
 
 class ChatbotsNodes:
     def __init__(self) -> None:
@@ -15,39 +29,223 @@ class ChatbotsNodes:
             thinking={"type": "enabled", "budget_tokens": 1024}
         )
 
-        self.retriever = HybridSearchRetriever(
-            index_name="ca-contextualemb-dotp-3large",
-            embedding_model_name="text-embedding-3-large",
-            embedding_provider="openai"
-        ).retriever
+        # Comma separated VECTOR_INDEXES are queried together and fused (see FederatedRetriever).
+        index_names = os.getenv("VECTOR_INDEXES", "ca-contextualemb-dotp-3large").split(",")
+        retrievers = {
+            index_name.strip(): HybridSearchRetriever(
+                index_name=index_name.strip(),
+                embedding_model_name="text-embedding-3-large",
+                embedding_provider="openai",
+                backend=os.getenv("VECTOR_BACKEND", "pinecone")   # "local" to serve the index in-process
+            )
+            for index_name in index_names
+        }
+        # Time to first token is bounded: retrieval past this budget falls back to a degraded context.
+        self.retrieval_budget = float(os.getenv("RETRIEVAL_BUDGET_SECONDS", "2.0"))
+        self.retriever = self.build_retriever(retrievers)
+        self.retrieval_executor = ThreadPoolExecutor(max_workers=8)
+        self.router = QueryRouter()
+        # Merged, deduplicated passages within a token budget instead of the repr of the retrieved Documents.
+        self.context_assembler = ContextAssembler(token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000")))
+        # Prompt cache usage of the assistant requests, see record_usage.
+        self.lock = threading.Lock()
+        self.usage = defaultdict(int)
+        self.retrieval_paths = defaultdict(int)
+        # Last turns verbatim, older ones in a rolling summary written by a small model.
+        self.history_window = HistoryWindow(
+            summarizer=llm_config.get_llm_model(model_name="claude-3-5-haiku-latest", temperature=0, max_tokens=512),
+            max_turns=int(os.getenv("HISTORY_MAX_TURNS", "4")),
+            max_tokens=int(os.getenv("PROMPT_MAX_TOKENS", "12000"))
+        )
+
+    def build_retriever(self, retrievers: dict):
+        """
+        A single index is queried directly. Several are federated with a deadline shorter than retrieval_budget, so
+        a slow backend is dropped and the others are fused before the node gives up on the whole retrieval.
+        """
+        if len(retrievers) == 1:
+            return next(iter(retrievers.values()))
+        deadline = max(self.retrieval_budget - FEDERATION_MARGIN_SECONDS, self.retrieval_budget / 2)
+        return FederatedRetriever(retrievers, deadline=deadline)
+
+    def route(self, state: ChatbotState):
+        """
+        Routing node: decides if the turn needs retrieval (see QueryRouter), next_node follows the decision.
+        """
+        decision, reason = self.router.decide(state["messages"][-1].content, has_context=bool(state.get("context")))
+        self.router.record_decision(decision, reason)
+
+        # The context of the previous turn stays in the state: "reuse" answers with it, "none" only leaves it out of
+        # its prompt, so a follow-up after small talk still finds it.
+        return {"route": decision}
+
+    @staticmethod
+    def next_node(state: ChatbotState) -> str:
+        return "retrieval" if state["route"] == "retrieve" else "assistant"
 
     def retrieval(self, state: ChatbotState):
         """
-        Retrieval node
+        Retrieval node, within retrieval_budget seconds: past it (or if the hybrid retrieval fails) the turn is served
+        by a degraded path, see fallback_context. The hybrid retrieval left behind keeps running in the pool and
+        fills the result cache for the next time.
         """
-        state["context"] = self.retriever.invoke(
-            state["messages"][-1].content   # Query on retriever with last message
-        )
-        return state
+        query = state["messages"][-1].content   # Query on retriever with last message
+        start = time.perf_counter()
+        future = self.retrieval_executor.submit(self.retriever.retrieve, query)
+        try:
+            context, path, reason = future.result(timeout=self.retrieval_budget), "hybrid", "within budget"
+            self.router.record_retrieval(time.perf_counter() - start)
+        except FuturesTimeoutError:
+            context, path = self.fallback_context(query)
+            reason = f"hybrid retrieval over the {self.retrieval_budget}s budget"
+        except Exception as e:
+            context, path = self.fallback_context(query)
+            reason = f"hybrid retrieval failed: {e!r}"
+
+        self.record_retrieval_path(path, reason, time.perf_counter() - start)
+        return {"context": context, "retrieval_path": path}
+
+    async def aretrieval(self, state: ChatbotState):
+        """
+        Async retrieval node, for graphs run with ainvoke/astream: waiting on the embedding and index requests does
+        not hold a worker thread. Same budget and fallbacks as retrieval, the hybrid retrieval is cancelled when
+        the budget runs out.
+        """
+        query = state["messages"][-1].content
+        start = time.perf_counter()
+        try:
+            context = await self.retriever.aretrieve(query, timeout=self.retrieval_budget)
+            path, reason = "hybrid", "within budget"
+            self.router.record_retrieval(time.perf_counter() - start)
+        except asyncio.TimeoutError:
+            context, path = self.fallback_context(query)
+            reason = f"hybrid retrieval over the {self.retrieval_budget}s budget"
+        except Exception as e:
+            context, path = self.fallback_context(query)
+            reason = f"hybrid retrieval failed: {e!r}"
+
+        self.record_retrieval_path(path, reason, time.perf_counter() - start)
+        return {"context": context, "retrieval_path": path}
+
+    def fallback_context(self, query: str):
+        """
+        Degraded context, in order: BM25 only over the local sparse index ("sparse", skipped when it stores no
+        chunks), the last results of the same query ("cached"), no context ("none").
+        """
+        context = []
+        # Checked at each fallback: the BM25 stats are reloaded when an ingestion bumps the index version.
+        if self.retriever.sparse_available():
+            try:
+                context = self.retriever.sparse_retrieve(query)
+            except Exception as e:
+                print(f"[Retrieval] Sparse fallback failed: {e!r}")
+        if context:
+            return context, "sparse"
+
+        context = self.retriever.cached_retrieve(query)
+        if context:
+            return context, "cached"
+        return [], "none"
+
+    def record_retrieval_path(self, path: str, reason: str, seconds: float) -> None:
+        with self.lock:
+            self.retrieval_paths[path] += 1
+            paths = dict(self.retrieval_paths)
+        print(f"[Retrieval] Served by {path} in {seconds * 1000:.0f}ms ({reason}). Paths so far: {paths}")
+
+    @staticmethod
+    def cached_block(text: str) -> dict:
+        return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+
+    def build_prompt(self, context: str, history: list, summary: str) -> list:
+        """
+        Prompt laid out for Anthropic prompt caching: the stable part first (instructions, previous turns), with a
+        cache breakpoint at the end of the system prompt and one on the last previous message, then the part that
+        changes at every turn (summary, retrieved context and current message) in the last user message. A turn
+        reads the prefix the previous turn wrote, the summary is kept after the breakpoints so updating it does not
+        invalidate them.
+        """
+        system = SystemMessage(content=[self.cached_block(CHATBOT_INSTRUCTIONS)])
+
+        previous, current = history[:-1], history[-1]
+        if previous:
+            previous[-1] = self.with_cache_breakpoint(previous[-1])
+
+        turn = CHATBOT_TURN.format(relevant_documents=context, message=current.content)
+        if summary:
+            turn = CONVERSATION_SUMMARY.format(summary=summary) + turn
+        return [system] + previous + [HumanMessage(content=turn)]
+
+    def with_cache_breakpoint(self, message):
+        """
+        Copy of message with cache_control on its last text block.
+        """
+        if isinstance(message.content, str):
+            blocks = [self.cached_block(message.content)] if message.content else []
+        else:
+            blocks = [dict(block) if isinstance(block, dict) else {"type": "text", "text": block}
+                      for block in message.content]
+            text_blocks = [block for block in blocks if block.get("type") == "text" and block.get("text")]
+            if text_blocks:
+                text_blocks[-1]["cache_control"] = {"type": "ephemeral"}
+        if not any("cache_control" in block for block in blocks):
+            return message
+        return message.model_copy(update={"content": blocks})
+
+    def record_usage(self, response) -> None:
+        usage = response.usage_metadata or {}
+        details = usage.get("input_token_details") or {}
+        cache_read = details.get("cache_read") or 0
+        cache_write = details.get("cache_creation") or 0
+        uncached = usage.get("input_tokens", 0) - cache_read - cache_write
+
+        with self.lock:
+            self.usage["requests"] += 1
+            self.usage["cache_read_tokens"] += cache_read
+            self.usage["cache_write_tokens"] += cache_write
+            self.usage["uncached_input_tokens"] += uncached
+            self.usage["output_tokens"] += usage.get("output_tokens", 0)
+
+        print(f"[Assistant] Input tokens: {cache_read} cache read / {cache_write} cache write / {uncached} uncached. "
+              f"Session: {self.usage_report()}")
+
+    def usage_report(self) -> str:
+        with self.lock:
+            usage = dict(self.usage)
+
+        input_tokens = usage["cache_read_tokens"] + usage["cache_write_tokens"] + usage["uncached_input_tokens"]
+        hit_rate = usage["cache_read_tokens"] / input_tokens if input_tokens else 0.0
+        return (f"{usage['requests']} requests, {usage['cache_read_tokens']} cache read / "
+                f"{usage['cache_write_tokens']} cache write / {usage['uncached_input_tokens']} uncached input tokens "
+                f"({hit_rate:.0%} of input read from cache), {usage['output_tokens']} output tokens")
 
     def assistant(self, state: ChatbotState):
         """
         Assistant node
         """
-        sys_msg = SystemMessage(
-            content=CHATBOT_PROMPT.format(
-                relevant_documents=state["context"],
-                message=state["messages"][-1].content
-            ),
-            additional_kwargs={"cache-control": {"type": "ephemeral"}}
+        context = self.context_assembler.assemble(state.get("context") or []) if state.get("route") != "none" else ""
+        reserved_tokens = self.history_window.count_tokens(CHATBOT_INSTRUCTIONS) + \
+                          self.history_window.count_tokens(CHATBOT_TURN.format(relevant_documents=context, message=""))
+
+        history, summary, summarized = self.history_window.window(
+            state["messages"],
+            summary=state.get("summary", ""),
+            summarized=state.get("summarized_messages", 0),
+            reserved_tokens=reserved_tokens
         )
 
-        response = self.llm.invoke([sys_msg] + state["messages"])
+        response = self.llm.invoke(self.build_prompt(context, history, summary))
+        self.record_usage(response)
 
         thinking = response.content[0]["thinking"] if "thinking" in response.content[0] else ""
         text = response.content[1]["text"] if "text" in response.content[1] else ""
 
-        state["messages"].extend([AIMessage(content=thinking), AIMessage(content=text)])
-
         # claude 3.7 response looks like [{thinking:..., text:....}], and we spect a dict in front end, so...
-        return {"thinking": thinking, "text": text}
+        # The thinking is stored flagged, so it is never replayed (see HistoryWindow).
+        return {
+            "messages": [AIMessage(content=thinking, additional_kwargs={"thinking": True}), AIMessage(content=text)],
+            "summary": summary,
+            "summarized_messages": summarized,
+            "thinking": thinking,
+            "text": text
+        }
@@ -0,0 +1,22 @@
+# Same prompt as prompt_v0, split for prompt caching: the instructions never change, the context and the user
+# message change at every turn, so they go in the last user message, after everything that can be cached.
+CHATBOT_INSTRUCTIONS = """
+You are an AI Engineer specialist. User will ask you questions about AI Engineering and you need to answer based on the context retrieved, given with each user message.
+
+You can ask for clarification and say you don't know the answer if you don't have enought context to answer it.
+
+If user message is not about AI Engineering, you can act as a general purpose AI model. Just answer in normal way, act like a specialist.
+"""
+
+CONVERSATION_SUMMARY = """
+Summary of the earlier conversation:
+{summary}
+"""
+
+CHATBOT_TURN = """
+Context:
+{relevant_documents}
+
+User: 
+{message}
+"""
@@ -0,0 +1,91 @@
+import re
+import threading
+from typing import Tuple
+
+# Whole messages that need no context at all.
+SMALL_TALK = re.compile(
+    r"^(hi|hello|hey|good (morning|afternoon|evening)|thanks?( you)?( so much| a lot)?|thx|ty|ok(ay)?|cool|great|"
+    r"nice|perfect|awesome|got it|understood|makes sense|bye|goodbye|see you|yes|no|yep|nope|sure)"
+    r"( ?!+| ?\.+)*$"
+)
+
+# Instructions about the previous answer, answered from the same context. The phrase must end a word ("longer context
+# windows" is not "longer"): (?!\w) rather than \b, which never matches after "why?".
+FOLLOW_UP = re.compile(
+    r"^(rewrite|rephrase|reword|shorten|summari[sz]e|simplify|translate|format|expand|elaborate|"
+    r"make (it|that|this)|explain (it|that|this)|say (it|that)|put (it|that)|can you (rewrite|rephrase|shorten|"
+    r"summari[sz]e|simplify|translate|make it|explain that|explain it)|"
+    r"(give me|show me) (an )?(example|examples|the code)|in (bullet points|a table|portuguese|english|spanish)|"
+    r"(more|less) (detail|details|detailed|concise)|shorter|longer|why\??$|how so\??$|what do you mean)(?!\w)"
+)
+REFERENCES = re.compile(r"\b(it|that|this|these|those|above|previous|your (answer|response|explanation))\b")
+
+
+class QueryRouter:
+    def __init__(self, max_follow_up_words: int = 12, max_extra_words: int = 2) -> None:
+        """
+        Decides per turn, with local rules only (no LLM call), whether the assistant needs fresh retrieval:
+
+        - "none": small talk ("thanks!", "ok", "hi"), answered without context.
+        - "reuse": short follow-ups about the previous answer ("rewrite that shorter", "translate it"), answered with
+          the context retrieved for the previous turn. A follow-up instruction must refer to the previous answer
+          (it, that, this, above...) or add at most max_extra_words words ("summarize the hyde paper" is a new
+          question about the paper).
+        - "retrieve": everything else, and follow-ups when there is no previous context to reuse.
+
+        It also keeps a moving average of the retrieval latency, to log the time saved by each skipped retrieval.
+        """
+        self.max_follow_up_words = max_follow_up_words
+        self.max_extra_words = max_extra_words
+        self.lock = threading.Lock()
+        self.retrieval_seconds = None
+        self.decisions = {"retrieve": 0, "reuse": 0, "none": 0}
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def normalize(message: str) -> str:
+        return re.sub(r"\s+", " ", message.lower()).strip()
+
+    def decide(self, message: str, has_context: bool) -> Tuple[str, str]:
+        """
+        (decision, reason) for the last user message.
+        """
+        text = self.normalize(message)
+        if not re.search(r"\w", text):
+            return "none", "no words"
+        if SMALL_TALK.match(text):
+            return "none", "small talk"
+
+        n_words = len(text.split())
+        if n_words <= self.max_follow_up_words and (self.is_follow_up(text) or
+                                                   (n_words <= 6 and REFERENCES.search(text))):
+            # Capitalized words or acronyms after the first word ("is this better than RAG-Fusion?") are new topics.
+            if re.search(r"\b[A-Z]", message.strip().partition(" ")[2]):
+                return "retrieve", "follow-up naming new terms"
+            if has_context:
+                return "reuse", "follow-up on the previous answer"
+            return "retrieve", "follow-up without previous context"
+        return "retrieve", "new question"
+
+    def is_follow_up(self, text: str) -> bool:
+        match = FOLLOW_UP.match(text)
+        if match is None:
+            return False
+        return bool(REFERENCES.search(text)) or len(text[match.end():].split()) <= self.max_extra_words
+
+    def record_retrieval(self, seconds: float) -> None:
+        with self.lock:
+            self.retrieval_seconds = seconds if self.retrieval_seconds is None \
+                                             else 0.8 * self.retrieval_seconds + 0.2 * seconds
+
+    def record_decision(self, decision: str, reason: str) -> None:
+        with self.lock:
+            self.decisions[decision] += 1
+            saved = (self.retrieval_seconds or 0.0) if decision != "retrieve" else 0.0
+            self.seconds_saved += saved
+            total_saved, decisions = self.seconds_saved, dict(self.decisions)
+
+        message = f"[Router] {decision} ({reason})"
+        if decision != "retrieve":
+            message += f", ~{saved * 1000:.0f}ms of retrieval saved ({total_saved:.2f}s in total)"
+        print(f"{message}. Decisions so far: {decisions}")
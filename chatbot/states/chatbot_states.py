@@ -7,4 +7,11 @@ from langchain_core.documents import Document
 class ChatbotState(TypedDict):
     messages: Annotated[list, add_messages]
     context: List[Document]
+    # Decision of the router for the current turn: "retrieve", "reuse" or "none".
+    route: str
+    # Path that served the context of the turn: "hybrid", "sparse", "cached" or "none".
+    retrieval_path: str
+    # Rolling summary of the first summarized_messages messages of the thread (thinking excluded).
+    summary: str
+    summarized_messages: int
 
@@ -0,0 +1,94 @@
+import time
+import random
+import threading
+from datetime import datetime, timezone
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float) -> None:
+        """
+        Bucket of per_minute units refilled continuously. The level can go negative when the real cost of a
+        request was higher than what was taken for it, delaying the next ones.
+        """
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60.0 / self.capacity)
+
+
+class RateLimiter:
+    def __init__(self,
+                 requests_per_minute: float = 50,
+                 tokens_per_minute: float = 40000
+                 ) -> None:
+        """
+        Paces calls to an LLM API under a requests per minute and an input tokens per minute quota.
+
+        acquire() blocks until both buckets can pay for the request. The buckets follow the API: update_from_headers()
+        takes the limits, the remaining quota and the retry-after of a response (anthropic-ratelimit-* headers), and
+        settle() corrects the tokens taken for a request with the ones it really used.
+        """
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, tokens: int) -> None:
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+
+                wait = max(self.paused_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    self.requests.level -= 1
+                    self.tokens.level -= min(tokens, self.tokens.capacity)
+                    return
+                self.condition.wait(wait)
+
+    def settle(self, estimated_tokens: int, used_tokens: int) -> None:
+        with self.condition:
+            self.tokens.level -= used_tokens - min(estimated_tokens, self.tokens.capacity)
+            self.condition.notify_all()
+
+    def update_from_headers(self, headers) -> None:
+        if headers is None:
+            return
+
+        with self.condition:
+            now = time.monotonic()
+            for bucket, name in ((self.requests, "requests"), (self.tokens, "input-tokens")):
+                limit = headers.get(f"anthropic-ratelimit-{name}-limit")
+                remaining = headers.get(f"anthropic-ratelimit-{name}-remaining")
+                if limit:
+                    bucket.refill(now)
+                    bucket.capacity = float(limit)
+                if remaining:
+                    bucket.refill(now)
+                    bucket.level = min(bucket.level, float(remaining))
+
+                # With nothing left, nothing is sent before the API says the quota is back.
+                reset = headers.get(f"anthropic-ratelimit-{name}-reset")
+                if remaining is not None and float(remaining) <= 0 and reset:
+                    reset_in = (datetime.fromisoformat(reset.replace("Z", "+00:00")) -
+                                datetime.now(timezone.utc)).total_seconds()
+                    self.paused_until = max(self.paused_until, now + reset_in)
+
+            retry_after = headers.get("retry-after")
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + float(retry_after))
+
+
+def backoff_time(attempt: int, base: float = 1.0, maximum: float = 60.0) -> float:
+    """
+    Exponential backoff with full jitter, so retrying workers do not hit the API again at the same time.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
@@ -1,4 +1,20 @@
+from typing import List
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from preprocessment.chunking.span_chunking import SpanChunker
+
+
+class OffsetTextSplitter(RecursiveCharacterTextSplitter):
+    """
+    RecursiveCharacterTextSplitter whose chunks carry end_index next to start_index, like span chunks, so chunks
+    of the same source can be merged by offsets at query time even once preprocessing appended context to them.
+    """
+    def create_documents(self, texts: List[str], metadatas: List[dict] = None) -> List[Document]:
+        documents = super().create_documents(texts, metadatas)
+        for doc in documents:
+            doc.metadata["end_index"] = doc.metadata["start_index"] + len(doc.page_content)
+        return documents
+
 
 class ContentAwareChunking:
     def __init__(self,
@@ -13,10 +29,22 @@ class ContentAwareChunking:
 
     def get_chunker(self):
         """
-        Get the langchain recursive text splitter object.
+        Get the langchain recursive text splitter object (with start_index / end_index offsets).
+        :return:
+        """
+        return OffsetTextSplitter(
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            add_start_index=True
+        )
+
+    def get_span_chunker(self, length_unit: str = "characters"):
+        """
+        Get the same splitting as offsets over the document text (see SpanChunker).
         :return:
         """
-        return RecursiveCharacterTextSplitter(
+        return SpanChunker(
             chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap
+            chunk_overlap=self.chunk_overlap,
+            length_unit=length_unit
         )
@@ -0,0 +1,183 @@
+from bisect import bisect_left
+from collections import deque
+from typing import Callable, List, Tuple
+from langchain_core.documents import Document
+
+DEFAULT_SEPARATORS = ["\n\n", "\n", " ", ""]
+
+
+class TextBuffer:
+    def __init__(self, text: str, metadata: dict) -> None:
+        """
+        Text and metadata of a parsed document, shared by all the spans cut from it.
+        """
+        self.text = text
+        self.metadata = metadata
+
+
+class Span:
+    __slots__ = ("buffer", "start", "end", "context")
+
+    def __init__(self, buffer: TextBuffer, start: int, end: int) -> None:
+        """
+        Chunk of a document as a (buffer, start, end) range, with an optional context appended by preprocessing.
+
+        It reads like a Document (page_content, metadata), so the rest of the ingestion handles it the same way, but
+        the chunk text only exists as a string while something reads it: memory follows the source text instead of
+        the source text times the overlap.
+        """
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+        self.context = ""
+
+    @property
+    def page_content(self) -> str:
+        return self.buffer.text[self.start:self.end] + self.context
+
+    @page_content.setter
+    def page_content(self, value: str) -> None:
+        # Preprocessing appends to the chunk: only the added part is kept.
+        source_text = self.buffer.text[self.start:self.end]
+        if not value.startswith(source_text):
+            raise ValueError("A span can only be extended, its source text can not change.")
+        self.context = value[len(source_text):]
+
+    @property
+    def metadata(self) -> dict:
+        return {**self.buffer.metadata, "start_index": self.start, "end_index": self.end}
+
+    def to_document(self) -> Document:
+        return Document(page_content=self.page_content, metadata=self.metadata)
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+
+class SpanChunker:
+    def __init__(self,
+                 chunk_size: int = 512,
+                 chunk_overlap: int = 80,
+                 separators: List[str] = None,
+                 length_unit: str = "characters",
+                 encoding_name: str = "cl100k_base"
+                 ) -> None:
+        """
+        Recursive splitting of RecursiveCharacterTextSplitter (split on the first separator found, merge the pieces
+        back up to chunk_size with chunk_overlap, split again the pieces still too long), done on offsets: it
+        returns Spans over the document text instead of new strings and copies of the metadata. In characters,
+        the chunks are exactly the splitter's ones, so chunk ids do not change when switching between the two.
+
+        With length_unit="tokens", chunk_size and chunk_overlap are counted in tokens of encoding_name. Each
+        document is tokenized once, lengths of ranges come from the token offsets (the splitter tokenizes each
+        piece alone, a token across a piece boundary can be counted differently).
+        """
+        self.check_length_unit(length_unit)
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = separators or DEFAULT_SEPARATORS
+        self.length_unit = length_unit
+        self.encoding_name = encoding_name
+        self.encoding = None
+
+    @staticmethod
+    def check_length_unit(length_unit: str) -> None:
+        if length_unit not in ["characters", "tokens"]:
+            raise ValueError("The length unit must be 'characters' or 'tokens'.")
+
+    def split_documents(self, documents: List[Document]) -> List[Span]:
+        return [span for document in documents for span in self.split_document(document)]
+
+    def split_document(self, document: Document) -> List[Span]:
+        buffer = TextBuffer(document.page_content, document.metadata)
+        length = self.length_function(buffer.text)
+
+        spans = []
+        for start, end in self.split_range(buffer.text, 0, len(buffer.text), self.separators, length):
+            start, end = self.strip(buffer.text, start, end)
+            if start < end:
+                spans.append(Span(buffer, start, end))
+        return spans
+
+    def length_function(self, text: str) -> Callable[[int, int], int]:
+        if self.length_unit == "characters":
+            return lambda start, end: end - start
+
+        if self.encoding is None:
+            import tiktoken
+            self.encoding = tiktoken.get_encoding(self.encoding_name)
+        _, token_starts = self.encoding.decode_with_offsets(self.encoding.encode_ordinary(text))
+        # Tokens starting inside the range.
+        return lambda start, end: bisect_left(token_starts, end) - bisect_left(token_starts, start)
+
+    def split_range(self, text: str, start: int, end: int, separators: List[str], length) -> List[Tuple[int, int]]:
+        """
+        Chunks of text[start:end], the same steps as RecursiveCharacterTextSplitter._split_text: pieces shorter
+        than chunk_size are merged, each longer piece ends the current merge and is split with the next separators.
+        """
+        separator, remaining_separators = separators[-1], []
+        for idx, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if text.find(candidate, start, end) != -1:
+                separator, remaining_separators = candidate, separators[idx + 1:]
+                break
+
+        chunks, good_pieces = [], []
+        for piece_start, piece_end in self.cut(text, start, end, separator):
+            if length(piece_start, piece_end) < self.chunk_size:
+                good_pieces.append((piece_start, piece_end))
+                continue
+
+            if good_pieces:
+                chunks.extend(self.merge_pieces(good_pieces, length))
+                good_pieces = []
+            if not remaining_separators:
+                chunks.append((piece_start, piece_end))
+            else:
+                chunks.extend(self.split_range(text, piece_start, piece_end, remaining_separators, length))
+
+        if good_pieces:
+            chunks.extend(self.merge_pieces(good_pieces, length))
+        return chunks
+
+    @staticmethod
+    def cut(text: str, start: int, end: int, separator: str) -> List[Tuple[int, int]]:
+        if separator == "":
+            return [(idx, idx + 1) for idx in range(start, end)]
+
+        # Separators stay at the start of the piece that follows them (matches found left to right, without overlap).
+        cuts = [start]
+        position = text.find(separator, start, end)
+        while position != -1:
+            cuts.append(position)
+            position = text.find(separator, position + len(separator), end)
+        cuts.append(end)
+        return [(piece_start, piece_end) for piece_start, piece_end in zip(cuts, cuts[1:]) if piece_start < piece_end]
+
+    def merge_pieces(self, pieces: List[Tuple[int, int]], length) -> List[Tuple[int, int]]:
+        chunks = []
+        current = deque()
+        total = 0
+        for start, end in pieces:
+            piece_length = length(start, end)
+            if total + piece_length > self.chunk_size and current:
+                chunks.append((current[0][0], current[-1][1]))
+                # Keep the tail of the chunk as overlap for the next one.
+                while total > self.chunk_overlap or (total + piece_length > self.chunk_size and total > 0):
+                    total -= length(*current.popleft())
+            current.append((start, end))
+            total += piece_length
+
+        if current:
+            chunks.append((current[0][0], current[-1][1]))
+        return chunks
+
+    @staticmethod
+    def strip(text: str, start: int, end: int) -> Tuple[int, int]:
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        return start, end
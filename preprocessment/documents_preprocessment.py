@@ -1,51 +1,89 @@
 import os
 import time
+import threading
 from tqdm import tqdm
 from typing import List
+from collections import OrderedDict, defaultdict
 from pathlib import Path
 from dotenv import load_dotenv
-from anthropic import RateLimitError
+from anthropic import Anthropic, APIStatusError, APIConnectionError
+from concurrent.futures import ThreadPoolExecutor
 from langchain_core.documents import Document
-from langchain_core.prompts import ChatPromptTemplate
 from llm_config.llm_model_config import LLMModelConfig
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_core.messages import SystemMessage, HumanMessage
+from llm_config.rate_limiter import RateLimiter, backoff_time
+from preprocessment.parsing.parse_cache import ParseCache
 
 ROOT_DIR = Path(__file__).parent.parent
 load_dotenv(dotenv_path=ROOT_DIR / '.env')
 
+# The prompt cache lives 5 minutes after its last use, a source idle for longer than this is written again first.
+CACHE_REWARM_SECONDS = 240
+
 class Preprocesser:
     def __init__(self,
-                 preprocessing_technique: str = None
+                 preprocessing_technique: str = None,
+                 max_cached_sources: int = 32,
+                 max_concurrency: int = 8,
+                 requests_per_minute: float = 50,
+                 tokens_per_minute: float = 40000,
+                 max_retries: int = 8,
+                 parse_cache: ParseCache = None
                  ) -> None:
+        """
+        Contextual embedding requests are sent by a pool of max_concurrency threads shared by every caller, paced
+        by a RateLimiter (requests_per_minute, input tokens_per_minute, corrected by the rate limit headers the API
+        returns) and retried with jittered exponential backoff. A chunk that still fails after max_retries raises,
+        chunks are never left without their context silently.
 
+        Source documents are read from parse_cache, the one the ingestion loader fills, so they are not parsed again.
+        """
+        # The Anthropic client is used directly (not through LangChain) to read the rate limit headers of every
+        # response. Retries are done here, paced by the rate limiter.
         llm_config = LLMModelConfig('anthropic')
-        self.llm = llm_config.get_llm_model(
-            model_name="claude-3-7-sonnet-latest"
-        )
+        self.client = Anthropic(api_key=llm_config.ANTHROPIC_API_KEY, max_retries=0)
+        self.model_name = "claude-3-7-sonnet-latest"
 
         self.preprocessing_technique = preprocessing_technique
 
-    def contextual_embedding(self, docs: List[Document]) -> List[Document]:
+        self.parse_cache = parse_cache if parse_cache is not None else ParseCache()
+        self.lock = threading.Lock()
+        self.max_cached_sources = max_cached_sources
+        self.source_documents = OrderedDict()
+        self.source_locks = defaultdict(threading.Lock)
+        # Source -> time.monotonic() of the last request that wrote or read its prompt cache.
+        self.cached_sources = {}
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.max_retries = max_retries
+        self.usage = {"requests": 0, "retries": 0, "cache_read_tokens": 0, "cache_write_tokens": 0,
+                      "uncached_input_tokens": 0, "output_tokens": 0}
+
+    def load_source_document(self, source) -> str:
         """
-        Function that apply contextual embedding preprocessment for each document in input list.
+        Full text of a source file, from the parse cache and kept in memory for the next chunks of the same file.
         """
-        for doc in tqdm(docs, desc="Augmenting chunks using contextual embeddings strategy..."):
-            source_doc_path = doc.metadata['source']
-            loader = PyPDFLoader(source_doc_path)
-            source_doc_pages = loader.load()
-
-            full_source_document = ""
-            for page in source_doc_pages:
-                full_source_document += page.page_content + "\n"
-
-            sys_msg = f"""
+        source = str(source)
+        with self.lock:
+            if source in self.source_documents:
+                self.source_documents.move_to_end(source)
+                return self.source_documents[source]
+
+        full_source_document = self.parse_cache.parse(source).text
+
+        with self.lock:
+            self.source_documents[source] = full_source_document
+            while len(self.source_documents) > self.max_cached_sources:
+                self.source_documents.popitem(last=False)
+        return full_source_document
+
+    def situate_chunk(self, full_source_document: str, doc: Document, cached: bool = True):
+        sys_msg = f"""
 Considering the full document:
 <document>
 {full_source_document}
 </document>
 """
-            human_msg = f"""
+        human_msg = f"""
 Here is the chunk we want to situate within the whole document:
 <chunk>
 {doc.page_content}
@@ -54,36 +92,125 @@ Here is the chunk we want to situate within the whole document:
 Please give a short succinct context to situate this chunk within the overall document for the purposes of improving search retrieval of the chunk.
 Answer only with the succinct context and nothing else.
 """
-            prompt = ChatPromptTemplate.from_messages([
-                SystemMessage(content=[{
-                    "text": sys_msg,
-                    "type": "text",
-
-                    # Since we are sending multiple times the same global document, we can send it once with the
-                    # flag to be cached, and in next times 5 minutes this tokens will have 90% discount to be
-                    # used again. To learn more: https://www.anthropic.com/news/prompt-caching.
-                    "cache_control": {"type": "ephemeral"}
-                }]),
-                HumanMessage(content=human_msg)
-            ])
-
-            # Try/except because of api limit, some chunks can be so big that raises the limit error.
+        system = [{
+            "text": sys_msg,
+            "type": "text",
+
+            # Since we are sending multiple times the same global document, we can send it once with the
+            # flag to be cached, and in next times 5 minutes this tokens will have 90% discount to be
+            # used again. To learn more: https://www.anthropic.com/news/prompt-caching.
+            "cache_control": {"type": "ephemeral"}
+        }]
+
+        # Cached document tokens do not count in the input tokens per minute quota, so only the first request of a
+        # source pays for the document. About 4 characters per token.
+        estimated_tokens = (len(human_msg) + (0 if cached else len(sys_msg))) // 4
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(estimated_tokens)
             try:
-                result = self.llm.invoke(prompt.messages)
-            except RateLimitError:
-                print("\nRate limit error. Waiting 60 sec before trying again...")
-                time.sleep(60)
-                try:
-                    result = self.llm.invoke(prompt.messages)
-                except RateLimitError as e:
-                    print("Rate limit persists. Skipping this chunk. \n", e)
-                    continue
-
-            # Add the global context to the end of the document content.
-            doc.page_content += "\n" + result.content
+                response = self.client.messages.with_raw_response.create(
+                    model=self.model_name,
+                    max_tokens=1000,
+                    temperature=0.7,
+                    system=system,
+                    messages=[{"role": "user", "content": human_msg}]
+                )
+            except (APIStatusError, APIConnectionError) as e:
+                # Rate limits (429), overloads (529), server errors and network errors are worth retrying.
+                retryable = not isinstance(e, APIStatusError) or e.status_code in (408, 409, 429) or e.status_code >= 500
+                if not retryable or attempt == self.max_retries:
+                    raise
+
+                # A 429 tells the limiter how much quota is left and when to try again, for every thread.
+                if isinstance(e, APIStatusError):
+                    self.rate_limiter.update_from_headers(e.response.headers)
+                self.rate_limiter.settle(estimated_tokens, 0)
+                with self.lock:
+                    self.usage["retries"] += 1
+                time.sleep(backoff_time(attempt))
+                continue
+
+            # Successful responses carry the remaining quota too, the limiter follows it before any 429.
+            self.rate_limiter.update_from_headers(response.headers)
+            message = response.parse()
+            used_tokens = self.record_usage(message)
+            self.rate_limiter.settle(estimated_tokens, used_tokens)
+            return "".join(block.text for block in message.content if block.type == "text")
+
+    def contextual_embedding(self, docs: List[Document]) -> List[Document]:
+        """
+        Function that apply contextual embedding preprocessment for each document in input list.
+
+        Chunks are grouped by source file: each file is parsed once and the first chunk of every source is sent
+        first and alone for its source, to write the document in the prompt cache. The other chunks then read it
+        from the cache, all of them in flight at once up to the limits of the pool and of the rate limiter.
+        """
+        chunks_per_source = defaultdict(list)
+        for doc in docs:
+            chunks_per_source[str(doc.metadata['source'])].append(doc)
+
+        progress = tqdm(total=len(docs), desc="Augmenting chunks using contextual embeddings strategy...")
+        remaining = list(self.executor.map(lambda item: self.warm_source(*item, progress), chunks_per_source.items()))
+        list(self.executor.map(lambda item: self.augment(*item, progress),
+                               [(source, doc) for source, source_docs in remaining for doc in source_docs]))
+        progress.close()
 
         return docs
 
+    def warm_source(self, source: str, source_docs: List[Document], progress):
+        """
+        Send the first request of a source if nobody did it yet, returns the chunks of the source left to augment.
+        """
+        full_source_document = self.load_source_document(source)
+        with self.lock:
+            source_lock = self.source_locks[source]
+
+        # Other threads working on the same source wait for the cache to be written, otherwise they would all miss
+        # the cache and pay for the write again.
+        with source_lock:
+            with self.lock:
+                last_used = self.cached_sources.get(source)
+            if last_used is not None and time.monotonic() - last_used < CACHE_REWARM_SECONDS:
+                return source, source_docs
+            self.augment(source, source_docs[0], progress, cached=False)
+        return source, source_docs[1:]
+
+    def augment(self, source: str, doc: Document, progress, cached: bool = True) -> None:
+        context = self.situate_chunk(self.load_source_document(source), doc, cached=cached)
+        # Every request on the source keeps its prompt cache alive.
+        with self.lock:
+            self.cached_sources[source] = time.monotonic()
+        # Add the global context to the end of the document content.
+        doc.page_content += "\n" + context
+        progress.update(1)
+
+    def record_usage(self, message) -> int:
+        # The API counts cache reads and writes apart from input_tokens (the uncached ones).
+        usage = message.usage
+        cache_read = usage.cache_read_input_tokens or 0
+        cache_write = usage.cache_creation_input_tokens or 0
+
+        with self.lock:
+            self.usage["requests"] += 1
+            self.usage["cache_read_tokens"] += cache_read
+            self.usage["cache_write_tokens"] += cache_write
+            self.usage["uncached_input_tokens"] += usage.input_tokens
+            self.usage["output_tokens"] += usage.output_tokens
+
+        # Input tokens counted in the rate limit: everything but the cache reads.
+        return usage.input_tokens + cache_write
+
+    def usage_report(self) -> str:
+        with self.lock:
+            usage = dict(self.usage)
+
+        input_tokens = usage["cache_read_tokens"] + usage["cache_write_tokens"] + usage["uncached_input_tokens"]
+        hit_rate = usage["cache_read_tokens"] / input_tokens if input_tokens else 0.0
+        return (f"{usage['requests']} requests ({usage['retries']} retries), {usage['cache_read_tokens']} cache read / "
+                f"{usage['cache_write_tokens']} cache write / {usage['uncached_input_tokens']} uncached input tokens "
+                f"({hit_rate:.0%} of input read from cache), {usage['output_tokens']} output tokens")
+
     def preprocess_documents(self, docs: List[Document]) -> List[Document]:
         if self.preprocessing_technique == "contextual-embedding":
             return self.contextual_embedding(docs)
@@ -102,3 +229,4 @@ if __name__ == "__main__":
 
     preprocessor = Preprocesser(preprocessing_technique="contextual-embedding")
     print(preprocessor.preprocess_documents(docs=docs))
+    print(preprocessor.usage_report())
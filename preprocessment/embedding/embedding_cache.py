@@ -0,0 +1,190 @@
+import os
+import fcntl
+import hashlib
+import threading
+import numpy as np
+from pathlib import Path
+from typing import List
+from langchain_core.embeddings import Embeddings
+
+ROOT_DIR = Path(__file__).parent.parent.parent
+EMBEDDING_CACHE_DIR = ROOT_DIR / ".cache" / "embeddings"
+
+KEY_SIZE = 16
+
+
+class EmbeddingStore:
+    # One store per directory in the process (see shared), so threads never hold two views of the same files.
+    stores = {}
+    stores_lock = threading.Lock()
+
+    def __init__(self, directory, dimension: int) -> None:
+        """
+        Append-only on disk store of float32 vectors addressed by a 16 bytes key, safe to share between processes.
+
+        vectors.f32 holds the rows, keys.bin the key of each row: row i is at i * row size in vectors.f32 and its
+        key at i * 16 in keys.bin. Appends are serialized across processes with an flock on store.lock and take
+        their row from the real length of keys.bin, the vector is written (and fsynced) before the key, so a row
+        only exists once both are complete. A torn tail left by a crash is simply overwritten by the next append,
+        the files are never truncated. Keys appended by other processes are picked up on a miss.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.directory / "vectors.f32"
+        self.keys_path = self.directory / "keys.bin"
+        self.lock_path = self.directory / "store.lock"
+        self.dimension = dimension
+        self.row_size = dimension * 4
+        self.lock = threading.Lock()
+
+        self.vectors_path.touch()
+        self.keys_path.touch()
+        self.lock_path.touch()
+
+        self.rows = {}
+        self.n_rows = 0
+        self.vectors = None
+        self.mapped_rows = 0
+        self.refresh()
+
+    @classmethod
+    def shared(cls, directory, dimension: int) -> "EmbeddingStore":
+        """
+        The store of directory for this process, opened on first use.
+        """
+        directory = Path(directory).resolve()
+        with cls.stores_lock:
+            store = cls.stores.get(directory)
+            if store is None:
+                store = cls.stores[directory] = cls(directory, dimension)
+            elif store.dimension != dimension:
+                raise ValueError(f"Embedding store {directory} has dimension {store.dimension}, not {dimension}.")
+            return store
+
+    def refresh(self) -> None:
+        """
+        Read the keys appended since the last refresh (by this or another process). Only complete keys count.
+        """
+        n_keys = os.path.getsize(self.keys_path) // KEY_SIZE
+        if n_keys <= self.n_rows:
+            return
+
+        with open(self.keys_path, "rb") as f:
+            f.seek(self.n_rows * KEY_SIZE)
+            keys = f.read((n_keys - self.n_rows) * KEY_SIZE)
+        for i in range(len(keys) // KEY_SIZE):
+            # A key appended twice (two processes embedding the same text) keeps its first row.
+            self.rows.setdefault(keys[i * KEY_SIZE:(i + 1) * KEY_SIZE], self.n_rows + i)
+        self.n_rows += len(keys) // KEY_SIZE
+
+    def __contains__(self, key: bytes) -> bool:
+        if key in self.rows:
+            return True
+        with self.lock:
+            self.refresh()
+        return key in self.rows
+
+    def get_many(self, keys: List[bytes]) -> np.ndarray:
+        rows = np.array([self.rows[key] for key in keys], dtype=np.int64)
+        with self.lock:
+            if self.mapped_rows < self.n_rows:
+                self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.n_rows, self.dimension))
+                self.mapped_rows = self.n_rows
+            return np.array(self.vectors[rows]) if len(rows) else np.zeros((0, self.dimension), dtype=np.float32)
+
+    def put_many(self, keys: List[bytes], vectors: List[List[float]]) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dimension:
+            raise ValueError(f"Expected vectors of dimension {self.dimension}, got shape {vectors.shape}.")
+
+        with self.lock, open(self.lock_path, "r+b") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another process may have appended rows (maybe the same keys) since the last refresh.
+                self.refresh()
+                new = list({key: i for i, key in enumerate(keys) if key not in self.rows}.values())
+                if not new:
+                    return
+
+                with open(self.vectors_path, "r+b") as f:
+                    f.seek(self.n_rows * self.row_size)
+                    f.write(vectors[new].tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                with open(self.keys_path, "r+b") as f:
+                    f.seek(self.n_rows * KEY_SIZE)
+                    f.write(b"".join(keys[i] for i in new))
+
+                for i in new:
+                    self.rows[keys[i]] = self.n_rows
+                    self.n_rows += 1
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self,
+                 embedding_model: Embeddings,
+                 model_name: str,
+                 dimension: int,
+                 cache_dir=EMBEDDING_CACHE_DIR
+                 ) -> None:
+        """
+        Embeddings wrapper that only calls the wrapped model for texts it has never seen. Vectors are keyed by
+        (model name, dimension, text hash), so re-ingesting the same documents (in the same or in another index or
+        metric) and repeated queries never reach the embedding API.
+        """
+        self.embedding_model = embedding_model
+        self.model_name = model_name
+        self.dimension = dimension
+        self.store = EmbeddingStore.shared(Path(cache_dir) / f"{model_name}-{dimension}", dimension)
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> bytes:
+        return hashlib.blake2b(
+            f"{self.model_name}\0{self.dimension}\0{text}".encode("utf-8"), digest_size=KEY_SIZE
+        ).digest()
+
+    def missing_texts(self, texts: List[str], keys: List[bytes]) -> List[str]:
+        # Distinct texts that are not cached yet, in first appearance order.
+        missing = {key: text for text, key in zip(texts, keys) if key not in self.store}
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        return list(missing.values())
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.key(text) for text in texts]
+
+        missing = self.missing_texts(texts, keys)
+        if missing:
+            self.store.put_many([self.key(text) for text in missing], self.embedding_model.embed_documents(missing))
+
+        return self.store.get_many(keys).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self.key(text)
+
+        if self.missing_texts([text], [key]):
+            self.store.put_many([key], [self.embedding_model.embed_query(text)])
+
+        return self.store.get_many([key])[0].tolist()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.key(text) for text in texts]
+
+        missing = self.missing_texts(texts, keys)
+        if missing:
+            vectors = await self.embedding_model.aembed_documents(missing)
+            self.store.put_many([self.key(text) for text in missing], vectors)
+
+        return self.store.get_many(keys).tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self.key(text)
+
+        if self.missing_texts([text], [key]):
+            self.store.put_many([key], [await self.embedding_model.aembed_query(text)])
+
+        return self.store.get_many([key])[0].tolist()
@@ -2,17 +2,26 @@ import os
 from pathlib import Path
 from dotenv import load_dotenv
 from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
+from preprocessment.embedding.embedding_cache import CachedEmbeddings
 
 ROOT_DIR = Path(__file__).parent.parent.parent
 load_dotenv(dotenv_path=ROOT_DIR / '.env')
 
+MODELS_VECTOR_DIMENSION = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-large": 3072
+}
+
 class EmbeddingConfig:
     def __init__(self,
                  embedding_model: str,
-                 provider: str = "openai"
+                 provider: str = "openai",
+                 use_cache: bool = True
                  ) -> None:
         """
         Class used to manage with embedding configuration we are using in the project.
+
+        With use_cache the model is wrapped in CachedEmbeddings, so a text is only embedded once per model.
         """
         self.check_provider(provider)
         self.provider = provider
@@ -21,6 +30,12 @@ class EmbeddingConfig:
         self.embedding_model_name = embedding_model
 
         self.instanced_model = self.instance_embedding_model(self.embedding_model_name)
+        if use_cache:
+            self.instanced_model = CachedEmbeddings(
+                embedding_model=self.instanced_model,
+                model_name=self.embedding_model_name,
+                dimension=MODELS_VECTOR_DIMENSION[self.embedding_model_name]
+            )
 
     @staticmethod
     def check_provider(provider: str) -> None:
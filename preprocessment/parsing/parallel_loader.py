@@ -0,0 +1,142 @@
+import os
+import time
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait
+from typing import List
+from langchain_core.documents import Document
+from preprocessment.parsing.parse_cache import ParseCache, parse_file
+
+# Parser processes are started from a clean server process, never forked from the ingestion process and its threads
+# (a fork copies locks held by other threads). The server imports the parser once, so starting a process stays cheap.
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def parse_file_worker(path: str, connection) -> None:
+    """
+    Child process: parse one file and send (status, parsed document or error, parse seconds) back.
+    """
+    start = time.perf_counter()
+    try:
+        connection.send(("ok", parse_file(path), time.perf_counter() - start))
+    except Exception as e:
+        connection.send(("error", repr(e), time.perf_counter() - start))
+    finally:
+        connection.close()
+
+
+class ParallelDocumentLoader:
+    def __init__(self,
+                 n_workers: int = None,
+                 timeout: float = 300.0,
+                 parse_cache: ParseCache = None
+                 ) -> None:
+        """
+        Parses files with unstructured in separate processes, n_workers at a time. Every file gets its own process,
+        so a file that hangs past timeout seconds is killed and one that crashes the parser only fails itself.
+        Documents come back in the order of the input files.
+
+        Files found in parse_cache are not parsed again, the others are added to it once parsed.
+
+        Each file is recorded in self.stats (file, status, seconds, documents) to spot pathological PDFs.
+        """
+        self.n_workers = n_workers or os.cpu_count()
+        self.timeout = timeout
+        self.parse_cache = parse_cache if parse_cache is not None else ParseCache()
+        self.stats: List[dict] = []
+        self.lock = threading.Lock()
+
+        self.context = multiprocessing.get_context(START_METHOD)
+        if START_METHOD == "forkserver":
+            self.context.set_forkserver_preload(["preprocessment.parsing.parse_cache"])
+
+    def load(self, files) -> List[Document]:
+        files = [str(file) for file in files]
+        results = [[] for _ in files]
+        pending = deque()
+        running = {}
+
+        for file_idx, file in enumerate(files):
+            start = time.perf_counter()
+            try:
+                parsed = self.parse_cache.get(file)
+            except OSError as e:
+                # Missing or unreadable file (the cache hashes it): it fails alone, like a file the parser rejects.
+                self.record(file, "error", time.perf_counter() - start, repr(e))
+                continue
+            if parsed is None:
+                pending.append((file_idx, file))
+                continue
+            results[file_idx] = [self.to_document(file, parsed)]
+            self.record(file, "cached", time.perf_counter() - start, results[file_idx])
+
+        while pending or running:
+            while pending and len(running) < self.n_workers:
+                file_idx, file = pending.popleft()
+                receiver, sender = self.context.Pipe(duplex=False)
+                process = self.context.Process(target=parse_file_worker, args=(file, sender), daemon=True)
+                process.start()
+                sender.close()
+                running[receiver] = (file_idx, process, time.perf_counter())
+
+            next_deadline = min(start + self.timeout for _, _, start in running.values())
+            for receiver in wait(list(running), timeout=max(0.0, next_deadline - time.perf_counter())):
+                file_idx, process, start = running.pop(receiver)
+                try:
+                    status, payload, seconds = receiver.recv()
+                except EOFError:
+                    # The process died without answering (segfault, OOM kill...).
+                    status, payload, seconds = "error", "parser process died", time.perf_counter() - start
+                receiver.close()
+                process.join()
+
+                if status == "ok":
+                    try:
+                        self.parse_cache.put(files[file_idx], payload)
+                    except OSError as e:
+                        # The file went away while it was parsed, its document is still good, only not cached.
+                        print(f"[Document loader] Not caching {files[file_idx]}: {e!r}")
+                    payload = results[file_idx] = [self.to_document(files[file_idx], payload)]
+                self.record(files[file_idx], status, seconds, payload)
+
+            for receiver, (file_idx, process, start) in list(running.items()):
+                if time.perf_counter() - start > self.timeout:
+                    process.kill()
+                    process.join()
+                    receiver.close()
+                    del running[receiver]
+                    self.record(files[file_idx], "timeout", self.timeout, f"no answer after {self.timeout}s")
+
+        return [doc for docs in results for doc in docs]
+
+    @staticmethod
+    def to_document(file: str, parsed) -> Document:
+        # Same document as UnstructuredFileLoader in its default single mode.
+        return Document(page_content=parsed.text, metadata={"source": file})
+
+    def record(self, file: str, status: str, seconds: float, payload) -> None:
+        stats = {
+            "file": file,
+            "status": status,
+            "seconds": seconds,
+            "documents": len(payload) if status in ("ok", "cached") else 0,
+            "error": None if status in ("ok", "cached") else payload
+        }
+        with self.lock:
+            self.stats.append(stats)
+
+        if stats["error"] is not None:
+            print(f"[Document loader] Skipping {file} ({status}): {stats['error']}")
+
+    def report(self, slowest: int = 5) -> str:
+        with self.lock:
+            stats = list(self.stats)
+
+        failed = [s for s in stats if s["error"] is not None]
+        cached = [s for s in stats if s["status"] == "cached"]
+        lines = [f"{len(stats) - len(cached)} files parsed, {len(cached)} from the parse cache, {len(failed)} failed, "
+                 f"{sum(s['seconds'] for s in stats):.1f}s of parsing in total. Slowest files:"]
+        for s in sorted(stats, key=lambda s: s["seconds"], reverse=True)[:slowest]:
+            lines.append(f"  {s['seconds']:7.2f}s  {s['status']:<7}  {s['file']}")
+        return "\n".join(lines)
@@ -0,0 +1,141 @@
+import os
+import zlib
+import struct
+import hashlib
+import threading
+import numpy as np
+from pathlib import Path
+from typing import List, Optional
+from importlib.metadata import version, PackageNotFoundError
+from langchain_community.document_loaders import UnstructuredFileLoader
+
+ROOT_DIR = Path(__file__).parent.parent.parent
+PARSE_CACHE_DIR = ROOT_DIR / ".cache" / "parsed"
+
+MAGIC = b"PARSED\x00\x01"
+
+
+def parser_version() -> str:
+    try:
+        return f"unstructured-{version('unstructured')}"
+    except PackageNotFoundError:
+        return "unstructured-unknown"
+
+
+class ParsedDocument:
+    def __init__(self, source: str, text: str, page_offsets: List[int]) -> None:
+        """
+        Text of a parsed file and where each page starts in it (page i is text[page_offsets[i]:page_offsets[i + 1]]).
+        """
+        self.source = source
+        self.text = text
+        self.page_offsets = page_offsets
+
+    def page(self, page_idx: int) -> str:
+        return self.text[self.page_offsets[page_idx]:self.page_offsets[page_idx + 1]]
+
+    @property
+    def n_pages(self) -> int:
+        return len(self.page_offsets) - 1
+
+
+def parse_file(path: str) -> ParsedDocument:
+    """
+    Parse a file with unstructured. The text is the one UnstructuredFileLoader gives in its default single mode
+    (elements joined by blank lines), element metadata gives the page boundaries.
+    """
+    elements = UnstructuredFileLoader(path, mode="elements").load()
+
+    parts, page_offsets, length, page = [], [0], 0, None
+    for idx, element in enumerate(elements):
+        separator = "\n\n" if idx else ""
+        element_page = element.metadata.get("page_number")
+        if page is not None and element_page is not None and element_page != page:
+            page_offsets.append(length + len(separator))
+        page = element_page if element_page is not None else page
+
+        parts.append(separator + element.page_content)
+        length += len(parts[-1])
+    page_offsets.append(length)
+
+    return ParsedDocument(path, "".join(parts), page_offsets)
+
+
+class ParseCache:
+    def __init__(self, directory=PARSE_CACHE_DIR) -> None:
+        """
+        On disk cache of parsed files, keyed by the sha256 of the file content and the parser version, so a file is
+        parsed once until it changes or the parser is upgraded, whatever its path. Each entry is one file: a header,
+        the page offsets (int64) and the zlib compressed utf-8 text.
+        """
+        self.directory = Path(directory) / parser_version()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # Content hashes of files already hashed, while their size and modification time do not change.
+        self.hashes = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def file_hash(self, path) -> str:
+        stat = os.stat(path)
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if key in self.hashes:
+                return self.hashes[key]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+
+        with self.lock:
+            self.hashes[key] = digest.hexdigest()
+        return self.hashes[key]
+
+    def entry_path(self, path) -> Path:
+        return self.directory / f"{self.file_hash(path)}.parsed"
+
+    def get(self, path) -> Optional[ParsedDocument]:
+        entry_path = self.entry_path(path)
+        if not entry_path.exists():
+            with self.lock:
+                self.misses += 1
+            return None
+
+        data = entry_path.read_bytes()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{entry_path} is not a parse cache entry.")
+        n_offsets, = struct.unpack_from("<I", data, len(MAGIC))
+        offsets_start = len(MAGIC) + 4
+        text_start = offsets_start + n_offsets * 8
+        page_offsets = np.frombuffer(data[offsets_start:text_start], dtype="<i8").tolist()
+
+        with self.lock:
+            self.hits += 1
+        return ParsedDocument(str(path), zlib.decompress(data[text_start:]).decode("utf-8"), page_offsets)
+
+    def put(self, path, document: ParsedDocument) -> None:
+        entry_path = self.entry_path(path)
+        data = b"".join([
+            MAGIC,
+            struct.pack("<I", len(document.page_offsets)),
+            np.asarray(document.page_offsets, dtype="<i8").tobytes(),
+            zlib.compress(document.text.encode("utf-8"), 6)
+        ])
+
+        # Unique tmp name, two threads can parse the same file at once.
+        tmp_path = entry_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, entry_path)
+
+    def parse(self, path) -> ParsedDocument:
+        """
+        Parsed file from the cache, parsing it (in this process) and caching it on a miss.
+        """
+        document = self.get(path)
+        if document is None:
+            document = parse_file(str(path))
+            self.put(path, document)
+        return document
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# The packages are imported from the repository root, as when running the scripts.
+ROOT_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT_DIR))
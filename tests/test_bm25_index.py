@@ -0,0 +1,71 @@
+import re
+import numpy as np
+import pytest
+from pinecone_text.sparse import BM25Encoder
+from pinecone_text.sparse.bm25_tokenizer import BM25Tokenizer
+from vector_database.bm25_index import BM25Index
+
+CORPUS = [
+    "HyDE generates a hypothetical document and embeds it",
+    "BM25 is a sparse retrieval function based on term frequencies",
+    "Hybrid search fuses dense and sparse retrieval scores",
+    "Rerankers rescore the retrieved documents with a cross encoder",
+]
+
+
+@pytest.fixture(autouse=True)
+def offline_tokenizer(monkeypatch):
+    # BM25Tokenizer loads the nltk stopwords and stemmer data; both encoders share this class, so the weighting is
+    # compared with a simple tokenizer instead.
+    monkeypatch.setattr(BM25Tokenizer, "__init__", lambda self, **params: self.__dict__.update(params))
+    monkeypatch.setattr(BM25Tokenizer, "__call__", lambda self, text: re.findall(r"\w+", text.lower()))
+
+
+def as_dict(sparse: dict) -> dict:
+    return dict(zip(sparse["indices"], sparse["values"]))
+
+
+def assert_same_sparse(first: dict, second: dict) -> None:
+    first, second = as_dict(first), as_dict(second)
+    assert first.keys() == second.keys()
+    assert np.allclose([first[key] for key in first], [second[key] for key in first])
+
+
+def test_encodings_match_bm25_encoder():
+    encoder = BM25Encoder().fit(CORPUS)
+    index = BM25Index.fit(CORPUS)
+
+    for text in CORPUS:
+        assert_same_sparse(index.encode_documents(text), encoder.encode_documents(text))
+    for query in ["how does hyde work", "sparse retrieval", "unknown words only"]:
+        assert_same_sparse(index.encode_queries(query), encoder.encode_queries(query))
+
+
+def test_saved_index_is_memory_mapped_back(tmp_path):
+    index = BM25Index.fit(CORPUS, ids=["a", "b", "c", "d"], metadatas=[{"source": f"{i}.pdf"} for i in range(4)])
+    index.save(tmp_path / "sparse.bm25")
+    loaded = BM25Index.load(tmp_path / "sparse.bm25")
+
+    assert isinstance(loaded.postings_docs, np.memmap)
+    result = loaded.search("dense and sparse retrieval", top_k=1)[0]
+    assert (result.metadata["id"], result.metadata["source"]) == ("c", "2.pdf")
+
+
+def test_incremental_updates_match_a_refit():
+    index = BM25Index.fit(CORPUS[:2], ids=["a", "b"])
+    index.add_documents(CORPUS[2:], ids=["c", "d"])
+    # Re-upserting an id replaces its document instead of counting it twice.
+    index.remove_documents(["b"])
+    index.add_documents(["BM25 weights terms by inverse document frequency"], ids=["b"])
+
+    expected = BM25Index.fit([CORPUS[0], *CORPUS[2:], "BM25 weights terms by inverse document frequency"])
+    # Postings of the batches are only merged when something reads them.
+    assert len(index.pending_postings) == 3 and index.pending_removals
+    index.merge_pending()
+    expected.merge_pending()
+    assert len(expected.terms) > 0
+    assert (index.n_docs, index.avgdl) == (expected.n_docs, expected.avgdl)
+    assert np.array_equal(index.terms, expected.terms)
+    assert np.array_equal(index.doc_freq, expected.doc_freq)
+    assert [doc.metadata["id"] for doc in index.search("bm25 frequency", top_k=2)] == ["b"]
+
@@ -0,0 +1,113 @@
+import time
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from chatbot.nodes.nodes import ChatbotsNodes
+
+
+def nodes() -> ChatbotsNodes:
+    # Only the pure prompt / routing logic is tested, without the LLM and retriever clients.
+    return ChatbotsNodes.__new__(ChatbotsNodes)
+
+
+def history():
+    return [HumanMessage(content="q1"), AIMessage(content="a1"), HumanMessage(content="q2"),
+            AIMessage(content=[{"type": "text", "text": "a2"}]), HumanMessage(content="q3")]
+
+
+def test_summary_is_after_the_cache_breakpoints():
+    first = nodes().build_prompt("context", history(), "summary one")
+    second = nodes().build_prompt("context", history(), "summary two")
+
+    # Everything up to the last breakpoint is the same whatever the summary.
+    assert first[:-1] == second[:-1]
+    assert "summary one" in first[-1].content and "context" in first[-1].content
+    assert isinstance(first[0], SystemMessage) and first[0].content[-1]["cache_control"] == {"type": "ephemeral"}
+
+
+def test_cache_breakpoint_is_on_the_last_previous_message():
+    prompt = nodes().build_prompt("context", history(), "")
+
+    assert prompt[-2].content == [{"type": "text", "text": "a2", "cache_control": {"type": "ephemeral"}}]
+    assert prompt[2].content == "a1"
+    assert prompt[-1].content.rstrip().endswith("q3")
+
+
+class FakeRouter:
+    def __init__(self, decision: str) -> None:
+        self.decision = decision
+
+    def decide(self, message: str, has_context: bool):
+        return self.decision, "test"
+
+    def record_decision(self, decision: str, reason: str) -> None:
+        pass
+
+
+def test_small_talk_keeps_the_previous_context_in_the_state():
+    chatbot_nodes = nodes()
+    chatbot_nodes.router = FakeRouter("none")
+
+    update = chatbot_nodes.route({"messages": [HumanMessage(content="thanks!")], "context": ["previous chunk"]})
+    assert update == {"route": "none"}
+
+
+class FakeRetriever:
+    def __init__(self, sparse_available: bool) -> None:
+        self.available = sparse_available
+        self.sparse_queries = []
+
+    def sparse_available(self) -> bool:
+        return self.available
+
+    def sparse_retrieve(self, query: str):
+        self.sparse_queries.append(query)
+        return ["sparse chunk"]
+
+    def cached_retrieve(self, query: str):
+        return ["cached chunk"]
+
+
+def test_fallback_skips_sparse_retrieval_when_the_sparse_index_has_no_chunks():
+    chatbot_nodes = nodes()
+    chatbot_nodes.retriever = FakeRetriever(sparse_available=False)
+    assert chatbot_nodes.fallback_context("query") == (["cached chunk"], "cached")
+    assert chatbot_nodes.retriever.sparse_queries == []
+
+    chatbot_nodes.retriever = FakeRetriever(sparse_available=True)
+    assert chatbot_nodes.fallback_context("query") == (["sparse chunk"], "sparse")
+
+
+class SlowRetriever:
+    def __init__(self, documents: list, seconds: float) -> None:
+        self.documents = documents
+        self.seconds = seconds
+
+    def retrieve(self, query: str):
+        time.sleep(self.seconds)
+        return self.documents
+
+
+class TimingRouter:
+    def record_retrieval(self, seconds: float) -> None:
+        pass
+
+
+def test_federated_retrieval_serves_the_fast_backend_within_the_budget():
+    chatbot_nodes = nodes()
+    chatbot_nodes.retrieval_budget = 0.5
+    chatbot_nodes.retrieval_executor = ThreadPoolExecutor(max_workers=2)
+    chatbot_nodes.router = TimingRouter()
+    chatbot_nodes.lock = threading.Lock()
+    chatbot_nodes.retrieval_paths = defaultdict(int)
+    doc = Document(page_content="fast chunk", metadata={"source": "doc.pdf", "score": 1.0})
+    chatbot_nodes.retriever = chatbot_nodes.build_retriever({"slow": SlowRetriever([], seconds=2.0),
+                                                             "fast": SlowRetriever([doc], seconds=0.0)})
+
+    update = chatbot_nodes.retrieval({"messages": [HumanMessage(content="query")]})
+    # The federated deadline runs out before the node budget: the slow backend is dropped, not the whole retrieval.
+    assert update["retrieval_path"] == "hybrid"
+    assert [d.page_content for d in update["context"]] == ["fast chunk"]
+    assert chatbot_nodes.retriever.late["slow"] == 1
@@ -0,0 +1,39 @@
+from langchain_core.documents import Document
+from chatbot.context.context_assembly import ContextAssembler
+from preprocessment.chunking.content_aware_chunking import ContentAwareChunking
+
+
+class WordEncoding:
+    # Offline stand-in for tiktoken: one token per word.
+    @staticmethod
+    def encode_ordinary(text: str):
+        return text.split()
+
+
+def assembler(token_budget: int = 3000) -> ContextAssembler:
+    context_assembler = ContextAssembler(token_budget=token_budget)
+    context_assembler.encoding = WordEncoding()
+    return context_assembler
+
+
+def test_contextual_chunks_of_the_recursive_splitter_are_merged_by_offsets():
+    text = " ".join(f"word{i}" for i in range(200))
+    chunks = ContentAwareChunking(chunk_size=300, chunk_overlap=60).get_chunker().split_documents(
+        [Document(page_content=text, metadata={"source": "/docs/paper.pdf"})]
+    )
+    assert all(text[c.metadata["start_index"]:c.metadata["end_index"]] == c.page_content for c in chunks)
+
+    # Contextual preprocessing appends a different context to every chunk, text overlap can not match them.
+    for i, chunk in enumerate(chunks):
+        chunk.page_content += f"\nContext {i} of the paper."
+
+    context = assembler().assemble(chunks[:3])
+    assert context == f"[1] paper.pdf\n{text[:chunks[2].metadata['end_index']]}"
+
+
+def test_passages_that_do_not_fit_are_skipped_for_smaller_ones():
+    documents = [
+        Document(page_content="long " * 50, metadata={"source": "a.pdf"}),
+        Document(page_content="short passage", metadata={"source": "b.pdf", "page": 3}),
+    ]
+    assert assembler(token_budget=10).assemble(documents) == "[1] b.pdf (page 3)\nshort passage"
@@ -0,0 +1,76 @@
+import os
+from typing import List
+from langchain_core.embeddings import Embeddings
+from preprocessment.embedding.embedding_cache import CachedEmbeddings, EmbeddingStore, KEY_SIZE
+
+
+def key(i: int) -> bytes:
+    return i.to_bytes(KEY_SIZE, "big")
+
+
+def vector(i: int, dimension: int = 4) -> List[float]:
+    return [float(i)] * dimension
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self) -> None:
+        self.embedded = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.embedded.extend(texts)
+        return [vector(len(text)) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def test_two_stores_on_the_same_directory_never_overwrite_each_other(tmp_path):
+    # Two instances stand for two processes: each allocates its rows from the files, not from its own count.
+    first, second = EmbeddingStore(tmp_path, 4), EmbeddingStore(tmp_path, 4)
+    first.put_many([key(1), key(2)], [vector(1), vector(2)])
+    second.put_many([key(3)], [vector(3)])
+    first.put_many([key(4)], [vector(4)])
+
+    for store in [first, second, EmbeddingStore(tmp_path, 4)]:
+        assert all(key(i) in store for i in range(1, 5))
+        assert store.get_many([key(i) for i in range(1, 5)])[:, 0].tolist() == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_key_appended_by_another_store_is_not_appended_again(tmp_path):
+    first, second = EmbeddingStore(tmp_path, 4), EmbeddingStore(tmp_path, 4)
+    first.put_many([key(1)], [vector(1)])
+    second.put_many([key(1), key(2)], [vector(9), vector(2)])
+
+    assert os.path.getsize(tmp_path / "keys.bin") == 2 * KEY_SIZE
+    assert second.get_many([key(1)])[0, 0] == 1.0
+
+
+def test_opening_a_store_never_truncates_and_torn_tails_are_overwritten(tmp_path):
+    store = EmbeddingStore(tmp_path, 4)
+    store.put_many([key(1)], [vector(1)])
+    # A crash in the middle of an append: half a vector and no key.
+    with open(tmp_path / "vectors.f32", "ab") as f:
+        f.write(b"\1" * 8)
+    size = os.path.getsize(tmp_path / "vectors.f32")
+
+    reopened = EmbeddingStore(tmp_path, 4)
+    assert os.path.getsize(tmp_path / "vectors.f32") == size
+    assert reopened.n_rows == 1
+
+    reopened.put_many([key(2)], [vector(2)])
+    assert EmbeddingStore(tmp_path, 4).get_many([key(1), key(2)])[:, 0].tolist() == [1.0, 2.0]
+
+
+def test_shared_returns_one_store_per_directory(tmp_path):
+    assert EmbeddingStore.shared(tmp_path, 4) is EmbeddingStore.shared(tmp_path / "sub" / "..", 4)
+
+
+def test_cached_embeddings_only_embed_unseen_texts(tmp_path):
+    model = CountingEmbeddings()
+    embeddings = CachedEmbeddings(model, "fake", 4, cache_dir=tmp_path)
+
+    assert embeddings.embed_documents(["a", "bb", "a"]) == [vector(1), vector(2), vector(1)]
+    assert embeddings.embed_query("bb") == vector(2)
+    assert embeddings.embed_documents(["ccc"]) == [vector(3)]
+    assert model.embedded == ["a", "bb", "ccc"]
+    assert (embeddings.hits, embeddings.misses) == (2, 3)
@@ -0,0 +1,57 @@
+import threading
+from typing import List
+from langchain_core.documents import Document
+from vector_database.federated_retrieval import FederatedRetriever
+
+
+class FakeRetriever:
+    def __init__(self, documents: List[Document], release: threading.Event = None) -> None:
+        self.documents = documents
+        self.release = release
+        self.calls = 0
+
+    def retrieve(self, query: str) -> List[Document]:
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(timeout=5)
+        return self.documents
+
+
+def doc(text: str, score: float, **metadata) -> Document:
+    return Document(page_content=text, metadata={"source": "doc.pdf", "score": score, **metadata})
+
+
+def test_same_chunk_from_contextual_and_plain_indexes_is_fused_once():
+    plain = FakeRetriever([doc("HyDE writes a hypothetical answer.", 0.9), doc("BM25 ranks by terms.", 0.5)])
+    contextual = FakeRetriever([doc("HyDE writes a hypothetical answer.\nThis chunk is from the HyDE paper.", 0.8)])
+    federated = FederatedRetriever({"plain": plain, "contextual": contextual})
+
+    fused = federated.retrieve("what is hyde")
+    assert len(fused) == 2
+    assert fused[0].metadata["backends"] == ["plain", "contextual"]
+
+
+def test_chunks_with_offsets_are_matched_by_source_and_start_index():
+    first = FakeRetriever([doc("chunk text", 0.9, start_index=120, end_index=130)])
+    second = FakeRetriever([doc("chunk text\ncontext", 0.7, start_index=120.0, end_index=130.0),
+                            doc("chunk text", 0.6, start_index=400, end_index=410)])
+    fused = FederatedRetriever({"first": first, "second": second}).retrieve("query")
+
+    assert [d.metadata["start_index"] for d in fused] == [120, 400]
+    assert fused[0].metadata["backends"] == ["first", "second"]
+
+
+def test_slow_backend_does_not_delay_nor_block_the_others():
+    release = threading.Event()
+    slow = FakeRetriever([doc("slow chunk", 1.0)], release=release)
+    fast = FakeRetriever([doc("fast chunk", 1.0)])
+    federated = FederatedRetriever({"slow": slow, "fast": fast}, deadline=0.2)
+
+    try:
+        for _ in range(3):
+            assert [d.page_content for d in federated.retrieve("query")] == ["fast chunk"]
+        # The slow backend is not queried again while its first call is pending.
+        assert (slow.calls, fast.calls) == (1, 3)
+        assert (federated.late["slow"], federated.skipped["slow"]) == (1, 2)
+    finally:
+        release.set()
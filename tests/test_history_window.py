@@ -0,0 +1,72 @@
+from langchain_core.messages import AIMessage, HumanMessage
+from chatbot.context.history_window import HistoryWindow
+
+
+class WordEncoding:
+    # Offline stand-in for tiktoken: one token per word.
+    @staticmethod
+    def encode_ordinary(text: str):
+        return text.split()
+
+    @staticmethod
+    def decode(tokens):
+        return " ".join(tokens)
+
+
+class FakeSummarizer:
+    def __init__(self) -> None:
+        self.prompts = []
+
+    def invoke(self, prompt: str, config: dict = None) -> AIMessage:
+        self.prompts.append(prompt)
+        return AIMessage(content=f"summary {len(self.prompts)}")
+
+
+def history_window(max_turns: int = 2, max_tokens: int = 10000):
+    summarizer = FakeSummarizer()
+    window = HistoryWindow(summarizer=summarizer, max_turns=max_turns, max_tokens=max_tokens)
+    window.encoding = WordEncoding()
+    return window, summarizer
+
+
+def conversation(n_turns: int):
+    messages = []
+    for i in range(n_turns):
+        messages.append(HumanMessage(content=f"question {i}"))
+        messages.append(AIMessage(content=f"thinking {i}", additional_kwargs={"thinking": True}))
+        messages.append(AIMessage(content=f"answer {i}"))
+    return messages[:-2]
+
+
+def test_summarizer_runs_every_max_turns_turns_not_every_turn():
+    window, summarizer = history_window(max_turns=2)
+    summary, summarized, sizes = "", 0, []
+    for n_turns in range(1, 12):
+        messages, summary, summarized = window.window(conversation(n_turns), summary, summarized)
+        sizes.append(sum(isinstance(message, HumanMessage) for message in messages))
+        # Assistant answers are added after the window, as in the graph.
+        assert messages[-1].content == f"question {n_turns - 1}"
+
+    assert sizes == [1, 2, 3, 4, 2, 3, 4, 2, 3, 4, 2]
+    assert len(summarizer.prompts) == 3
+    assert summary == "summary 3"
+
+
+def test_thinking_is_never_replayed_nor_summarized():
+    window, summarizer = history_window(max_turns=1)
+    messages, _, _ = window.window(conversation(4))
+
+    assert not any("thinking" in message.content for message in messages)
+    assert not any("thinking" in prompt for prompt in summarizer.prompts)
+
+
+def test_window_is_folded_and_truncated_under_token_pressure():
+    window, summarizer = history_window(max_turns=4, max_tokens=12)
+    messages = conversation(2)
+    messages[-1] = HumanMessage(content=" ".join(["long"] * 20))
+
+    window_messages, summary, summarized = window.window(messages, reserved_tokens=2)
+    assert len(summarizer.prompts) == 1
+    assert summarized == 2
+    assert len(window_messages) == 1
+    assert len(window_messages[0].content.split()) == 12 - 2 - len(summary.split())
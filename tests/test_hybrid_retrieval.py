@@ -0,0 +1,144 @@
+import re
+import zlib
+from typing import List
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from pinecone_text.sparse.bm25_tokenizer import BM25Tokenizer
+from preprocessment.embedding.embedding_config import MODELS_VECTOR_DIMENSION
+import vector_database.pinecone_utils as pinecone_utils_module
+import vector_database.hybrid_retrieval as hybrid_retrieval_module
+from vector_database.pinecone_utils import PineconeUtils
+from vector_database.hybrid_retrieval import HybridSearchRetriever
+
+DIMENSION = 16
+MODEL = "text-embedding-3-large"
+
+
+class WordEmbeddings(Embeddings):
+    """
+    Offline embeddings: hashed bag of words, so texts sharing words are close.
+    """
+    def __init__(self) -> None:
+        self.embedded = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.embedded.extend(texts)
+        vectors = []
+        for text in texts:
+            vector = [0.0] * DIMENSION
+            for word in re.findall(r"\w+", text.lower()):
+                vector[zlib.crc32(word.encode()) % DIMENSION] += 1.0
+            vectors.append(vector)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class FakeEmbeddingConfig:
+    def __init__(self, embedding_model: str, provider: str = "openai") -> None:
+        self.embedding_model_name = embedding_model
+        self.model = WordEmbeddings()
+
+    def get_embedding_model(self) -> WordEmbeddings:
+        return self.model
+
+
+@pytest.fixture(autouse=True)
+def local_backend(monkeypatch, tmp_path):
+    # Local indexes under tmp_path, offline embeddings and BM25 tokenizer (no API keys nor nltk data).
+    monkeypatch.setattr(pinecone_utils_module, "LOCAL_INDEXES_DIR", tmp_path)
+    monkeypatch.setattr(pinecone_utils_module, "EmbeddingConfig", FakeEmbeddingConfig)
+    monkeypatch.setattr(hybrid_retrieval_module, "EmbeddingConfig", FakeEmbeddingConfig)
+    monkeypatch.setitem(MODELS_VECTOR_DIMENSION, MODEL, DIMENSION)
+    monkeypatch.setattr(BM25Tokenizer, "__init__", lambda self, **params: self.__dict__.update(params))
+    monkeypatch.setattr(BM25Tokenizer, "__call__", lambda self, text: re.findall(r"\w+", text.lower()))
+
+
+def utils(**options) -> PineconeUtils:
+    return PineconeUtils(index_name="test", embedding_model_name=MODEL, embedding_provider="openai",
+                         metric="dotproduct", backend="local", **options)
+
+
+def retriever(**options) -> HybridSearchRetriever:
+    return HybridSearchRetriever(index_name="test", embedding_model_name=MODEL, embedding_provider="openai",
+                                 top_k=2, backend="local", **options)
+
+
+def ingest(pinecone_utils: PineconeUtils, texts: dict, delete: List[str] = ()) -> None:
+    """
+    What an Ingestion run does to the index: upsert, delete, save the BM25 stats, flush and bump the version.
+    """
+    if texts:
+        docs = [Document(page_content=text, metadata={"source": f"{_id}.pdf"}) for _id, text in texts.items()]
+        ids = list(texts)
+        pinecone_utils.upsert_records(pinecone_utils.to_records(docs, ids, pinecone_utils.encode_sparse(docs, ids)))
+    if delete:
+        pinecone_utils.delete_documents(list(delete))
+    pinecone_utils.save_sparse_index()
+    pinecone_utils.flush_index()
+    pinecone_utils.bump_index_version()
+
+
+def test_quantization_options_reach_the_local_index():
+    local_retriever = retriever(quantization="int8", search_dimension=8, rescore_factor=10)
+    compact = local_retriever.index.compact
+
+    assert (compact.quantization, compact.search_dimension) == ("int8", 8)
+    assert local_retriever.index.rescore_factor == 10
+    assert utils(quantization="binary").index.compact.quantization == "binary"
+
+
+def test_retriever_sees_what_another_process_ingested():
+    ingest(utils(), {"hyde": "HyDE embeds a hypothetical answer document",
+                     "bm25": "BM25 scores sparse term frequencies"})
+    local_retriever = retriever()
+    assert "hyde.pdf" in [doc.metadata["source"] for doc in local_retriever.retrieve("hypothetical answer document")]
+
+    # Another PineconeUtils (another ingestion process) replaces the HyDE chunk.
+    ingest(utils(), {"rerank": "Rerankers rescore hypothetical answer candidates"}, delete=["hyde"])
+
+    sources = [doc.metadata["source"] for doc in local_retriever.retrieve("hypothetical answer document")]
+    assert "hyde.pdf" not in sources and "rerank.pdf" in sources
+    assert local_retriever.sparse_encoder.n_docs == 2
+
+
+def test_results_are_cached_per_normalized_query_until_the_version_changes():
+    ingest(utils(), {"hyde": "HyDE embeds a hypothetical answer document"})
+    local_retriever = retriever()
+
+    first = local_retriever.retrieve("Hypothetical  answer?")
+    first[0].metadata["source"] = "changed by the caller"
+    second = local_retriever.retrieve("hypothetical answer")
+    assert second[0].metadata["source"] == "hyde.pdf"
+    assert local_retriever.embeddings.embedded == ["Hypothetical  answer?"]
+    assert local_retriever.cache_stats()["results"]["hits"] == 1
+
+    ingest(utils(), {"bm25": "BM25 scores sparse term frequencies of an answer"})
+    local_retriever.retrieve("hypothetical answer")
+    # A new version is searched again, with the dense embedding still taken from the encoding cache.
+    assert local_retriever.cache_stats()["results"]["hits"] == 1
+    assert local_retriever.embeddings.embedded == ["Hypothetical  answer?"]
+
+
+def test_batched_retrieval_matches_per_query_retrieval():
+    ingest(utils(), {"hyde": "HyDE embeds a hypothetical answer document",
+                     "bm25": "BM25 scores sparse term frequencies",
+                     "rerank": "Rerankers rescore the retrieved candidates",
+                     "hybrid": "Hybrid search fuses dense and sparse scores"})
+    queries = ["hypothetical answer", "sparse term frequencies", "Hypothetical answer?", "rescore candidates"]
+
+    expected = [[(doc.page_content, doc.metadata["score"]) for doc in retriever().retrieve(query)]
+                for query in queries]
+    batch_retriever = retriever()
+    results = batch_retriever.retrieve_many(queries)
+
+    assert [[(doc.page_content, pytest.approx(doc.metadata["score"])) for doc in documents]
+            for documents in results] == expected
+    # Each distinct normalized query is embedded once, in a single batch.
+    assert batch_retriever.embeddings.embedded == ["hypothetical answer", "sparse term frequencies",
+                                                   "rescore candidates"]
+    assert batch_retriever.retrieve_many(queries[:2]) == results[:2]
+    assert batch_retriever.embeddings.embedded == ["hypothetical answer", "sparse term frequencies",
+                                                   "rescore candidates"]
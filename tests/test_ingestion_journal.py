@@ -0,0 +1,27 @@
+from vector_database.ingestion_journal import IngestionJournal
+
+
+def test_resumed_run_finds_the_work_already_done(tmp_path):
+    journal = IngestionJournal(tmp_path / "journal.sqlite", run_key="contextual-embedding")
+    journal.mark_embedded(["a", "b"], ["text a + context", "text b + context"])
+    journal.mark_upserted(["a"])
+    journal.connection.close()
+
+    resumed = IngestionJournal(tmp_path / "journal.sqlite", run_key="contextual-embedding")
+    assert resumed.texts(["a", "b", "c"]) == {"a": "text a + context", "b": "text b + context"}
+    assert resumed.texts(["a", "b", "c"], upserted=True) == {"a": "text a + context"}
+
+    resumed.clear()
+    assert len(resumed) == 0
+
+
+def test_journal_of_other_settings_is_discarded(tmp_path):
+    IngestionJournal(tmp_path / "journal.sqlite", run_key="None").record_texts(["a"], ["plain text"])
+    assert len(IngestionJournal(tmp_path / "journal.sqlite", run_key="contextual-embedding")) == 0
+
+
+def test_more_ids_than_sqlite_parameters(tmp_path):
+    journal = IngestionJournal(tmp_path / "journal.sqlite")
+    ids = [str(i) for i in range(1200)]
+    journal.record_texts(ids, ids)
+    assert len(journal.texts(ids)) == 1200
@@ -0,0 +1,42 @@
+from vector_database.feeding_vector_db import Ingestion
+from vector_database.ingestion_manifest import IngestionManifest
+
+
+def test_diff_finds_changed_and_removed_files(tmp_path):
+    manifest = IngestionManifest(tmp_path / "manifest.json")
+    manifest.update("a.pdf", "hash-a", ["a-0", "a-1"])
+    manifest.update("b.pdf", "hash-b", ["b-0"])
+    manifest.save()
+
+    manifest = IngestionManifest(tmp_path / "manifest.json")
+    changed, removed = manifest.diff({"a.pdf": "hash-a", "c.pdf": "hash-c"})
+    assert (changed, removed) == (["c.pdf"], ["b.pdf"])
+    assert manifest.chunk_ids(["a.pdf", "b.pdf"]) == ["a-0", "a-1", "b-0"]
+
+
+def test_changed_settings_mark_every_file_changed(tmp_path):
+    settings = {"chunk_size": 512, "chunk_overlap": 50, "span_chunking": False, "preprocessing_technique": "None"}
+    manifest = IngestionManifest(tmp_path / "manifest.json", settings=settings)
+    manifest.update("a.pdf", "hash-a", ["a-0"])
+    manifest.save()
+
+    same = IngestionManifest(tmp_path / "manifest.json", settings=dict(settings))
+    assert same.diff({"a.pdf": "hash-a"}) == ([], [])
+    for change in [{"chunk_size": 256}, {"chunk_overlap": 0}, {"span_chunking": True},
+                   {"preprocessing_technique": "contextual-embedding"}]:
+        other = IngestionManifest(tmp_path / "manifest.json", settings={**settings, **change})
+        assert other.diff({"a.pdf": "hash-a"}) == (["a.pdf"], [])
+
+
+def test_orphan_sources_are_removed_after_the_manifest_update(tmp_path):
+    ingestion = Ingestion.__new__(Ingestion)
+    ingestion.manifest = IngestionManifest(tmp_path / "manifest.json")
+    ingestion.manifest.update("kept.pdf", "hash-kept", ["k-0"])
+    ingestion.chunk_ids_per_file = {"orphan.pdf": ["o-0"], "changed.pdf": ["c-0"]}
+
+    # orphan.pdf changed in this run but one of its duplicates lost its kept chunk: it must be ingested again.
+    ingestion.update_manifest(["orphan.pdf", "changed.pdf"], [], {"orphan.pdf": "hash-o", "changed.pdf": "hash-c"},
+                              orphan_sources=["orphan.pdf"])
+
+    files = IngestionManifest(tmp_path / "manifest.json").files
+    assert sorted(files) == ["changed.pdf", "kept.pdf"]
@@ -0,0 +1,79 @@
+import time
+import threading
+import pytest
+from vector_database.ingestion_pipeline import Stage, StreamingPipeline
+
+
+def test_every_item_goes_through_every_stage_in_order_with_one_worker():
+    pipeline = StreamingPipeline([
+        Stage("double", lambda batch: [x * 2 for x in batch], batch_size=3),
+        Stage("split", lambda batch: [y for x in batch for y in (x, x + 1)])
+    ], queue_size=2)
+
+    assert list(pipeline.run(range(10))) == [y for x in range(10) for y in (2 * x, 2 * x + 1)]
+    assert [(s["items_in"], s["items_out"]) for s in map(Stage.stats, pipeline.stages)] == [(10, 10), (10, 20)]
+
+
+def test_several_workers_process_every_item_once():
+    pipeline = StreamingPipeline([Stage("square", lambda batch: [x * x for x in batch], workers=4, batch_size=5)])
+
+    assert sorted(pipeline.run(range(100))) == [x * x for x in range(100)]
+
+
+def test_a_slow_stage_bounds_what_is_read_ahead():
+    fed = []
+    release = threading.Event()
+
+    def items():
+        for i in range(100):
+            fed.append(i)
+            yield i
+
+    def slow(batch):
+        release.wait()
+        return batch
+
+    pipeline = StreamingPipeline([Stage("fast", lambda batch: batch), Stage("slow", slow)], queue_size=2)
+    outputs = []
+    consumer = threading.Thread(target=lambda: outputs.extend(pipeline.run(items())))
+    consumer.start()
+    time.sleep(0.2)
+
+    # The feeder blocks once the queues in front of the blocked stage are full: 2 items per queue, plus the one
+    # held by each stage and the one the feeder is putting.
+    assert len(fed) <= 2 * 2 + 3
+    release.set()
+    consumer.join(timeout=5)
+    assert outputs == list(range(100))
+
+
+def test_a_failing_stage_stops_the_pipeline_and_raises():
+    processed = []
+    threads_before = set(threading.enumerate())
+
+    def fail_on_seven(batch):
+        if 7 in batch:
+            raise RuntimeError("stage failed on 7")
+        return batch
+
+    pipeline = StreamingPipeline([
+        Stage("check", fail_on_seven, workers=2),
+        Stage("record", lambda batch: processed.extend(batch) or batch)
+    ], queue_size=2)
+
+    with pytest.raises(RuntimeError, match="stage failed on 7"):
+        list(pipeline.run(range(1000)))
+
+    # Remaining items are drained without being processed and every thread stopped.
+    assert 7 not in processed and len(processed) < 1000
+    assert set(threading.enumerate()) <= threads_before
+
+
+def test_an_error_while_feeding_is_raised():
+    def items():
+        yield 1
+        raise ValueError("bad input")
+
+    pipeline = StreamingPipeline([Stage("identity", lambda batch: batch)])
+    with pytest.raises(ValueError, match="bad input"):
+        list(pipeline.run(items()))
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from vector_database.local_index import LocalIndex
+
+DIMENSION = 16
+
+
+def records(n: int, seed: int = 0, prefix: str = "chunk", dimension: int = DIMENSION):
+    rng = np.random.default_rng(seed)
+    return [{"id": f"{prefix}-{i}", "values": rng.normal(size=dimension).tolist(),
+             "metadata": {"text": f"text {i}", "source": f"{i % 3}.pdf"}} for i in range(n)]
+
+
+def test_writes_survive_reopening_before_and_after_flush(tmp_path):
+    index = LocalIndex(tmp_path, DIMENSION, metric="cosine")
+    for record in records(50):
+        index.upsert([record])
+    index.delete(ids=["chunk-3"])
+    index.upsert([{"id": "chunk-4", "values": [1.0] * DIMENSION, "metadata": {"text": "updated"}}])
+
+    for reopened in [LocalIndex(tmp_path, DIMENSION, metric="cosine"), index]:
+        assert reopened.describe_index_stats()["total_vector_count"] == 49
+        match = reopened.query(id="chunk-4", top_k=1, include_metadata=True)["matches"][0]
+        assert (match["id"], match["metadata"]["text"]) == ("chunk-4", "updated")
+        assert match["score"] == pytest.approx(1.0, abs=1e-5)
+
+    index.close()
+    assert (tmp_path / "records.log").stat().st_size == 0
+    assert sorted(LocalIndex(tmp_path, DIMENSION).fetch(["chunk-3", "chunk-4"])["vectors"]) == ["chunk-4"]
+
+
+def test_torn_log_line_is_ignored(tmp_path):
+    index = LocalIndex(tmp_path, DIMENSION)
+    index.upsert(records(5))
+    with open(tmp_path / "records.log", "a") as f:
+        f.write('{"op": "upsert", "records": [["chunk-9"')
+
+    assert sorted(LocalIndex(tmp_path, DIMENSION).id_to_row) == [f"chunk-{i}" for i in range(5)]
+
+
+def test_unknown_query_id_raises_a_clear_error(tmp_path):
+    with pytest.raises(ValueError, match="not in the local index"):
+        LocalIndex(tmp_path, DIMENSION).query(id="missing")
+
+
+def test_query_matches_a_brute_force_search_and_filters(tmp_path):
+    index = LocalIndex(tmp_path, DIMENSION, metric="dotproduct")
+    data = records(200)
+    index.upsert(data)
+    vectors = np.array([record["values"] for record in data], dtype=np.float32)
+    query = vectors[7] + 0.1
+
+    top = [match["id"] for match in index.query(vector=query.tolist(), top_k=5)["matches"]]
+    assert top == [f"chunk-{i}" for i in np.argsort(-(vectors @ query))[:5]]
+
+    filtered = index.query(vector=query.tolist(), top_k=5, filter={"source": "1.pdf"}, include_metadata=True)
+    assert {match["metadata"]["source"] for match in filtered["matches"]} == {"1.pdf"}
+
+
+def test_ivf_probe_keeps_recall(tmp_path):
+    # Clustered vectors, like embeddings: on structureless random ones a partial probe cannot do well.
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(32, 128))
+    vectors = centers[rng.integers(32, size=2000)] + 0.5 * rng.normal(size=(2000, 128))
+    queries = centers[rng.integers(32, size=20)] + 0.5 * rng.normal(size=(20, 128))
+
+    index = LocalIndex(tmp_path, 128, metric="cosine", ann="ivf", n_lists=16, n_probe=4)
+    index.upsert([{"id": f"chunk-{i}", "values": vector.tolist()} for i, vector in enumerate(vectors)])
+
+    # A quarter of the lists is scored, so this is an approximate search, not an exact one in disguise.
+    assert index.ann.is_trained and index.ann.n_probe < index.ann.n_lists
+    assert index.evaluate_recall(queries, top_k=10)["recall@10"] >= 0.9
+
+
+def test_overwritten_rows_are_reassigned_after_reopening_without_flush(tmp_path):
+    index = LocalIndex(tmp_path, DIMENSION, metric="cosine", ann="ivf", n_lists=16, n_probe=1)
+    index.upsert(records(1500))
+    index.flush()
+
+    # Overwrite rows after the last ann persist: only the log knows about them.
+    moved = [{**record, "id": f"chunk-{i}"} for i, record in enumerate(records(100, seed=7))]
+    index.upsert(moved)
+    reopened = LocalIndex(tmp_path, DIMENSION, metric="cosine", ann="ivf", n_lists=16, n_probe=1)
+
+    # With a single probed list, a vector is only found if it sits in the list of its closest centroid.
+    for record in moved:
+        assert reopened.query(vector=record["values"], top_k=1)["matches"][0]["id"] == record["id"]
+
+
+@pytest.mark.parametrize("options", [{"quantization": "int8"}, {"quantization": "binary", "rescore_factor": 50},
+                                     {"search_dimension": 96, "rescore_factor": 10}])
+def test_compact_search_keeps_recall(tmp_path, options):
+    # Binary codes need enough bits (and candidates, on unstructured random vectors) to rank well.
+    index = LocalIndex(tmp_path, 128, metric="cosine", **options)
+    index.upsert(records(2000, dimension=128))
+    queries = np.random.default_rng(1).normal(size=(20, 128))
+
+    assert index.evaluate_recall(queries, top_k=10)["recall@10"] >= 0.9
@@ -0,0 +1,46 @@
+import random
+from vector_database.near_duplicates import NearDuplicateIndex
+
+WORDS = ["retrieval", "dense", "sparse", "vector", "index", "query", "chunk", "model", "embedding", "score",
+         "document", "passage", "ranking", "token", "context", "answer", "graph", "cache", "batch", "latency"]
+
+
+def text(seed: int, n_words: int = 80) -> str:
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def edited(original: str) -> str:
+    # One word changed: 4 of the 77 word 4-grams differ, a Jaccard similarity of 73 / 81 ~ 0.9.
+    words = original.split()
+    words[40] = "changed"
+    return " ".join(words)
+
+
+def test_threshold_decides_what_is_a_duplicate(tmp_path):
+    for threshold, kept in [(0.7, [True, False, True]), (0.98, [True, True, True])]:
+        index = NearDuplicateIndex(tmp_path / str(threshold), threshold=threshold)
+        keep = index.deduplicate([text(0), edited(text(0)), text(1)], ids=["a", "b", "c"],
+                                 sources=["a.pdf", "b.pdf", "c.pdf"])
+
+        assert keep == kept
+        if not kept[1]:
+            assert index.duplicates["b"]["duplicate_of"] == "a"
+            assert 0.7 <= index.duplicates["b"]["similarity"] < 1.0
+
+
+def test_signatures_and_duplicates_persist_across_runs(tmp_path):
+    index = NearDuplicateIndex(tmp_path, threshold=0.7)
+    assert index.deduplicate([text(0), edited(text(0))], ids=["a", "b"], sources=["a.pdf", "b.pdf"]) == [True, False]
+    index.save()
+
+    reopened = NearDuplicateIndex(tmp_path, threshold=0.7)
+    assert reopened.duplicates["b"]["duplicate_of"] == "a"
+    # A chunk already indexed under its id is kept, a new near copy of it is still caught.
+    assert reopened.deduplicate([text(0), edited(text(0))], ids=["a", "d"], sources=["a.pdf", "d.pdf"]) == [True, False]
+
+    # Chunks of files being re-ingested match nothing, and deleting them orphans their duplicates.
+    reopened.exclude(["a"])
+    assert reopened.deduplicate([edited(text(0))], ids=["e"], sources=["e.pdf"]) == [True]
+    reopened.remove(["a"])
+    assert sorted(reopened.orphans()) == ["b", "d"]
@@ -0,0 +1,51 @@
+from preprocessment.parsing.parse_cache import ParseCache, ParsedDocument
+from preprocessment.parsing.parallel_loader import ParallelDocumentLoader
+
+
+def test_a_missing_file_fails_alone(tmp_path):
+    cache = ParseCache(tmp_path / "cache")
+    present = tmp_path / "present.pdf"
+    present.write_bytes(b"%PDF present")
+    cache.put(present, ParsedDocument(str(present), "present text", [0, 12]))
+
+    loader = ParallelDocumentLoader(parse_cache=cache)
+    documents = loader.load([tmp_path / "missing.pdf", present])
+
+    assert [doc.page_content for doc in documents] == ["present text"]
+    assert [(s["status"], s["error"] is not None) for s in loader.stats] == [("error", True), ("cached", False)]
+    assert "FileNotFoundError" in loader.stats[0]["error"]
+
+
+def test_parsed_files_are_cached_until_their_content_changes(tmp_path):
+    cache = ParseCache(tmp_path / "cache")
+    source = tmp_path / "a.pdf"
+    source.write_bytes(b"%PDF first version")
+    cache.put(source, ParsedDocument(str(source), "first text", [0, 10]))
+
+    # Same content under another path is the same entry.
+    copy = tmp_path / "copy.pdf"
+    copy.write_bytes(source.read_bytes())
+    assert cache.get(source).text == cache.get(copy).text == "first text"
+    assert (cache.hits, cache.misses) == (2, 0)
+
+    source.write_bytes(b"%PDF second version, longer")
+    assert cache.get(source) is None
+    assert ParseCache(tmp_path / "cache").get(copy).page_offsets == [0, 10]
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_a_file_the_parser_rejects_fails_alone(tmp_path):
+    cache = ParseCache(tmp_path / "cache")
+    cached = tmp_path / "cached.pdf"
+    cached.write_bytes(b"%PDF cached")
+    cache.put(cached, ParsedDocument(str(cached), "cached text", [0, 11]))
+    broken = tmp_path / "broken.bin"
+    broken.write_bytes(bytes(range(256)))
+
+    loader = ParallelDocumentLoader(n_workers=1, timeout=60, parse_cache=cache)
+    documents = loader.load([broken, cached])
+
+    assert [doc.page_content for doc in documents] == ["cached text"]
+    statuses = {s["file"]: s["status"] for s in loader.stats}
+    assert statuses == {str(broken): "error", str(cached): "cached"}
+    assert "1 failed" in loader.report()
@@ -0,0 +1,27 @@
+import time
+from vector_database.query_cache import TTLCache, normalize_query
+
+
+def test_queries_differing_in_case_spaces_and_punctuation_share_a_key():
+    assert normalize_query("  How HyDE\n works? ") == normalize_query("how hyde works") == "how hyde works"
+    assert normalize_query("how hyde works") != normalize_query("how bm25 works")
+
+
+def test_entries_expire_after_ttl():
+    cache = TTLCache(ttl=0.05)
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+
+    time.sleep(0.06)
+    assert cache.get("key") is None
+    assert len(cache) == 0 and cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(max_size=2, ttl=None)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
@@ -0,0 +1,38 @@
+import pytest
+from chatbot.routing.query_router import QueryRouter
+
+
+@pytest.mark.parametrize("message,decision", [
+    ("thanks!", "none"),
+    ("ok.", "none"),
+    ("???", "none"),
+    ("shorter", "reuse"),
+    ("why?", "reuse"),
+    ("how so", "reuse"),
+    ("give me an example", "reuse"),
+    ("translate it to portuguese", "reuse"),
+    ("can you rewrite it in a table", "reuse"),
+    ("what do you mean by that", "reuse"),
+    ("what is hyde", "retrieve"),
+    ("longer context windows vs rag", "retrieve"),
+    ("summarize the hyde paper", "retrieve"),
+    ("shortcut to build a rag pipeline", "retrieve"),
+    ("is this better than RAG-Fusion?", "retrieve"),
+])
+def test_decide(message, decision):
+    assert QueryRouter().decide(message, has_context=True)[0] == decision
+
+
+def test_follow_up_without_previous_context_retrieves():
+    assert QueryRouter().decide("make it shorter", has_context=False) == ("retrieve", "follow-up without previous context")
+
+
+def test_skipped_retrievals_are_counted_with_the_average_latency():
+    router = QueryRouter()
+    router.record_retrieval(1.0)
+    router.record_retrieval(0.5)
+    router.record_decision("reuse", "follow-up")
+    router.record_decision("retrieve", "new question")
+
+    assert router.decisions == {"retrieve": 1, "reuse": 1, "none": 0}
+    assert router.seconds_saved == pytest.approx(0.9)
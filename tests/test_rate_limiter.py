@@ -0,0 +1,88 @@
+import time
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+from langchain_core.documents import Document
+from llm_config.rate_limiter import RateLimiter
+from preprocessment.documents_preprocessment import Preprocesser
+
+
+def test_acquire_waits_for_the_bucket_to_refill():
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=100000)
+    for _ in range(600):
+        limiter.acquire(1)
+
+    start = time.monotonic()
+    limiter.acquire(1)
+    # One request every 0.1s once the bucket is empty.
+    assert 0.05 < time.monotonic() - start < 0.5
+
+
+def test_settle_charges_the_real_token_count():
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=6000)
+    limiter.acquire(100)
+    limiter.settle(100, 6100)
+
+    # 6000 tokens more than estimated leave the bucket 100 tokens in debt, a second of refill at 100 tokens/s.
+    assert limiter.tokens.level < 0
+    assert 0.9 < limiter.tokens.wait_time(1) < 1.1
+
+
+def test_headers_set_the_limits_and_the_remaining_quota():
+    limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=100000)
+    limiter.update_from_headers({
+        "anthropic-ratelimit-requests-limit": "50",
+        "anthropic-ratelimit-requests-remaining": "10",
+        "anthropic-ratelimit-input-tokens-limit": "40000",
+        "anthropic-ratelimit-input-tokens-remaining": "0",
+        "anthropic-ratelimit-input-tokens-reset": (datetime.now(timezone.utc) + timedelta(seconds=30)).isoformat()
+    })
+
+    assert (limiter.requests.capacity, limiter.tokens.capacity) == (50, 40000)
+    assert limiter.requests.level <= 10
+    assert 25 < limiter.paused_until - time.monotonic() <= 30
+
+
+def test_retry_after_pauses_every_caller():
+    limiter = RateLimiter()
+    limiter.update_from_headers({"retry-after": "0.3"})
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=limiter.acquire, args=(1,)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - start >= 0.25
+
+
+class FakeMessages:
+    def __init__(self, headers: dict) -> None:
+        self.headers = headers
+        self.with_raw_response = self
+
+    def create(self, **kwargs):
+        message = SimpleNamespace(
+            content=[SimpleNamespace(type="text", text="situated")],
+            usage=SimpleNamespace(input_tokens=40, cache_read_input_tokens=1000, cache_creation_input_tokens=0,
+                                  output_tokens=5)
+        )
+        return SimpleNamespace(headers=self.headers, parse=lambda: message)
+
+
+def test_successful_responses_feed_the_limiter():
+    preprocesser = Preprocesser.__new__(Preprocesser)
+    preprocesser.client = SimpleNamespace(messages=FakeMessages({"anthropic-ratelimit-requests-limit": "7",
+                                                                 "anthropic-ratelimit-requests-remaining": "3"}))
+    preprocesser.model_name = "model"
+    preprocesser.rate_limiter = RateLimiter(requests_per_minute=1000)
+    preprocesser.max_retries = 0
+    preprocesser.lock = threading.Lock()
+    preprocesser.usage = {"requests": 0, "retries": 0, "cache_read_tokens": 0, "cache_write_tokens": 0,
+                          "uncached_input_tokens": 0, "output_tokens": 0}
+
+    context = preprocesser.situate_chunk("document", Document(page_content="chunk"))
+
+    assert context == "situated"
+    assert preprocesser.rate_limiter.requests.capacity == 7 and preprocesser.rate_limiter.requests.level <= 3
+    assert (preprocesser.usage["cache_read_tokens"], preprocesser.usage["uncached_input_tokens"]) == (1000, 40)
@@ -0,0 +1,54 @@
+import random
+import pytest
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from preprocessment.chunking.span_chunking import SpanChunker
+from preprocessment.chunking.content_aware_chunking import ContentAwareChunking
+from vector_database.feeding_vector_db import Ingestion
+
+WORDS = ["retrieval", "augmented", "generation", "hyde", "bm25", "rag", "a", "x" * 40]
+SEPARATORS = [" "] * 10 + ["\n"] * 2 + ["\n\n", "  ", "\n\n\n", " \n"]
+
+
+def random_text(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 200)):
+        parts.extend([rng.choice(WORDS), rng.choice(SEPARATORS)])
+    if rng.random() < 0.2:
+        # A run longer than chunk_size with no separator, split character by character.
+        parts.append("z" * 700)
+    return "".join(parts)
+
+
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(512, 80), (100, 20), (50, 0), (1000, 200)])
+def test_spans_are_the_chunks_of_recursive_character_text_splitter(chunk_size, chunk_overlap):
+    rng = random.Random(chunk_size)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    chunker = SpanChunker(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    for _ in range(100):
+        text = random_text(rng)
+        spans = chunker.split_document(Document(page_content=text, metadata={"source": "doc.txt"}))
+        assert [span.page_content for span in spans] == splitter.split_text(text)
+        assert all(text[span.start:span.end] == span.page_content for span in spans)
+
+
+def test_span_keeps_its_offsets_when_context_is_appended():
+    text = "first paragraph\n\nsecond paragraph"
+    span = SpanChunker(chunk_size=20, chunk_overlap=0).split_document(Document(page_content=text, metadata={}))[1]
+    span.page_content += "\ncontext"
+
+    assert span.metadata["start_index"] == text.index("second")
+    assert span.page_content == "second paragraph\ncontext"
+    with pytest.raises(ValueError):
+        span.page_content = "changed"
+
+
+def test_ingestion_length_unit_reaches_the_span_chunker():
+    Ingestion.check_length_unit("tokens", span_chunking=True)
+    with pytest.raises(ValueError):
+        Ingestion.check_length_unit("tokens", span_chunking=False)
+    with pytest.raises(ValueError):
+        Ingestion.check_length_unit("words", span_chunking=True)
+
+    assert ContentAwareChunking().get_span_chunker("tokens").length_unit == "tokens"
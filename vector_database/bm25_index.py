@@ -0,0 +1,499 @@
+import os
+import json
+import mmh3
+import threading
+import multiprocessing
+import numpy as np
+from pathlib import Path
+from collections import Counter
+from typing import List, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.documents import Document
+from pinecone_text.sparse.bm25_tokenizer import BM25Tokenizer
+
+ROOT_DIR = Path(__file__).parent.parent
+SPARSE_INDEXES_DIR = ROOT_DIR / "vector_database" / "sparse_indexes"
+
+MAGIC = b"BM25IDX\x01"
+
+# Per process tokenizer used by count_terms_shard (building it loads the nltk stopwords, so only once per worker).
+worker_tokenizer = None
+
+# Below this many texts per job, tokenizing in the calling process is faster than shipping the texts to the pool.
+MIN_TEXTS_PER_JOB = 256
+
+# Tokenization pool shared by every count_terms call of the process (see get_tokenization_pool).
+tokenization_pool = None
+tokenization_pool_size = 0
+tokenization_pool_lock = threading.Lock()
+
+
+def get_tokenization_pool(n_jobs: int) -> ProcessPoolExecutor:
+    """
+    Process pool created once for the whole ingestion (the workers keep their tokenizer between calls) and
+    recreated only if a different size is asked. Workers are started with forkserver (spawn where it does not
+    exist), never forked from a process that runs threads.
+    """
+    global tokenization_pool, tokenization_pool_size
+    with tokenization_pool_lock:
+        if tokenization_pool is None or tokenization_pool_size != n_jobs:
+            if tokenization_pool is not None:
+                tokenization_pool.shutdown(wait=False)
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            tokenization_pool = ProcessPoolExecutor(max_workers=n_jobs,
+                                                    mp_context=multiprocessing.get_context(start_method))
+            tokenization_pool_size = n_jobs
+        return tokenization_pool
+
+
+def count_terms_shard(texts: List[str], tokenizer_params: dict) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Process pool worker: (term hashes, term frequencies) of each text.
+    """
+    global worker_tokenizer
+    if worker_tokenizer is None:
+        worker_tokenizer = BM25Tokenizer(**tokenizer_params)
+
+    counts = []
+    for text in texts:
+        term_counts = Counter(mmh3.hash(token, signed=False) for token in worker_tokenizer(text))
+        counts.append((
+            np.fromiter(term_counts.keys(), dtype=np.uint32, count=len(term_counts)),
+            np.fromiter(term_counts.values(), dtype=np.int64, count=len(term_counts))
+        ))
+    return counts
+
+
+class PackedStrings:
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray) -> None:
+        """
+        List of strings stored as one utf-8 blob plus offsets, decoded only when accessed (so a memory mapped index
+        does not decode its whole corpus on load). Appended strings are kept aside until pack() folds them into the
+        blob, so appending a batch never copies the blob.
+        """
+        self.blob = blob
+        self.offsets = offsets
+        self.appended: List[str] = []
+
+    @classmethod
+    def from_list(cls, strings: List[str]) -> "PackedStrings":
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.concatenate([[0], np.cumsum([len(e) for e in encoded], dtype=np.int64)]).astype(np.int64)
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def extend(self, strings: List[str]) -> None:
+        self.appended.extend(strings)
+
+    def pack(self) -> None:
+        """
+        Fold the appended strings into the blob (the existing blob is copied as bytes, never decoded).
+        """
+        if not self.appended:
+            return
+        other = PackedStrings.from_list(self.appended)
+        self.blob = np.concatenate([self.blob, other.blob])
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + other.offsets[1:]])
+        self.appended = []
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1 + len(self.appended)
+
+    def __getitem__(self, i: int) -> str:
+        n_packed = len(self.offsets) - 1
+        if i >= n_packed:
+            return self.appended[i - n_packed]
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class BM25Index:
+    def __init__(self,
+                 k1: float = 1.2,
+                 b: float = 0.75,
+                 lower_case: bool = True,
+                 remove_punctuation: bool = True,
+                 remove_stopwords: bool = True,
+                 stem: bool = True,
+                 language: str = "english"
+                 ) -> None:
+        """
+        BM25 sparse retrieval engine. It produces the same sparse vectors as pinecone_text's BM25Encoder (same
+        tokenizer, same murmur3 term hashes, same weighting), so it can be passed as sparse_encoder to
+        PineconeHybridSearchRetriever, and it also keeps an inverted index (CSR postings) to score top-k locally.
+
+        Everything lives in numpy arrays that are written to a single binary file and memory-mapped back on load,
+        so opening an index does not parse anything proportional to its size.
+        """
+        self.k1 = k1
+        self.b = b
+        self.tokenizer_params = {
+            "lower_case": lower_case,
+            "remove_punctuation": remove_punctuation,
+            "remove_stopwords": remove_stopwords,
+            "stem": stem,
+            "language": language
+        }
+        self.tokenizer = BM25Tokenizer(**self.tokenizer_params)
+        self.hash_cache = {}
+
+        self.n_docs = 0
+        self.avgdl = 0.0
+
+        # Vocabulary stats: sorted term hashes and their document frequencies.
+        self.terms = np.zeros(0, dtype=np.uint32)
+        self.doc_freq = np.zeros(0, dtype=np.uint32)
+
+        # Postings of terms[i] are postings_docs/postings_tf[postings_offsets[i]:postings_offsets[i + 1]].
+        self.postings_offsets = np.zeros(1, dtype=np.int64)
+        self.postings_docs = np.zeros(0, dtype=np.uint32)
+        self.postings_tf = np.zeros(0, dtype=np.uint16)
+
+        # (terms, docs, tf) columns of added documents and whether documents were removed since the last merge.
+        self.pending_postings = []
+        self.pending_removals = False
+
+        # Stored documents, metadatas are json strings.
+        self.doc_lengths = np.zeros(0, dtype=np.uint32)
+        self.deleted = np.zeros(0, dtype=np.uint8)
+        self.id_positions = None
+        self.ids = PackedStrings.from_list([])
+        self.texts = PackedStrings.from_list([])
+        self.metadatas = PackedStrings.from_list([])
+
+    # ------------------------------------------------------------------
+    # Tokenization
+    # ------------------------------------------------------------------
+    def term_hashes(self, text: str) -> List[int]:
+        hashes = []
+        for token in self.tokenizer(text):
+            token_hash = self.hash_cache.get(token)
+            if token_hash is None:
+                token_hash = self.hash_cache[token] = mmh3.hash(token, signed=False)
+            hashes.append(token_hash)
+        return hashes
+
+    def lookup_doc_freq(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Document frequency of each hash, 1 for unknown terms (same default as BM25Encoder).
+        """
+        self.merge_pending()
+        if len(self.terms) == 0:
+            return np.ones(len(hashes), dtype=np.float64)
+        positions = np.minimum(np.searchsorted(self.terms, hashes), len(self.terms) - 1)
+        found = self.terms[positions] == hashes
+        return np.where(found, self.doc_freq[positions], 1).astype(np.float64)
+
+    # ------------------------------------------------------------------
+    # Encoding (BM25Encoder compatible)
+    # ------------------------------------------------------------------
+    def encode_queries(self, texts: Union[str, List[str]]) -> Union[dict, List[dict]]:
+        if isinstance(texts, str):
+            return self.encode_queries([texts])[0]
+
+        # Hash every query first, then look all of them up in the vocabulary in a single vectorized pass.
+        queries = [np.array(list(dict.fromkeys(self.term_hashes(text))), dtype=np.uint32) for text in texts]
+        if not queries:
+            return []
+
+        all_hashes = np.concatenate(queries)
+        idf = np.log((self.n_docs + 1) / (self.lookup_doc_freq(all_hashes) + 0.5))
+
+        encoded = []
+        for query_hashes, query_idf in zip(queries, np.split(idf, np.cumsum([len(q) for q in queries])[:-1])):
+            total = query_idf.sum()
+            encoded.append({
+                "indices": query_hashes.tolist(),
+                "values": (query_idf / total if total else query_idf).tolist()
+            })
+        return encoded
+
+    def encode_documents(self,
+                         texts: Union[str, List[str]],
+                         term_counts: List[Tuple[np.ndarray, np.ndarray]] = None,
+                         n_jobs: int = 1) -> Union[dict, List[dict]]:
+        """
+        Sparse vectors of documents. The BM25 weights of the whole batch are computed in one vectorized call,
+        term_counts can be passed when the texts were already tokenized (see count_terms).
+        """
+        if isinstance(texts, str):
+            return self.encode_documents([texts])[0]
+
+        term_counts = term_counts if term_counts is not None else self.count_terms(texts, n_jobs)
+        if not term_counts:
+            return []
+
+        sizes = [len(hashes) for hashes, _ in term_counts]
+        tf = np.concatenate([counts for _, counts in term_counts]).astype(np.float64)
+        doc_lengths = np.repeat([counts.sum() for _, counts in term_counts], sizes)
+        weights = np.split(self.tf_weights(tf, doc_lengths), np.cumsum(sizes)[:-1])
+
+        return [
+            {"indices": hashes.tolist(), "values": doc_weights.tolist()}
+            for (hashes, _), doc_weights in zip(term_counts, weights)
+        ]
+
+    def count_terms(self, texts: List[str], n_jobs: int = 1) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        (term hashes, term frequencies) of each text. With n_jobs > 1 the tokenization (the expensive part, it is
+        pure Python) is spread over the shared process pool, small batches are tokenized in this process.
+        """
+        n_shards = min(n_jobs, len(texts) // MIN_TEXTS_PER_JOB)
+        if n_shards <= 1:
+            return count_terms_shard(texts, self.tokenizer_params)
+
+        shard_size = -(-len(texts) // n_shards)
+        shards = [texts[i:i + shard_size] for i in range(0, len(texts), shard_size)]
+        results = get_tokenization_pool(n_jobs).map(count_terms_shard, shards, [self.tokenizer_params] * len(shards))
+        return [counts for shard_counts in results for counts in shard_counts]
+
+    def tf_weights(self, tf: np.ndarray, doc_lengths) -> np.ndarray:
+        return tf / (self.k1 * (1.0 - self.b + self.b * (doc_lengths / self.avgdl)) + tf)
+
+    # ------------------------------------------------------------------
+    # Building
+    # ------------------------------------------------------------------
+    @classmethod
+    def fit(cls, texts: List[str], ids: List[str] = None, metadatas: List[dict] = None, **params) -> "BM25Index":
+        """
+        Build stats and postings from a corpus.
+        """
+        index = cls(**params)
+        index.add_documents(texts, ids, metadatas)
+        return index
+
+    def add_documents(self,
+                      texts: List[str],
+                      ids: List[str] = None,
+                      metadatas: List[dict] = None,
+                      term_counts: List[Tuple[np.ndarray, np.ndarray]] = None) -> None:
+        """
+        Add documents to the index: n_docs and avgdl are updated from the new documents only, their postings are
+        appended to the pending ones and merged into the CSR arrays (with the document frequencies) on the next
+        merge_pending, so adding a batch costs the size of the batch, not of the corpus already indexed.
+        """
+        if not texts:
+            return
+
+        n_stored = len(self.doc_lengths)
+        ids = ids if ids is not None else [str(n_stored + i) for i in range(len(texts))]
+        metadatas = metadatas if metadatas is not None else [{} for _ in texts]
+        term_counts = term_counts if term_counts is not None else self.count_terms(texts)
+
+        sizes = [len(hashes) for hashes, _ in term_counts]
+        doc_lengths = np.array([counts.sum() for _, counts in term_counts], dtype=np.uint32)
+        tf_column = np.concatenate([counts for _, counts in term_counts])
+        self.pending_postings.append((
+            np.concatenate([hashes for hashes, _ in term_counts]).astype(np.uint32),
+            np.repeat(np.arange(n_stored, n_stored + len(texts), dtype=np.uint32), sizes),
+            np.minimum(tf_column, np.iinfo(np.uint16).max).astype(np.uint16)
+        ))
+
+        total_length = self.avgdl * self.n_docs + float(doc_lengths.sum())
+        self.n_docs += len(texts)
+        self.avgdl = total_length / self.n_docs
+
+        self.doc_lengths = np.concatenate([self.doc_lengths, doc_lengths])
+        self.deleted = np.concatenate([self.deleted, np.zeros(len(texts), dtype=np.uint8)])
+        if self.id_positions is not None:
+            self.id_positions.update(zip(ids, range(n_stored, n_stored + len(texts))))
+        self.ids.extend(ids)
+        self.texts.extend(texts)
+        self.metadatas.extend([json.dumps(metadata, default=str) for metadata in metadatas])
+
+    def remove_documents(self, ids: List[str]) -> None:
+        """
+        Remove stored documents: n_docs and avgdl are decremented right away, their postings are dropped (and the
+        document frequencies decremented) on the next merge_pending. Their texts stay in the blobs, only
+        unreachable. Unknown ids are ignored.
+        """
+        if self.id_positions is None:
+            self.id_positions = {_id: pos for pos, _id in enumerate(self.ids) if not self.deleted[pos]}
+        positions = np.array([self.id_positions[_id] for _id in ids if _id in self.id_positions], dtype=np.int64)
+        if len(positions) == 0:
+            return
+
+        total_length = self.avgdl * self.n_docs - float(self.doc_lengths[positions].sum())
+        self.n_docs -= len(positions)
+        self.avgdl = total_length / self.n_docs if self.n_docs else 0.0
+
+        self.deleted = np.array(self.deleted)
+        self.deleted[positions] = 1
+        self.pending_removals = True
+        for pos in positions:
+            del self.id_positions[self.ids[pos]]
+
+    def merge_pending(self) -> None:
+        """
+        Fold the postings added and removed since the last merge into the CSR arrays, in one sort. Each posting is
+        one (term, document) pair, so the document frequency of a term is its number of postings. Called before
+        anything reads the vocabulary or the postings (queries, search, save).
+        """
+        if not self.pending_postings and not self.pending_removals:
+            return
+
+        all_terms = np.concatenate([np.repeat(self.terms, np.diff(self.postings_offsets)),
+                                    *[terms for terms, _, _ in self.pending_postings]])
+        all_docs = np.concatenate([self.postings_docs, *[docs for _, docs, _ in self.pending_postings]])
+        all_tf = np.concatenate([self.postings_tf, *[tf for _, _, tf in self.pending_postings]])
+
+        # Terms no longer in any document leave the vocabulary (unknown terms get the default frequency).
+        kept = self.deleted[all_docs] == 0
+        all_terms, all_docs, all_tf = all_terms[kept], all_docs[kept], all_tf[kept]
+        order = np.lexsort((all_docs, all_terms))
+
+        self.terms, doc_freq = np.unique(all_terms, return_counts=True)
+        self.terms = self.terms.astype(np.uint32)
+        self.doc_freq = doc_freq.astype(np.uint32)
+        self.postings_offsets = np.concatenate([[0], np.cumsum(doc_freq)]).astype(np.int64)
+        self.postings_docs = all_docs[order]
+        self.postings_tf = all_tf[order]
+
+        self.pending_postings = []
+        self.pending_removals = False
+
+    # ------------------------------------------------------------------
+    # Search
+    # ------------------------------------------------------------------
+    def search(self, query: str, top_k: int = 10) -> List[Document]:
+        """
+        Score every stored document against the query with the same dot product Pinecone would compute between
+        encode_queries(query) and encode_documents(document), and return the top_k as Documents.
+        """
+        if len(self.doc_lengths) == 0:
+            return []
+
+        self.merge_pending()
+        encoded = self.encode_queries(query)
+        hashes = np.array(encoded["indices"], dtype=np.uint32)
+        query_values = np.array(encoded["values"], dtype=np.float64)
+
+        positions = np.minimum(np.searchsorted(self.terms, hashes), max(len(self.terms) - 1, 0))
+        found = self.terms[positions] == hashes
+        positions, query_values = positions[found], query_values[found]
+        if len(positions) == 0:
+            return []
+
+        starts, ends = self.postings_offsets[positions], self.postings_offsets[positions + 1]
+        posting_slices = [np.arange(start, end) for start, end in zip(starts, ends)]
+        postings = np.concatenate(posting_slices)
+
+        docs = self.postings_docs[postings].astype(np.int64)
+        tf = self.postings_tf[postings].astype(np.float64)
+        weights = np.repeat(query_values, ends - starts) * self.tf_weights(tf, self.doc_lengths[docs])
+
+        scores = np.bincount(docs, weights=weights, minlength=len(self.doc_lengths))
+
+        n_candidates = min(top_k, int((scores > 0).sum()))
+        if n_candidates == 0:
+            return []
+        top_docs = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        top_docs = top_docs[np.argsort(-scores[top_docs])]
+
+        return [
+            Document(
+                page_content=self.texts[doc],
+                metadata={**json.loads(self.metadatas[doc]), "id": self.ids[doc], "score": float(scores[doc])}
+            )
+            for doc in top_docs
+        ]
+
+    # ------------------------------------------------------------------
+    # Binary format
+    # ------------------------------------------------------------------
+    def save(self, path) -> None:
+        """
+        File layout: MAGIC | uint64 header size | json header | arrays (8 bytes aligned). The header holds the
+        parameters, the stats and the (dtype, offset, count) of every array.
+        """
+        self.merge_pending()
+        for strings in [self.ids, self.texts, self.metadatas]:
+            strings.pack()
+
+        arrays = {
+            "terms": self.terms,
+            "doc_freq": self.doc_freq,
+            "postings_offsets": self.postings_offsets,
+            "postings_docs": self.postings_docs,
+            "postings_tf": self.postings_tf,
+            "doc_lengths": self.doc_lengths,
+            "deleted": self.deleted,
+            "ids_blob": self.ids.blob,
+            "ids_offsets": self.ids.offsets,
+            "texts_blob": self.texts.blob,
+            "texts_offsets": self.texts.offsets,
+            "metadatas_blob": self.metadatas.blob,
+            "metadatas_offsets": self.metadatas.offsets
+        }
+
+        table, offset = {}, 0
+        for name, array in arrays.items():
+            table[name] = [array.dtype.str, offset, len(array)]
+            offset += self.align(array.nbytes)
+
+        header = json.dumps({
+            "k1": self.k1,
+            "b": self.b,
+            "tokenizer": self.tokenizer_params,
+            "n_docs": self.n_docs,
+            "avgdl": self.avgdl,
+            "arrays": table
+        }).encode("utf-8")
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            f.write(b"\0" * (self.align(f.tell()) - f.tell()))
+            for array in arrays.values():
+                f.write(np.ascontiguousarray(array).tobytes())
+                f.write(b"\0" * (self.align(array.nbytes) - array.nbytes))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path) -> "BM25Index":
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a BM25 index file.")
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_size))
+        data_start = cls.align(len(MAGIC) + 8 + header_size)
+
+        index = cls(k1=header["k1"], b=header["b"], **header["tokenizer"])
+        index.n_docs = header["n_docs"]
+        index.avgdl = header["avgdl"]
+
+        arrays = {}
+        for name, (dtype, offset, count) in header["arrays"].items():
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=data_start + offset, shape=(count,)) \
+                if count else np.zeros(0, dtype=dtype)
+
+        index.terms = arrays["terms"]
+        index.doc_freq = arrays["doc_freq"]
+        index.postings_offsets = arrays["postings_offsets"]
+        index.postings_docs = arrays["postings_docs"]
+        index.postings_tf = arrays["postings_tf"]
+        index.doc_lengths = arrays["doc_lengths"]
+        index.deleted = arrays["deleted"]
+        index.ids = PackedStrings(arrays["ids_blob"], arrays["ids_offsets"])
+        index.texts = PackedStrings(arrays["texts_blob"], arrays["texts_offsets"])
+        index.metadatas = PackedStrings(arrays["metadatas_blob"], arrays["metadatas_offsets"])
+
+        return index
+
+    @staticmethod
+    def align(size: int) -> int:
+        return (size + 7) // 8 * 8
+
+
+if __name__ == "__main__":
+    index = BM25Index.fit(
+        texts=["HyDE generates a hypothetical document", "BM25 is a sparse retrieval function"],
+        ids=["hyde", "bm25"]
+    )
+    print(index.encode_queries("How HyDE works?"))
+    print(index.search("sparse retrieval", top_k=1))
@@ -0,0 +1,166 @@
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+from langchain_core.documents import Document
+from vector_database.hybrid_retrieval import HybridSearchRetriever
+
+
+class FederatedRetriever:
+    def __init__(self,
+                 retrievers: Dict[str, HybridSearchRetriever],
+                 fusion: str = "rrf",
+                 weights: Dict[str, float] = None,
+                 top_k: int = 10,
+                 rrf_k: int = 60,
+                 deadline: float = 2.0
+                 ) -> None:
+        """
+        Retriever over several indexes or namespaces (one HybridSearchRetriever per backend, by name), queried in
+        parallel and merged into a single top_k.
+
+        fusion="rrf" ranks chunks by reciprocal rank fusion, sum of weight / (rrf_k + rank) over the backends that
+        returned them, which needs no score calibration between indexes built with different settings.
+        fusion="weighted" sums the weighted scores instead, min-max normalized per backend.
+
+        The same chunk ingested in two indexes is merged into one, whatever its ids: chunks are matched by source
+        and start_index, or for chunks stored without offsets by source and text, a chunk with a contextual
+        preprocessing suffix matching the same chunk without it.
+
+        Each backend has its own worker thread. A backend that has not answered deadline seconds after the query
+        started is left out of the result, so one slow backend never delays the answer more than deadline, and
+        it is skipped by the next queries until its pending call returns, instead of queueing them behind it.
+        """
+        self.check_fusion(fusion)
+        self.retrievers = retrievers
+        self.fusion = fusion
+        self.weights = {name: (weights or {}).get(name, 1.0) for name in retrievers}
+        self.top_k = top_k
+        self.rrf_k = rrf_k
+        self.deadline = deadline
+        self.executors = {name: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"federated-{name}")
+                          for name in retrievers}
+        self.running = {}
+
+        self.late = defaultdict(int)
+        self.failed = defaultdict(int)
+        self.skipped = defaultdict(int)
+
+    @staticmethod
+    def check_fusion(fusion: str) -> None:
+        if fusion not in ["rrf", "weighted"]:
+            raise ValueError("The fusion must be 'rrf' or 'weighted'.")
+
+    @staticmethod
+    def chunk_key(document: Document, keys: List[Tuple[str, object]]) -> Tuple[str, object]:
+        """
+        Key of the chunk a document comes from, one of keys if it was already seen in another backend.
+        """
+        source = str(document.metadata.get("source", ""))
+        if "start_index" in document.metadata:
+            # Pinecone returns numeric metadata as floats.
+            return source, int(document.metadata["start_index"])
+
+        text = " ".join(document.page_content.split())
+        for key in keys:
+            if key[0] != source or not isinstance(key[1], str):
+                continue
+            # Contextual preprocessing appends "\n" + context to the chunk text.
+            if text == key[1] or text.startswith(key[1] + " ") or key[1].startswith(text + " "):
+                return key
+        return source, text
+
+    def fuse(self, results: Dict[str, List[Document]]) -> List[Document]:
+        scores = defaultdict(float)
+        documents, backends = {}, defaultdict(list)
+
+        for name, backend_documents in results.items():
+            weight = self.weights[name]
+            backend_scores = [doc.metadata.get("score", 0.0) for doc in backend_documents]
+            low, high = min(backend_scores, default=0.0), max(backend_scores, default=0.0)
+
+            for rank, (doc, score) in enumerate(zip(backend_documents, backend_scores), start=1):
+                key = self.chunk_key(doc, list(documents))
+                if name in backends[key]:
+                    continue
+                if self.fusion == "rrf":
+                    scores[key] += weight / (self.rrf_k + rank)
+                else:
+                    scores[key] += weight * ((score - low) / (high - low) if high > low else 1.0)
+                documents.setdefault(key, doc)
+                backends[key].append(name)
+
+        fused = []
+        for key in sorted(scores, key=scores.get, reverse=True)[:self.top_k]:
+            doc = documents[key]
+            fused.append(Document(page_content=doc.page_content,
+                                  metadata={**doc.metadata, "fused_score": scores[key], "backends": backends[key]}))
+        return fused
+
+    def retrieve(self, query: str) -> List[Document]:
+        futures = {}
+        for name, retriever in self.retrievers.items():
+            previous = self.running.get(name)
+            if previous is not None and not previous.done():
+                self.skipped[name] += 1
+                print(f"[Federated retrieval] {name} skipped, its previous query is still running.")
+                continue
+            future = self.running[name] = self.executors[name].submit(retriever.retrieve, query)
+            futures[future] = name
+        done, pending = wait(futures, timeout=self.deadline)
+
+        results = {}
+        for future in done:
+            name = futures[future]
+            if future.exception() is not None:
+                self.failed[name] += 1
+                print(f"[Federated retrieval] {name} failed: {future.exception()!r}")
+            else:
+                results[name] = future.result()
+        for future in pending:
+            # Still running in the backend thread, its result is dropped.
+            self.late[futures[future]] += 1
+            print(f"[Federated retrieval] {futures[future]} missed the {self.deadline}s deadline.")
+
+        return self.fuse({name: results[name] for name in self.retrievers if name in results})
+
+    def sparse_available(self) -> bool:
+        return any(retriever.sparse_available() for retriever in self.retrievers.values())
+
+    def sparse_retrieve(self, query: str) -> List[Document]:
+        return self.fuse({name: retriever.sparse_retrieve(query) for name, retriever in self.retrievers.items()
+                          if retriever.sparse_available()})
+
+    def cached_retrieve(self, query: str) -> Optional[List[Document]]:
+        results = {name: retriever.cached_retrieve(query) for name, retriever in self.retrievers.items()}
+        results = {name: documents for name, documents in results.items() if documents is not None}
+        return self.fuse(results) if results else None
+
+    async def aretrieve(self, query: str, timeout: float = None) -> List[Document]:
+        """
+        Async retrieve: the backends are queried with HybridSearchRetriever.aretrieve, the ones still pending at
+        the deadline (or at timeout, if shorter) are cancelled.
+        """
+        deadline = self.deadline if timeout is None else min(self.deadline, timeout)
+        tasks = {asyncio.ensure_future(retriever.aretrieve(query)): name for name, retriever in self.retrievers.items()}
+        done, pending = await asyncio.wait(tasks, timeout=deadline)
+
+        for task in pending:
+            task.cancel()
+            self.late[tasks[task]] += 1
+            print(f"[Federated retrieval] {tasks[task]} missed the {deadline}s deadline.")
+
+        results = {}
+        for task in done:
+            name = tasks[task]
+            if task.exception() is not None:
+                self.failed[name] += 1
+                print(f"[Federated retrieval] {name} failed: {task.exception()!r}")
+            else:
+                results[name] = task.result()
+
+        return self.fuse({name: results[name] for name in self.retrievers if name in results})
+
+    async def aclose(self) -> None:
+        for retriever in self.retrievers.values():
+            await retriever.aclose()
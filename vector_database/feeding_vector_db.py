@@ -1,60 +1,290 @@
 import os
+import time
 
 from preprocessment.chunking.content_aware_chunking import ContentAwareChunking
 from vector_database.pinecone_utils import PineconeUtils
-from langchain_community.document_loaders import DirectoryLoader
+from vector_database.ingestion_manifest import IngestionManifest, chunk_ids, source_name
+from vector_database.ingestion_journal import IngestionJournal
+from vector_database.near_duplicates import NearDuplicateIndex
 from preprocessment.documents_preprocessment import Preprocesser
+from preprocessment.parsing.parallel_loader import ParallelDocumentLoader
+from preprocessment.parsing.parse_cache import ParseCache
+from vector_database.ingestion_pipeline import Stage, StreamingPipeline
+from vector_database.bm25_index import MIN_TEXTS_PER_JOB
 from pathlib import Path
 
+DEFAULT_STAGE_WORKERS = {
+    "load": os.cpu_count() or 2, "chunk": 1, "dedupe": 1, "preprocess": 4, "tokenize": 1, "embed": 2, "upsert": 4
+}
+
 class Ingestion:
     def __init__(self,
                  index_name,
                  directory, embedding_model_name, metric,
                  preprocessing_technique: str = "None",
                  model_provider: str = 'openai',
-                 glob: str = '*.pdf'):
+                 glob: str = '*.pdf',
+                 backend: str = 'pinecone',
+                 stage_workers: dict = None,
+                 queue_size: int = 8,
+                 parse_timeout: float = 300.0,
+                 span_chunking: bool = False,
+                 length_unit: str = "characters",
+                 ann: str = None,
+                 quantization: str = None,
+                 search_dimension: int = None,
+                 near_duplicate_threshold: float = None,
+                 tokenize_jobs: int = None):
         """
         This class is responsible for taking a path and parameters sending the documents on that path to a
         Pinecone index.
+
+        Runs are incremental: a manifest of file hashes and chunk ids is kept next to the index, unchanged files are
+        skipped, chunks of changed files are upserted under content derived ids and chunks that no longer exist are
+        deleted.
+
+        Changed files are streamed through concurrent stages (see build_pipeline), stage_workers overrides the
+        number of threads per stage of DEFAULT_STAGE_WORKERS. The BM25 tokenization of the chunks is spread over
+        tokenize_jobs processes (all the cpus by default).
+
+        Every file is parsed in its own process (one per load worker at a time): a file that takes longer than
+        parse_timeout seconds or crashes the parser is skipped and reported, without stopping the run. Parsed files
+        go to a ParseCache, read by the loader and by the preprocessing, so no file is parsed twice.
+
+        Progress is written to an IngestionJournal as chunks are preprocessed, embedded and upserted: if a run
+        stops halfway, the next one takes the preprocessed texts from the journal and skips the upserted chunks,
+        so no LLM, embedding or upsert call is paid twice.
+
+        With span_chunking, chunks are offsets over the parsed text (see SpanChunker) until they are embedded,
+        instead of strings copied from it. Chunk boundaries are the same as without it (in characters).
+        length_unit="tokens" counts chunk_size and chunk_overlap in tokens instead of characters, it needs
+        span_chunking.
+
+        The chunking and preprocessing settings are recorded in the manifest: changing any of them re-ingests every
+        file, since the chunks in the index were not produced with them.
+
+        ann, quantization and search_dimension open the local backend like its retrievers do (see PineconeUtils):
+        with ann="ivf" the IVF lists are trained and kept up to date by the ingestion itself.
+
+        With a near_duplicate_threshold, chunks whose estimated Jaccard similarity with a chunk already in the index
+        reaches it are dropped before preprocessing and embedding (see NearDuplicateIndex), and recorded in the
+        duplicates.json audit map kept next to the manifest.
         """
+        self.check_length_unit(length_unit, span_chunking)
         self.chunk_size = 512
         self.chunk_overlap = 50
-        self.chunker = ContentAwareChunking(
+        chunking = ContentAwareChunking(
             chunk_size=self.chunk_size,
             chunk_overlap=self.chunk_overlap,
-        ).get_chunker()
-
-        print("[Ingestion pipeline] Loading documents...")
-        self.docs = self.load_documents(directory, glob)
-
-        print("[Ingestion pipeline] Chunking documents...")
-        self.chunked_docs = self.chunker.split_documents(self.docs)
-
-        if preprocessing_technique != "None":
-            print(f"[Ingestion pipeline] Preprocessing documents (with {preprocessing_technique} strategy)...")
-            self.chunked_docs = self.preprocess_documents(self.chunked_docs, preprocessing_technique)
+        )
+        self.chunker = chunking.get_span_chunker(length_unit) if span_chunking else chunking.get_chunker()
 
-        print("[Ingestion pipeline] Sending documents into Pinecone...")
         self.pinecone_utils = PineconeUtils(
             index_name=index_name,
             metric=metric,
             embedding_model_name=embedding_model_name,
-            embedding_provider=model_provider
+            embedding_provider=model_provider,
+            backend=backend,
+            ann=ann,
+            quantization=quantization,
+            search_dimension=search_dimension
         )
+        self.manifest = IngestionManifest(self.pinecone_utils.manifest_path, settings={
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "span_chunking": span_chunking,
+            "length_unit": length_unit,
+            "preprocessing_technique": preprocessing_technique
+        })
+        self.journal = IngestionJournal(self.pinecone_utils.journal_path, run_key=preprocessing_technique)
+        if len(self.journal):
+            print(f"[Ingestion pipeline] Resuming an interrupted run, {len(self.journal)} chunks in the journal.")
+
+        print("[Ingestion pipeline] Comparing documents with the index manifest...")
+        files = sorted(Path(directory).glob(glob))
+        file_hashes = {source_name(file, directory): self.manifest.file_hash(file) for file in files}
+        changed, removed = self.manifest.diff(file_hashes)
+        print(f"[Ingestion pipeline] {len(changed)} new or changed, {len(removed)} removed, "
+              f"{len(files) - len(changed)} unchanged files.")
+
+        self.directory = directory
+        self.chunk_ids_per_file = {}
+        self.parse_cache = ParseCache()
+        self.loader = ParallelDocumentLoader(timeout=parse_timeout, parse_cache=self.parse_cache)
+        self.resumed_chunks = 0
+        self.tokenize_jobs = tokenize_jobs or os.cpu_count() or 1
+        self.near_duplicates = None
+        if near_duplicate_threshold is not None:
+            self.near_duplicates = NearDuplicateIndex(self.pinecone_utils.near_duplicates_path,
+                                                      threshold=near_duplicate_threshold)
+            self.near_duplicates.exclude(self.manifest.chunk_ids(changed + removed))
+        self.preprocessor = Preprocesser(preprocessing_technique, parse_cache=self.parse_cache) \
+                                                        if preprocessing_technique != "None" else None
 
-        self.pinecone_utils.insert_documents(self.chunked_docs)
+        print("[Ingestion pipeline] Streaming documents through load -> chunk -> "
+              f"{'dedupe -> ' if self.near_duplicates else ''}{'preprocess -> ' if self.preprocessor else ''}"
+              "tokenize -> embed -> upsert...")
+        self.pipeline = self.build_pipeline({**DEFAULT_STAGE_WORKERS, **(stage_workers or {})}, queue_size)
+        start = time.perf_counter()
+        n_chunks = sum(1 for _ in self.pipeline.run([Path(directory) / name for name in changed]))
+        self.pinecone_utils.save_sparse_index()
+        total_time = time.perf_counter() - start
+        print(f"[Ingestion pipeline] {n_chunks} chunks sent to the {backend} index in {total_time:.1f}s "
+              f"({n_chunks / max(total_time, 1e-9):.1f} chunks/s), {self.resumed_chunks} already sent by an "
+              f"interrupted run. Stage statistics:")
+        print(self.pipeline.report())
+        print(f"[Ingestion pipeline] Parsing: {self.loader.report()}")
+        if self.preprocessor is not None:
+            print(f"[Ingestion pipeline] Preprocessing: {self.preprocessor.usage_report()}")
+
+        # Files that failed to parse keep their previous chunks and manifest entry, so the next run retries them.
+        failed = {source_name(s["file"], directory) for s in self.loader.stats if s["error"] is not None}
+        changed = [name for name in changed if name not in failed]
+
+        # Upsert first and delete after, so there is no moment where a changed file has no chunks in the index.
+        new_ids = {chunk_id for ids in self.chunk_ids_per_file.values() for chunk_id in ids}
+        stale_ids = sorted(set(self.manifest.chunk_ids(changed + removed)) - new_ids)
+        if stale_ids:
+            print(f"[Ingestion pipeline] Deleting {len(stale_ids)} stale chunks...")
+            self.pinecone_utils.delete_documents(stale_ids)
+        self.pinecone_utils.flush_index()
+
+        orphan_sources = self.save_near_duplicates(stale_ids) if self.near_duplicates is not None else []
+        self.update_manifest(changed, removed, file_hashes, orphan_sources)
+        if n_chunks or stale_ids:
+            # Retrievers drop their cached results of the previous version.
+            self.pinecone_utils.bump_index_version()
+        self.journal.clear()
         print("[Ingestion pipeline] Done!")
 
     @staticmethod
-    def preprocess_documents(docs, preprocessing_technique):
-        preprocessor = Preprocesser(preprocessing_technique)
-        return preprocessor.preprocess_documents(docs)
+    def check_length_unit(length_unit: str, span_chunking: bool) -> None:
+        if length_unit not in ["characters", "tokens"]:
+            raise ValueError("The length unit must be 'characters' or 'tokens'.")
+        if length_unit == "tokens" and not span_chunking:
+            raise ValueError("Chunk lengths in tokens are only supported with span_chunking=True.")
+
+    def build_pipeline(self, stage_workers, queue_size):
+        """
+        Each stage runs in its own threads and passes its output through a bounded queue, so only queue_size
+        items per stage are in memory and parsing, LLM calls, embedding and upserts overlap.
+        """
+        # Local index writes rewrite its records file, so they are better done in larger batches.
+        upsert_batch_size = 500 if self.pinecone_utils.backend == "local" else 50
+
+        stages = [
+            Stage("load", self.load_stage, workers=stage_workers["load"]),
+            Stage("chunk", self.chunk_stage, workers=stage_workers["chunk"])
+        ]
+        if self.near_duplicates is not None:
+            stages.append(Stage("dedupe", self.dedupe_stage, workers=stage_workers["dedupe"], batch_size=64))
+        if self.preprocessor is not None:
+            stages.append(Stage("preprocess", self.preprocess_stage, workers=stage_workers["preprocess"],
+                                batch_size=16))
+        stages.extend([
+            # Batches large enough for count_terms to give every tokenization process a shard.
+            Stage("tokenize", self.tokenize_stage, workers=stage_workers["tokenize"],
+                  batch_size=MIN_TEXTS_PER_JOB * self.tokenize_jobs),
+            Stage("embed", self.embed_stage, workers=stage_workers["embed"], batch_size=64),
+            Stage("upsert", self.upsert_stage, workers=stage_workers["upsert"], batch_size=upsert_batch_size)
+        ])
+
+        return StreamingPipeline(stages, queue_size=queue_size)
+
+    def load_stage(self, files):
+        # One item per file, so the chunk ids of a file are computed over all of its chunks.
+        return [self.loader.load([file]) for file in files]
+
+    def chunk_stage(self, files_docs):
+        chunks = []
+        for docs in files_docs:
+            if not docs:
+                continue
+            chunked_docs = self.chunker.split_documents(docs)
+            # Ids come from the chunks as they are in the source, before any preprocessing changes their content.
+            ids = chunk_ids(chunked_docs, self.directory)
+            self.chunk_ids_per_file[source_name(docs[0].metadata["source"], self.directory)] = ids
+            chunks.extend(zip(chunked_docs, ids))
+
+        # With deduplication, resumed chunks are skipped after it, so they are also in the near duplicate index.
+        return chunks if self.near_duplicates is not None else self.skip_upserted(chunks)
+
+    def dedupe_stage(self, chunks):
+        keep = self.near_duplicates.deduplicate(
+            texts=[doc.page_content for doc, _ in chunks],
+            ids=[chunk_id for _, chunk_id in chunks],
+            sources=[source_name(doc.metadata["source"], self.directory) for doc, _ in chunks]
+        )
+        return self.skip_upserted([chunk for chunk, kept in zip(chunks, keep) if kept])
+
+    def skip_upserted(self, chunks):
+        # Chunks upserted by an interrupted run only need to be back in the BM25 stats, which are saved at the end
+        # of a run.
+        upserted = self.journal.texts([chunk_id for _, chunk_id in chunks], upserted=True)
+        resumed = [(doc, chunk_id) for doc, chunk_id in chunks if upserted.get(chunk_id)]
+        if resumed:
+            for doc, chunk_id in resumed:
+                doc.page_content = upserted[chunk_id]
+            self.pinecone_utils.encode_sparse([doc for doc, _ in resumed], [chunk_id for _, chunk_id in resumed],
+                                              n_jobs=self.tokenize_jobs)
+            self.resumed_chunks += len(resumed)
+
+        return [(doc, chunk_id) for doc, chunk_id in chunks if not upserted.get(chunk_id)]
+
+    def preprocess_stage(self, chunks):
+        preprocessed = self.journal.texts([chunk_id for _, chunk_id in chunks])
+        for doc, chunk_id in chunks:
+            if chunk_id in preprocessed:
+                doc.page_content = preprocessed[chunk_id]
+
+        pending = [(doc, chunk_id) for doc, chunk_id in chunks if chunk_id not in preprocessed]
+        if pending:
+            docs = self.preprocessor.preprocess_documents([doc for doc, _ in pending])
+            self.journal.record_texts([chunk_id for _, chunk_id in pending], [doc.page_content for doc in docs])
+        return chunks
+
+    def tokenize_stage(self, chunks):
+        term_counts = self.pinecone_utils.count_terms([doc for doc, _ in chunks], n_jobs=self.tokenize_jobs)
+        return [(doc, chunk_id, counts) for (doc, chunk_id), counts in zip(chunks, term_counts)]
+
+    def embed_stage(self, chunks):
+        docs, ids = [doc for doc, _, _ in chunks], [chunk_id for _, chunk_id, _ in chunks]
+        sparse_vectors = self.pinecone_utils.encode_sparse(docs, ids, term_counts=[counts for _, _, counts in chunks])
+        records = self.pinecone_utils.to_records(docs, ids, sparse_vectors)
+        # The vectors themselves are kept by the embedding cache, keyed by the recorded text.
+        self.journal.mark_embedded(ids, [doc.page_content for doc in docs])
+        return records
+
+    def upsert_stage(self, records):
+        self.pinecone_utils.upsert_records(records, batch_size=len(records), upsert_workers=1, journal=self.journal)
+        return [record["id"] for record in records]
+
+    def save_near_duplicates(self, stale_ids):
+        self.near_duplicates.remove(stale_ids)
+        self.near_duplicates.exclude([])
+
+        # A duplicate whose kept chunk was deleted (its file changed or was removed) is in no chunk of the index
+        # anymore: its file is ingested again on the next run.
+        orphans = self.near_duplicates.orphans()
+        self.near_duplicates.remove(list(orphans))
+        self.near_duplicates.save()
+
+        duplicates = len(self.near_duplicates.duplicates)
+        print(f"[Ingestion pipeline] {duplicates} near duplicate chunks left out of the index, see "
+              f"{self.near_duplicates.directory / 'duplicates.json'}.")
+        orphan_sources = sorted({entry["source"] for entry in orphans.values()})
+        for name in orphan_sources:
+            print(f"[Ingestion pipeline] {name} had duplicates of deleted chunks, it will be ingested again.")
+        return orphan_sources
+
+    def update_manifest(self, changed, removed, file_hashes, orphan_sources=()):
+        for name in changed:
+            self.manifest.update(name, file_hashes[name], self.chunk_ids_per_file.get(name, []))
+        # Sources with orphan duplicates leave the manifest last: one changed in this run must not be added back.
+        for name in [*removed, *orphan_sources]:
+            self.manifest.remove(name)
+        self.manifest.save()
 
-    @staticmethod
-    def load_documents(directory, glob):
-        return DirectoryLoader(
-            directory, glob=glob, show_progress=True
-        ).load()
 
 if __name__ == "__main__":
     ROOT_DIR = Path(__file__).parent.parent
@@ -65,5 +295,6 @@ if __name__ == "__main__":
         metric='dotproduct',
         directory=path,
         embedding_model_name='text-embedding-3-large',
+        backend=os.getenv("VECTOR_BACKEND", "pinecone"),
         # preprocessing_technique='contextual-embedding'
     )
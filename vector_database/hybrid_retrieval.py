@@ -1,30 +1,63 @@
 import os
-
-from pinecone import Pinecone
-from pinecone_text.sparse import BM25Encoder
+import asyncio
+import threading
 from langchain_core.documents import Document
 from vector_database.pinecone_utils import PineconeUtils
+from vector_database.bm25_index import BM25Index
 from preprocessment.embedding.embedding_config import EmbeddingConfig
+from vector_database.query_cache import TTLCache, normalize_query
 from langchain_community.retrievers import PineconeHybridSearchRetriever
-from pathlib import Path
-from typing import List
+from pinecone import PineconeAsyncio
+from pinecone_text.hybrid import hybrid_convex_scale
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 class HybridSearchRetriever:
     def __init__(self,
                  index_name: str,
                  embedding_model_name: str,
                  embedding_provider: str,
-                 top_k: int = 10
+                 top_k: int = 10,
+                 backend: str = "pinecone",
+                 ann: str = None,
+                 n_probe: int = 8,
+                 quantization: str = None,
+                 search_dimension: int = None,
+                 rescore_factor: int = 4,
+                 cache_size: int = 1024,
+                 cache_ttl: float = 3600.0,
+                 namespace: str = None
                  ) -> None:
+        """
+        Hybrid (dense + BM25) retriever over a PineconeUtils index.
 
-        self.index = PineconeUtils(
+        retrieve() goes through two LRU caches with a cache_ttl seconds expiry, keyed by the normalized query (see
+        normalize_query): the query encodings (dense embedding and sparse vector), so a repeated question never
+        reaches the embedding API, and the top_k results, so it does not reach the index either. Entries are
+        tied to the index version bumped by each ingestion: results of an older version are not served, the BM25
+        stats are reloaded and the sparse vectors encoded again. Ingestions running elsewhere (not writing the same
+        version file) are only picked up when the entries expire.
+
+        With a namespace, Pinecone queries only search that namespace of the index. ann, n_probe, quantization,
+        search_dimension and rescore_factor configure the search of the local backend (see PineconeUtils).
+        """
+        self.top_k = top_k
+        self.namespace = namespace
+        self.pinecone_utils = PineconeUtils(
             index_name=index_name,
             metric="dotproduct",
             embedding_model_name=embedding_model_name,
-            embedding_provider=embedding_provider
-        ).index
+            embedding_provider=embedding_provider,
+            backend=backend,
+            ann=ann,
+            n_probe=n_probe,
+            quantization=quantization,
+            search_dimension=search_dimension,
+            rescore_factor=rescore_factor
+        )
+        self.index = self.pinecone_utils.index
 
-        self.sparse_encoder = self.get_sparse_encoder(index_name)
+        self.sparse_encoder = self.get_sparse_encoder()
 
         self.embeddings = EmbeddingConfig(
             embedding_model=embedding_model_name,
@@ -40,62 +73,279 @@ class HybridSearchRetriever:
             top_k=top_k
         )
 
-    def get_sparse_encoder(self, index_name):
-        # get this file absolute path
-        current_dir = Path(__file__).resolve().parent
-        sparse_encoder_weights = current_dir / "bm25_values.json"
+        self.index_version = self.pinecone_utils.index_version()
+        self.version_lock = threading.Lock()
+        # Resolved once here, on the sync path: the async path only opens HTTP sessions to this host.
+        self.index_host = self.pinecone_utils.pc_client.describe_index(index_name).host \
+                                                        if self.pinecone_utils.backend == "pinecone" else None
+        # Event loop -> (PineconeAsyncio client, its IndexAsyncio), see get_async_index.
+        self.async_indexes = {}
+        self.async_lock = threading.Lock()
+        self.encoding_cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        self.result_cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        # Latest results of each query whatever the index version, only served by cached_retrieve.
+        self.latest_results = TTLCache(max_size=cache_size, ttl=cache_ttl)
+
+    def get_sparse_encoder(self) -> BM25Index:
+        # BM25 stats are maintained by the ingestion (PineconeUtils.encode_sparse) and saved next to the index.
+        return self.pinecone_utils.load_sparse_index()
+
+    def check_index_version(self) -> int:
+        version = self.pinecone_utils.index_version()
+        with self.version_lock:
+            if version == self.index_version:
+                return version
+            # Documents were ingested since the caches were filled: the local index is reopened to see them (and
+            # not the deleted ones), older results are never hit again (their key has the old version) and the
+            # sparse vectors have to be encoded with the new BM25 stats.
+            self.index = self.pinecone_utils.reload_index()
+            self.retriever.index = self.index
+            self.sparse_encoder = self.pinecone_utils.reload_sparse_index()
+            self.retriever.sparse_encoder = self.sparse_encoder
+            self.result_cache.clear()
+            self.index_version = version
+            return version
+
+    def encode_query(self, query: str, version: int) -> Tuple[List[float], dict]:
+        """
+        Dense embedding and sparse vector of the query, from the encoding cache when possible.
+        """
+        key = normalize_query(query)
+        cached = self.encoding_cache.get(key)
+        if cached is not None and cached[2] == version:
+            return cached[0], cached[1]
+
+        dense_vector = cached[0] if cached is not None else self.embeddings.embed_query(query)
+        sparse_vector = self.sparse_encoder.encode_queries(query)
+        self.encoding_cache.set(key, (dense_vector, sparse_vector, version))
+        return dense_vector, sparse_vector
+
+    async def aencode_query(self, query: str, version: int) -> Tuple[List[float], dict]:
+        """
+        encode_query with the embedding request and the sparse encoding (CPU bound, in a thread) run concurrently.
+        """
+        key = normalize_query(query)
+        cached = self.encoding_cache.get(key)
+        if cached is not None and cached[2] == version:
+            return cached[0], cached[1]
+
+        sparse_encoding = asyncio.to_thread(self.sparse_encoder.encode_queries, query)
+        if cached is not None:
+            dense_vector, sparse_vector = cached[0], await sparse_encoding
+        else:
+            dense_vector, sparse_vector = await asyncio.gather(self.embeddings.aembed_query(query), sparse_encoding)
+        self.encoding_cache.set(key, (dense_vector, sparse_vector, version))
+        return dense_vector, sparse_vector
+
+    def encode_queries(self, queries: List[str], version: int) -> List[Tuple[List[float], dict]]:
+        """
+        encode_query for a batch: the queries missing from the encoding cache are embedded in one
+        embed_documents call and sparse encoded in one vectorized encode_queries call.
+        """
+        keys = [normalize_query(query) for query in queries]
+        cached = [self.encoding_cache.get(key) for key in keys]
 
-        return BM25Encoder().load(sparse_encoder_weights) if sparse_encoder_weights.exists() \
-                                                      else self.create_sparse_encoder_tdif(index_name)
+        to_embed = [idx for idx, entry in enumerate(cached) if entry is None]
+        to_encode = [idx for idx, entry in enumerate(cached) if entry is None or entry[2] != version]
+        dense_vectors = dict(zip(to_embed, self.embeddings.embed_documents([queries[idx] for idx in to_embed])
+                                           if to_embed else []))
+        sparse_vectors = dict(zip(to_encode, self.sparse_encoder.encode_queries([queries[idx] for idx in to_encode])))
+
+        encodings = []
+        for idx, (key, entry) in enumerate(zip(keys, cached)):
+            dense_vector = dense_vectors[idx] if idx in dense_vectors else entry[0]
+            sparse_vector = sparse_vectors[idx] if idx in sparse_vectors else entry[1]
+            if idx in sparse_vectors:
+                self.encoding_cache.set(key, (dense_vector, sparse_vector, version))
+            encodings.append((dense_vector, sparse_vector))
+        return encodings
+
+    def query_arguments(self, dense_vector: List[float], sparse_vector: dict) -> dict:
+        """
+        Same query as PineconeHybridSearchRetriever.
+        """
+        dense_vector, sparse_vector = hybrid_convex_scale(dense_vector, sparse_vector, self.retriever.alpha)
+        sparse_vector["values"] = [float(value) for value in sparse_vector["values"]]
+        arguments = {"vector": dense_vector, "sparse_vector": sparse_vector, "top_k": self.top_k, "include_metadata": True}
+        if self.namespace is not None:
+            arguments["namespace"] = self.namespace
+        return arguments
 
     @staticmethod
-    def create_sparse_encoder_tdif(index_name):
-        pc = Pinecone(os.getenv("PINECONE_API_KEY"))
-        index = pc.Index(index_name)
+    def to_documents(result) -> List[Document]:
+        documents = []
+        for match in result["matches"]:
+            metadata = dict(match["metadata"])
+            text = metadata.pop("text")
+            if "score" not in metadata and "score" in match:
+                metadata["score"] = match["score"]
+            documents.append(Document(page_content=text, metadata=metadata))
+        return documents
 
-        # put all document ids in a list
-        ids = []
-        for id_list in index.list():
-            ids.extend(id_list)
+    def search(self, dense_vector: List[float], sparse_vector: dict) -> List[Document]:
+        return self.to_documents(self.index.query(**self.query_arguments(dense_vector, sparse_vector)))
 
-        # define a chunker function because we can load all vectors at once, we receive a HTTP error message
-        def chunker(seq, size):
-            return (seq[i:i + size] for i in range(0, len(seq), size))
+    def search_many(self, encodings: List[Tuple[List[float], dict]], max_workers: int = 8) -> List[List[Document]]:
+        """
+        search for a batch of encoded queries: one vectorized query_batch call on the local backend, Pinecone
+        queries sent by max_workers threads otherwise. Results are in the order of encodings.
+        """
+        arguments = [self.query_arguments(dense_vector, sparse_vector) for dense_vector, sparse_vector in encodings]
+        if self.pinecone_utils.backend == "local":
+            matches = self.index.query_batch(vectors=[argument["vector"] for argument in arguments],
+                                             sparse_vectors=[argument["sparse_vector"] for argument in arguments],
+                                             top_k=self.top_k, include_metadata=True)
+            return [self.to_documents({"matches": query_matches}) for query_matches in matches]
 
-        # We getting 100 documents per request
-        chunk_size = 100
-        all_vectors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda argument: self.to_documents(self.index.query(**argument)), arguments))
 
-        for chunk in chunker(ids, chunk_size):
-            result = index.fetch(ids=chunk)
-            all_vectors.update(result.get("vectors", {}))
+    async def asearch(self, dense_vector: List[float], sparse_vector: dict) -> List[Document]:
+        arguments = self.query_arguments(dense_vector, sparse_vector)
+        if self.pinecone_utils.backend == "local":
+            # In-process numpy search, off the event loop.
+            return self.to_documents(await asyncio.to_thread(self.index.query, **arguments))
+        return self.to_documents(await (await self.get_async_index()).query(**arguments))
 
-        # the corpus is basically the text of the documents, so:
-        corpus = [v["metadata"]["text"] for v in all_vectors.values() if "metadata" in v and "text" in v["metadata"]]
+    async def get_async_index(self):
+        """
+        Pinecone asyncio index of the running event loop (its HTTP session can not be shared between loops). The
+        clients of loops that have been closed since (asyncio.run per call) are closed on the way.
+        """
+        loop = asyncio.get_running_loop()
+        with self.async_lock:
+            closed = [self.async_indexes.pop(other) for other in list(self.async_indexes) if other.is_closed()]
+            if loop not in self.async_indexes:
+                client = PineconeAsyncio(api_key=os.environ["PINECONE_API_KEY"])
+                self.async_indexes[loop] = (client, client.IndexAsyncio(host=self.index_host))
+            index = self.async_indexes[loop][1]
 
-        # We initialize a BM25 encoder with default td-if values and fit in our corpus:
-        bm25_encoder = BM25Encoder().default()
-        bm25_encoder.fit(corpus)
+        for client, old_index in closed:
+            await self.close_async_clients(client, old_index)
+        return index
 
-        # and finally save it to a file, so we can re-use in other retriever loadings:
-        bm25_encoder.dump("bm25_values.json")
+    @staticmethod
+    async def close_async_clients(client, index) -> None:
+        for resource in [index, client]:
+            try:
+                await resource.close()
+            except Exception as e:
+                # Sessions of a closed loop can fail to close their connections, they are dropped anyway.
+                print(f"[Hybrid retrieval] Could not close {type(resource).__name__}: {e!r}")
 
-        encoder = BM25Encoder().load("bm25_values.json")
+    async def aclose(self) -> None:
+        """
+        Close the Pinecone asyncio clients of the running loop and of the loops closed since they were opened.
+        """
+        loop = asyncio.get_running_loop()
+        with self.async_lock:
+            clients = [self.async_indexes.pop(other) for other in list(self.async_indexes)
+                       if other is loop or other.is_closed()]
+
+        for client, index in clients:
+            await self.close_async_clients(client, index)
+
+    def cache_results(self, key: tuple, documents: List[Document]) -> None:
+        self.result_cache.set(key, documents)
+        self.latest_results.set((key[0], key[2]), documents)
+
+    @staticmethod
+    def copy_documents(documents: List[Document]) -> List[Document]:
+        # Copies, so callers can not change the cached documents.
+        return [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in documents]
+
+    def sparse_available(self) -> bool:
+        """
+        Whether the local BM25 stats store any chunk for sparse_retrieve to search.
+        """
+        return self.sparse_encoder.n_docs > 0
 
-        return encoder
+    def sparse_retrieve(self, query: str) -> List[Document]:
+        """
+        Degraded retrieval without the embedding API nor the index: BM25 top_k over the chunks stored in the local
+        BM25 stats, see sparse_available.
+        """
+        return self.sparse_encoder.search(query, top_k=self.top_k)
+
+    def cached_retrieve(self, query: str) -> Optional[List[Document]]:
+        """
+        Degraded retrieval: the last results of the query, possibly from an older index version, None if the query
+        was not retrieved recently.
+        """
+        documents = self.latest_results.get((normalize_query(query), self.top_k))
+        return self.copy_documents(documents) if documents is not None else None
 
     def retrieve(self, query: str) -> List[Document]:
         """
         This function retrieves the top k documents from the database.
         """
-        return self.retriever.invoke(query)
+        version = self.check_index_version()
+        key = (normalize_query(query), version, self.top_k)
+
+        documents = self.result_cache.get(key)
+        if documents is None:
+            documents = self.search(*self.encode_query(query, version))
+            self.cache_results(key, documents)
+
+        return self.copy_documents(documents)
+
+    def retrieve_many(self, queries: List[str], max_workers: int = 8) -> List[List[Document]]:
+        """
+        retrieve for many queries (evaluation sets, multi-query expansion) in a few batched calls instead of one
+        embedding request and one index query per query, see encode_queries and search_many. Repeated queries are
+        searched once. The results are aligned with queries.
+        """
+        version = self.check_index_version()
+        keys = [normalize_query(query) for query in queries]
+
+        results, missing = {}, {}
+        for query, key in zip(queries, keys):
+            if key in results or key in missing:
+                continue
+            documents = self.result_cache.get((key, version, self.top_k))
+            if documents is None:
+                missing[key] = query
+            else:
+                results[key] = documents
+
+        if missing:
+            searched = self.search_many(self.encode_queries(list(missing.values()), version), max_workers=max_workers)
+            for key, documents in zip(missing, searched):
+                self.cache_results((key, version, self.top_k), documents)
+                results[key] = documents
+
+        return [self.copy_documents(results[key]) for key in keys]
+
+    async def aretrieve(self, query: str, timeout: float = None) -> List[Document]:
+        """
+        Async retrieve: the query is embedded and sparse encoded concurrently, then the index is queried through
+        the asyncio Pinecone client, without blocking a thread. Raises asyncio.TimeoutError after timeout seconds,
+        and cancelling the task cancels the pending requests.
+        """
+        async def retrieve_documents():
+            version = self.check_index_version()
+            key = (normalize_query(query), version, self.top_k)
+
+            documents = self.result_cache.get(key)
+            if documents is None:
+                documents = await self.asearch(*await self.aencode_query(query, version))
+                self.cache_results(key, documents)
+            return documents
+
+        return self.copy_documents(await asyncio.wait_for(retrieve_documents(), timeout))
+
+    def cache_stats(self) -> dict:
+        return {"encodings": self.encoding_cache.stats(), "results": self.result_cache.stats(),
+                "index_version": self.index_version}
 
 if __name__ == "__main__":
     retriever = HybridSearchRetriever(
         index_name="ca-contextualemb-dotp-3large",
         embedding_model_name="text-embedding-3-large",
         embedding_provider="openai"
-    ).retriever
+    )
 
-    documents = retriever.invoke("How HyDE works?")
+    documents = retriever.retrieve("How HyDE works?")
     print(documents)
+    retriever.retrieve("how HyDE works")
+    print(retriever.cache_stats())
@@ -0,0 +1,82 @@
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List
+
+
+class IngestionJournal:
+    def __init__(self, path, run_key: str = "") -> None:
+        """
+        Durable record of the work done on each chunk of an ingestion that did not finish yet: its final text
+        (after preprocessing, the part paid to an LLM), whether it was embedded and whether it was upserted.
+
+        Every write is committed right away (sqlite, WAL), so after a crash a new run finds what the previous one
+        completed and only does the rest. run_key identifies the settings that change the chunk texts (the
+        preprocessing technique): a journal written with another run_key is discarded. The journal is cleared once
+        the run is recorded in the manifest.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "chunk_id TEXT PRIMARY KEY, text TEXT, embedded INTEGER DEFAULT 0, upserted INTEGER DEFAULT 0)"
+        )
+
+        stored = self.connection.execute("SELECT value FROM meta WHERE key = 'run_key'").fetchone()
+        if stored is not None and stored[0] != run_key:
+            self.connection.execute("DELETE FROM chunks")
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('run_key', ?)", (run_key,))
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def texts(self, ids: List[str], upserted: bool = False) -> Dict[str, str]:
+        """
+        Recorded texts of the given chunks (only the upserted ones if upserted=True).
+        """
+        rows = []
+        with self.lock:
+            # sqlite accepts a limited number of parameters per statement.
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i + 500]
+                rows.extend(self.connection.execute(
+                    f"SELECT chunk_id, text FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})"
+                    f"{' AND upserted = 1' if upserted else ''}",
+                    batch
+                ).fetchall())
+        return dict(rows)
+
+    def record_texts(self, ids: List[str], texts: List[str]) -> None:
+        self.write(
+            "INSERT INTO chunks (chunk_id, text) VALUES (?, ?) ON CONFLICT(chunk_id) DO UPDATE SET text = excluded.text",
+            list(zip(ids, texts))
+        )
+
+    def mark_embedded(self, ids: List[str], texts: List[str]) -> None:
+        self.write(
+            "INSERT INTO chunks (chunk_id, text, embedded) VALUES (?, ?, 1) "
+            "ON CONFLICT(chunk_id) DO UPDATE SET text = excluded.text, embedded = 1",
+            list(zip(ids, texts))
+        )
+
+    def mark_upserted(self, ids: List[str]) -> None:
+        self.write(
+            "INSERT INTO chunks (chunk_id, upserted) VALUES (?, 1) ON CONFLICT(chunk_id) DO UPDATE SET upserted = 1",
+            [(chunk_id,) for chunk_id in ids]
+        )
+
+    def clear(self) -> None:
+        self.write("DELETE FROM chunks", [()])
+
+    def write(self, statement: str, rows: List[tuple]) -> None:
+        with self.lock:
+            self.connection.executemany(statement, rows)
+            self.connection.commit()
@@ -0,0 +1,91 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from langchain_core.documents import Document
+
+ROOT_DIR = Path(__file__).parent.parent
+MANIFESTS_DIR = ROOT_DIR / "vector_database" / "manifests"
+
+
+class IngestionManifest:
+    def __init__(self, path, settings: dict = None) -> None:
+        """
+        Record of what is already in an index: for each source file (relative to the ingested directory) the hash
+        of its content and the ids of the chunks it produced. It lets the ingestion skip unchanged files and delete
+        the chunks of changed or removed ones.
+
+        Every file also records a hash of the ingestion settings it was ingested with (chunking, preprocessing...):
+        a file ingested with other settings than the current ones counts as changed, even if its content did not.
+        """
+        self.path = Path(path)
+        self.files: Dict[str, dict] = {}
+        self.settings_hash = hashlib.sha256(json.dumps(settings or {}, sort_keys=True).encode("utf-8")).hexdigest()
+
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.files = json.load(f)["files"]
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.files}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def file_hash(path) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def diff(self, file_hashes: Dict[str, str]) -> Tuple[List[str], List[str]]:
+        """
+        Compare the current files with the manifest: returns (new or changed files, removed files). Files ingested
+        with other settings (or before settings were recorded) are changed too.
+        """
+        changed = [name for name, file_hash in file_hashes.items()
+                   if self.files.get(name, {}).get("sha256") != file_hash
+                   or self.files[name].get("settings") != self.settings_hash]
+        removed = [name for name in self.files if name not in file_hashes]
+        return changed, removed
+
+    def chunk_ids(self, names: List[str]) -> List[str]:
+        return [chunk_id for name in names for chunk_id in self.files.get(name, {}).get("chunk_ids", [])]
+
+    def update(self, name: str, file_hash: str, chunk_ids: List[str]) -> None:
+        self.files[name] = {"sha256": file_hash, "settings": self.settings_hash, "chunk_ids": chunk_ids}
+
+    def remove(self, name: str) -> None:
+        self.files.pop(name, None)
+
+
+def source_name(source, directory) -> str:
+    """
+    Name of a source file in the manifest: its path relative to the ingested directory, so ids do not change if
+    the repository is cloned somewhere else.
+    """
+    try:
+        return Path(source).resolve().relative_to(Path(directory).resolve()).as_posix()
+    except ValueError:
+        return Path(source).as_posix()
+
+
+def chunk_ids(documents: List[Document], directory) -> List[str]:
+    """
+    Content derived chunk ids: hash of (source name, chunk text, occurrence of that text in the source). The same
+    chunk always gets the same id, so re-upserting it overwrites instead of duplicating.
+    """
+    occurrences = defaultdict(int)
+    ids = []
+    for doc in documents:
+        name = source_name(doc.metadata["source"], directory)
+        occurrence = occurrences[(name, doc.page_content)]
+        occurrences[(name, doc.page_content)] += 1
+
+        ids.append(hashlib.sha256(f"{name}\0{occurrence}\0{doc.page_content}".encode("utf-8")).hexdigest()[:32])
+    return ids
@@ -0,0 +1,179 @@
+import time
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, List
+
+END = object()
+
+
+class Stage:
+    def __init__(self,
+                 name: str,
+                 function: Callable[[List], List],
+                 workers: int = 1,
+                 batch_size: int = 1
+                 ) -> None:
+        """
+        One step of a StreamingPipeline: function receives a batch of up to batch_size items and returns the list
+        of items sent to the next stage (any length, so a stage can split, merge or drop items). workers threads
+        run it concurrently.
+        """
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batch_size = batch_size
+
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_time = 0.0
+        self.queue_depth_sum = 0
+        self.queue_depth_max = 0
+        self.queue_depth_samples = 0
+        self.start_time = None
+        self.end_time = None
+
+    def stats(self) -> dict:
+        wall_time = (self.end_time or time.perf_counter()) - (self.start_time or time.perf_counter())
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "items_per_sec": self.items_in / wall_time if wall_time > 0 else 0.0,
+            "busy": self.busy_time / (wall_time * self.workers) if wall_time > 0 else 0.0,
+            "queue_depth_avg": self.queue_depth_sum / self.queue_depth_samples if self.queue_depth_samples else 0.0,
+            "queue_depth_max": self.queue_depth_max
+        }
+
+
+class StreamingPipeline:
+    def __init__(self, stages: List[Stage], queue_size: int = 8) -> None:
+        """
+        Runs stages concurrently, connected by bounded queues: a stage blocks when the next one is queue_size items
+        behind, so memory is bounded by the queues instead of by the corpus, and the whole pipeline moves at the
+        speed of its slowest stage.
+
+        If a stage raises, the remaining items are drained without processing and the first error is raised by
+        run() once every thread stopped.
+        """
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self.lock = threading.Lock()
+        self.running_workers = [stage.workers for stage in stages]
+        self.error = None
+
+    def run(self, items: Iterable) -> Iterator:
+        """
+        Feed items to the first stage and yield what comes out of the last one.
+        """
+        threads = [threading.Thread(target=self.feed, args=(items,), daemon=True)]
+        for stage_idx, stage in enumerate(self.stages):
+            threads.extend(
+                threading.Thread(target=self.work, args=(stage_idx,), daemon=True) for _ in range(stage.workers)
+            )
+        for thread in threads:
+            thread.start()
+
+        output = self.queues[-1]
+        while True:
+            item = output.get()
+            if item is END:
+                break
+            yield item
+
+        for thread in threads:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def feed(self, items: Iterable) -> None:
+        try:
+            for item in items:
+                if self.error is not None:
+                    break
+                self.queues[0].put(item)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(END)
+
+    def work(self, stage_idx: int) -> None:
+        stage = self.stages[stage_idx]
+        input_queue, output_queue = self.queues[stage_idx], self.queues[stage_idx + 1]
+
+        with self.lock:
+            stage.start_time = stage.start_time or time.perf_counter()
+
+        finished = False
+        while not finished:
+            batch = []
+            while len(batch) < stage.batch_size:
+                depth = input_queue.qsize()
+                item = input_queue.get()
+                if item is END:
+                    finished = True
+                    break
+                batch.append(item)
+                with self.lock:
+                    stage.queue_depth_sum += depth
+                    stage.queue_depth_samples += 1
+                    stage.queue_depth_max = max(stage.queue_depth_max, depth)
+
+            if not batch or self.error is not None:
+                continue
+
+            start = time.perf_counter()
+            try:
+                outputs = stage.function(batch)
+            except Exception as e:
+                self.fail(e)
+                continue
+            busy_time = time.perf_counter() - start
+
+            with self.lock:
+                stage.items_in += len(batch)
+                stage.items_out += len(outputs)
+                stage.busy_time += busy_time
+
+            for output in outputs:
+                output_queue.put(output)
+
+        # The last worker of a stage closes the stage: one END per worker of the next stage (or for run()).
+        with self.lock:
+            self.running_workers[stage_idx] -= 1
+            last_worker = self.running_workers[stage_idx] == 0
+            if last_worker:
+                stage.end_time = time.perf_counter()
+
+        if last_worker:
+            next_workers = self.stages[stage_idx + 1].workers if stage_idx + 1 < len(self.stages) else 1
+            for _ in range(next_workers):
+                output_queue.put(END)
+
+    def fail(self, error: Exception) -> None:
+        with self.lock:
+            if self.error is None:
+                self.error = error
+
+    def report(self) -> str:
+        lines = []
+        for stage in self.stages:
+            stats = stage.stats()
+            lines.append(
+                f"{stats['stage']:>12}: {stats['items_in']} in / {stats['items_out']} out, "
+                f"{stats['items_per_sec']:.1f} items/s, {stats['workers']} workers {stats['busy']:.0%} busy, "
+                f"input queue depth avg {stats['queue_depth_avg']:.1f} max {stats['queue_depth_max']}"
+            )
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    pipeline = StreamingPipeline([
+        Stage("square", lambda batch: [x * x for x in batch], workers=2),
+        Stage("sum", lambda batch: [sum(batch)], batch_size=10)
+    ], queue_size=4)
+
+    print(sum(pipeline.run(range(100))))
+    print(pipeline.report())
@@ -0,0 +1,156 @@
+import json
+import numpy as np
+from pathlib import Path
+
+
+class IVFIndex:
+    def __init__(self,
+                 directory,
+                 metric: str = "dotproduct",
+                 n_lists: int = None,
+                 n_probe: int = 8,
+                 min_train_size: int = 1024,
+                 retrain_factor: float = 4.0
+                 ) -> None:
+        """
+        Inverted file (IVF) approximate nearest neighbour index used by LocalIndex when ann="ivf".
+
+        Vectors are clustered with k-means, each row is stored in the list of its nearest centroid and a query only
+        scores the rows of its n_probe closest lists. n_probe is the recall/latency knob: n_probe == n_lists is exact
+        search. It only holds centroids and row -> list assignments, the vectors stay in LocalIndex's memmap.
+        """
+        self.directory = Path(directory)
+        self.centroids_path = self.directory / "ivf_centroids.npy"
+        self.assignments_path = self.directory / "ivf_assignments.npy"
+        self.config_path = self.directory / "ivf.json"
+
+        self.metric = metric
+        self.requested_n_lists = n_lists
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.retrain_factor = retrain_factor
+
+        self.centroids = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.trained_size = 0
+
+        self.load()
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def load(self) -> None:
+        if not self.config_path.exists():
+            return
+
+        with open(self.config_path, "r") as f:
+            config = json.load(f)
+
+        self.n_lists = config["n_lists"]
+        self.trained_size = config["trained_size"]
+        self.centroids = np.load(self.centroids_path)
+        self.assignments = np.load(self.assignments_path)
+        self.build_lists()
+
+    def persist(self) -> None:
+        if not self.is_trained:
+            return
+
+        np.save(self.centroids_path, self.centroids)
+        np.save(self.assignments_path, self.assignments)
+        with open(self.config_path, "w") as f:
+            json.dump({"n_lists": self.n_lists, "trained_size": self.trained_size}, f)
+
+    def prepare(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        For cosine, cluster directions instead of raw vectors.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.metric != "cosine":
+            return vectors
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+    def train(self, vectors: np.ndarray, n_iterations: int = 20, seed: int = 42) -> None:
+        """
+        Spherical/Lloyd k-means on (a sample of) the stored vectors.
+        """
+        vectors = self.prepare(vectors)
+        n_rows = len(vectors)
+        n_lists = self.requested_n_lists or max(1, int(4 * np.sqrt(n_rows)))
+        n_lists = min(n_lists, n_rows)
+
+        rng = np.random.default_rng(seed)
+        # 256 points per centroid is enough to place them, training on everything is wasted time.
+        sample = vectors[rng.choice(n_rows, size=min(n_rows, 256 * n_lists), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+
+        for _ in range(n_iterations):
+            labels = self.nearest_centroids(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # Re-seed empty lists with random points so every list stays in use.
+            centroids[empty] = sample[rng.choice(len(sample), size=int(empty.sum()), replace=False)]
+            if self.metric == "cosine":
+                centroids = self.prepare(centroids)
+
+        self.n_lists = n_lists
+        self.centroids = centroids
+        self.trained_size = n_rows
+        self.assignments = self.nearest_centroids(vectors, centroids)
+        self.build_lists()
+
+    def add(self, rows: np.ndarray, vectors: np.ndarray, all_vectors: np.ndarray) -> None:
+        """
+        Assign new (or overwritten) rows to their lists. The index trains itself once min_train_size rows exist and
+        retrains when the corpus grew retrain_factor times since the last training.
+        """
+        n_rows = len(all_vectors)
+        if not self.is_trained:
+            if n_rows >= self.min_train_size:
+                self.train(all_vectors)
+            return
+
+        if n_rows > self.retrain_factor * self.trained_size:
+            self.train(all_vectors)
+            return
+
+        if len(self.assignments) < n_rows:
+            self.assignments = np.concatenate([
+                self.assignments, np.zeros(n_rows - len(self.assignments), dtype=np.int32)
+            ])
+        self.assignments[rows] = self.nearest_centroids(self.prepare(vectors), self.centroids)
+        self.build_lists()
+
+    def build_lists(self) -> None:
+        """
+        CSR layout of the inverted lists: rows of list i are list_rows[list_offsets[i]:list_offsets[i + 1]].
+        """
+        self.list_rows = np.argsort(self.assignments, kind="stable").astype(np.int64)
+        counts = np.bincount(self.assignments, minlength=self.n_lists)
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def candidates(self, query: np.ndarray, n_probe: int = None) -> np.ndarray:
+        """
+        Rows stored in the n_probe lists closest to the query.
+        """
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        # Same criterion used to assign rows to lists (closest centroid in L2).
+        centroid_scores = self.centroids @ self.prepare(query) - 0.5 * np.sum(self.centroids ** 2, axis=1)
+        probed = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+
+        return np.concatenate([
+            self.list_rows[self.list_offsets[list_id]:self.list_offsets[list_id + 1]] for list_id in probed
+        ])
+
+    @staticmethod
+    def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        # argmax(x.c - |c|^2 / 2) == argmin(|x - c|^2), without materializing the distances.
+        scores = vectors @ centroids.T - 0.5 * np.sum(centroids ** 2, axis=1)
+        return np.argmax(scores, axis=1).astype(np.int32)
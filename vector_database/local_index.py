@@ -0,0 +1,607 @@
+import os
+import json
+import time
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+from vector_database.ivf_index import IVFIndex
+from vector_database.quantized_vectors import QuantizedVectors
+
+ROOT_DIR = Path(__file__).parent.parent
+LOCAL_INDEXES_DIR = ROOT_DIR / "vector_database" / "local_indexes"
+
+
+class LocalIndex:
+    def __init__(self,
+                 directory,
+                 dimension: int,
+                 metric: str = "dotproduct",
+                 ann: str = None,
+                 n_probe: int = 8,
+                 n_lists: int = None,
+                 quantization: str = None,
+                 search_dimension: int = None,
+                 rescore_factor: int = 4
+                 ) -> None:
+        """
+        This class is an in-process replacement for a Pinecone index. It exposes the subset of the Pinecone Index API
+        used in this project (upsert, query, fetch, list, delete, describe_index_stats), so it can be handed to
+        PineconeVectorStore / PineconeHybridSearchRetriever unchanged.
+
+        Dense vectors are kept in a float32 memory-mapped matrix (vectors.f32), ids/metadata/sparse vectors in a json
+        snapshot next to it (records.json). Writes only append their records to records.log, replayed on load, so a
+        write costs what it writes whatever the size of the index: flush() (or close()) folds the log into the
+        snapshot. Queries are scored for the whole batch with a single matrix product.
+
+        With ann="ivf" queries only score the rows of the n_probe closest IVF lists (see IVFIndex), use
+        evaluate_recall to measure what a given n_probe costs in recall@k against exact search.
+
+        With quantization ("int8" / "binary") and/or a search_dimension below dimension, a compact copy of the
+        vectors is kept in memory (see QuantizedVectors): queries take top_k * rescore_factor candidates from it and
+        rescore them with the full float32 vectors, read from the memmap only for those rows. evaluate_recall also
+        reports the memory of the searched representation.
+        """
+        self.check_metric(metric)
+        self.check_ann(ann)
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.directory / "vectors.f32"
+        self.records_path = self.directory / "records.json"
+        self.log_path = self.directory / "records.log"
+
+        self.dimension = dimension
+        self.metric = metric
+
+        self.ids: List[str] = []
+        self.metadata: List[dict] = []
+        self.sparse_values: List[Optional[dict]] = []
+        self.alive: List[bool] = []
+        self.id_to_row: Dict[str, int] = {}
+        self.logged_rows = set()
+        self.capacity = 0
+
+        self.load()
+
+        self.ann = IVFIndex(
+            directory=self.directory, metric=self.metric, n_lists=n_lists, n_probe=n_probe
+        ) if ann == "ivf" else None
+        self.sync_ann()
+
+        self.rescore_factor = rescore_factor
+        self.compact = None
+        if quantization is not None or (search_dimension or dimension) < dimension:
+            # Derived from the float32 vectors, rebuilt in one pass when the index is opened.
+            self.compact = QuantizedVectors(dimension, quantization=quantization, search_dimension=search_dimension)
+            self.compact.build(self.vectors[:len(self.ids)])
+
+    @staticmethod
+    def check_metric(metric: str) -> None:
+        if metric not in ["dotproduct", "cosine"]:
+            raise ValueError("The local index metric must be 'dotproduct' or 'cosine'.")
+
+    @staticmethod
+    def check_ann(ann: str) -> None:
+        if ann not in [None, "ivf"]:
+            raise ValueError("The local index ann mode must be None (exact search) or 'ivf'.")
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+    def load(self) -> None:
+        if self.records_path.exists():
+            with open(self.records_path, "r") as f:
+                records = json.load(f)
+
+            if records["dimension"] != self.dimension:
+                raise ValueError(
+                    f"Local index at {self.directory} has dimension {records['dimension']}, expected {self.dimension}."
+                )
+            self.metric = records["metric"]
+            self.ids = records["ids"]
+            self.metadata = records["metadata"]
+            self.sparse_values = records["sparse_values"]
+            self.alive = records["alive"]
+
+        self.replay_log()
+        self.id_to_row = {_id: row for row, _id in enumerate(self.ids) if self.alive[row]}
+        # The vectors file is grown before any row is written to it, its size is the capacity.
+        if self.vectors_path.exists():
+            self.capacity = os.path.getsize(self.vectors_path) // (self.dimension * 4)
+
+        self.open_vectors()
+
+    def replay_log(self) -> None:
+        """
+        Apply the writes appended to records.log since the last snapshot. Replaying an entry twice gives the same
+        records, and a torn last line (crash in the middle of an append) is ignored. The replayed rows are kept in
+        logged_rows: the ann index was last persisted with the snapshot, so they may be stale in it.
+        """
+        if not self.log_path.exists():
+            return
+
+        with open(self.log_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+
+                if entry["op"] == "upsert":
+                    for _id, row, metadata, sparse_values in entry["records"]:
+                        while len(self.ids) <= row:
+                            self.ids.append(None)
+                            self.metadata.append(None)
+                            self.sparse_values.append(None)
+                            self.alive.append(False)
+                        self.ids[row], self.metadata[row], self.sparse_values[row] = _id, metadata, sparse_values
+                        self.alive[row] = True
+                        self.logged_rows.add(row)
+                else:
+                    for row in entry["rows"]:
+                        self.alive[row] = False
+                        self.metadata[row] = None
+                        self.sparse_values[row] = None
+
+    def append_log(self, entry: dict) -> None:
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+
+    def flush(self) -> None:
+        """
+        Write the records snapshot and empty the log. Not needed for durability, only to keep the log short.
+        """
+        self.vectors.flush()
+
+        records = {
+            "dimension": self.dimension,
+            "metric": self.metric,
+            "capacity": self.capacity,
+            "ids": self.ids,
+            "metadata": self.metadata,
+            "sparse_values": self.sparse_values,
+            "alive": self.alive
+        }
+
+        # Write in a temp file and rename, so a crash never leaves a half written records file. A crash before the
+        # log is emptied only replays it again on top of the snapshot.
+        tmp_path = self.records_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(records, f, default=str)
+        os.replace(tmp_path, self.records_path)
+        open(self.log_path, "w").close()
+        self.logged_rows = set()
+
+        if self.ann is not None:
+            self.ann.persist()
+
+    def close(self) -> None:
+        self.flush()
+
+    def sync_ann(self) -> None:
+        """
+        Bring the ann index up to date with rows written while it was disabled (or before it was ever trained), and
+        with the rows overwritten since its last persist, replayed from the log.
+        """
+        n_rows = len(self.ids)
+        if self.ann is None or n_rows == 0:
+            return
+
+        stale_rows = np.union1d(
+            np.arange(len(self.ann.assignments), n_rows),
+            np.fromiter(self.logged_rows, dtype=np.int64, count=len(self.logged_rows))
+        ).astype(np.int64)
+        if len(stale_rows) == 0:
+            return
+
+        self.ann.add(stale_rows, self.vectors[stale_rows], self.vectors[:n_rows])
+        self.ann.persist()
+
+    def open_vectors(self) -> None:
+        if self.capacity == 0:
+            self.capacity = 1024
+            with open(self.vectors_path, "wb") as f:
+                f.truncate(self.capacity * self.dimension * 4)
+
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dimension))
+        self.refresh_views()
+
+    def grow(self, needed_rows: int) -> None:
+        """
+        Double the memory-mapped file until it fits the needed rows (amortized O(1) appends).
+        """
+        new_capacity = self.capacity
+        while new_capacity < needed_rows:
+            new_capacity *= 2
+
+        self.vectors.flush()
+        del self.vectors
+        os.truncate(self.vectors_path, new_capacity * self.dimension * 4)
+        self.capacity = new_capacity
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dimension))
+
+    def refresh_views(self) -> None:
+        """
+        Recompute the derived arrays used at query time (alive mask, norms, sparse postings) for all the rows.
+        """
+        self.alive_mask = np.zeros(self.capacity, dtype=bool)
+        self.norms = np.ones(self.capacity, dtype=np.float32) if self.metric == "cosine" else None
+        self.update_views(np.arange(len(self.ids)))
+
+    def update_views(self, rows: np.ndarray) -> None:
+        """
+        Update the derived arrays for the written rows only. They are sized like the vectors file, so rows past
+        len(self.ids) are unused.
+        """
+        if len(self.alive_mask) < self.capacity:
+            self.alive_mask = np.concatenate([self.alive_mask, np.zeros(self.capacity - len(self.alive_mask), bool)])
+            if self.norms is not None:
+                self.norms = np.concatenate([self.norms, np.ones(self.capacity - len(self.norms), np.float32)])
+
+        if len(rows):
+            self.alive_mask[rows] = [self.alive[row] for row in rows]
+            if self.norms is not None:
+                norms = np.linalg.norm(self.vectors[rows], axis=1)
+                self.norms[rows] = np.where(norms == 0, 1.0, norms)
+
+        self.sparse_postings = None
+
+    def build_sparse_postings(self) -> Dict[int, tuple]:
+        """
+        Inverted view of the stored sparse vectors: term index -> (rows, values). Built lazily on the first hybrid
+        query after a write.
+        """
+        postings = {}
+        for row, sparse in enumerate(self.sparse_values):
+            if not sparse or not self.alive[row]:
+                continue
+            for term, value in zip(sparse["indices"], sparse["values"]):
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(row)
+                postings[term][1].append(value)
+
+        self.sparse_postings = {
+            term: (np.array(rows, dtype=np.int64), np.array(values, dtype=np.float32))
+            for term, (rows, values) in postings.items()
+        }
+        return self.sparse_postings
+
+    # ------------------------------------------------------------------
+    # Pinecone Index API
+    # ------------------------------------------------------------------
+    def upsert(self, vectors: List, namespace: str = None, **kwargs) -> dict:
+        """
+        Accept the same shapes as Pinecone: dicts with id/values/metadata/sparse_values or (id, values, metadata)
+        tuples.
+        """
+        records = [self.normalize_record(vector) for vector in vectors]
+
+        new_ids = {record["id"] for record in records if record["id"] not in self.id_to_row}
+        if len(self.ids) + len(new_ids) > self.capacity:
+            self.grow(len(self.ids) + len(new_ids))
+
+        rows = []
+        for record in records:
+            row = self.id_to_row.get(record["id"])
+            if row is None:
+                row = len(self.ids)
+                self.ids.append(record["id"])
+                self.metadata.append(None)
+                self.sparse_values.append(None)
+                self.alive.append(True)
+                self.id_to_row[record["id"]] = row
+
+            self.vectors[row] = np.asarray(record["values"], dtype=np.float32)
+            self.metadata[row] = record["metadata"]
+            self.sparse_values[row] = record["sparse_values"]
+            rows.append(row)
+
+        rows = np.array(rows, dtype=np.int64)
+        if self.ann is not None:
+            self.ann.add(rows, self.vectors[rows], self.vectors[:len(self.ids)])
+        if self.compact is not None:
+            self.compact.update(rows, self.vectors[rows])
+
+        # Vectors first, so a logged record always has its vector on disk.
+        self.vectors.flush()
+        self.append_log({"op": "upsert", "records": [
+            [self.ids[row], int(row), self.metadata[row], self.sparse_values[row]] for row in rows
+        ]})
+        self.update_views(rows)
+
+        return {"upserted_count": len(records)}
+
+    def query(self,
+              vector: List[float] = None,
+              sparse_vector: dict = None,
+              top_k: int = 10,
+              include_metadata: bool = False,
+              include_values: bool = False,
+              namespace: str = None,
+              filter: dict = None,
+              id: str = None,
+              **kwargs) -> dict:
+        if vector is None and id is not None:
+            if id not in self.id_to_row:
+                raise ValueError(f"Id {id} is not in the local index at {self.directory}.")
+            vector = self.vectors[self.id_to_row[id]]
+
+        matches = self.query_batch(
+            vectors=[vector],
+            sparse_vectors=[sparse_vector] if sparse_vector else None,
+            top_k=top_k,
+            include_metadata=include_metadata,
+            include_values=include_values,
+            filter=filter
+        )[0]
+
+        return {"matches": matches, "namespace": namespace or ""}
+
+    def query_batch(self,
+                    vectors,
+                    sparse_vectors: List[dict] = None,
+                    top_k: int = 10,
+                    include_metadata: bool = True,
+                    include_values: bool = False,
+                    filter: dict = None,
+                    exact: bool = False,
+                    n_probe: int = None) -> List[List[dict]]:
+        """
+        Score a whole batch of queries in one vectorized call and return the top_k matches of each one.
+        """
+        queries = np.asarray(vectors, dtype=np.float32)
+        filter_mask = self.filter_mask(filter) if filter else None
+
+        use_ann = self.ann is not None and self.ann.is_trained
+        if exact or (not use_ann and self.compact is None):
+            scores = self.score(queries, sparse_vectors)
+            if filter_mask is not None:
+                scores[:, ~filter_mask] = -np.inf
+
+            return [
+                self.to_matches(query_scores, top_k, include_metadata, include_values)
+                for query_scores in scores
+            ]
+
+        matches = []
+        for query_idx, query in enumerate(queries):
+            sparse_vector = sparse_vectors[query_idx] if sparse_vectors else None
+            rows = self.ann.candidates(query, n_probe) if use_ann else None
+
+            # Rows that share a term with the sparse query are candidates too, otherwise the sparse half of a hybrid
+            # query could only rerank what the dense probe already found.
+            if sparse_vector and use_ann:
+                rows = np.union1d(rows, self.sparse_candidates(sparse_vector))
+
+            if self.compact is not None:
+                rows = self.compact_candidates(query, sparse_vector, rows, top_k * self.rescore_factor, filter_mask)
+            elif rows is None:
+                rows = np.arange(len(self.ids))
+
+            scores = self.score(query[None, :], [sparse_vector] if sparse_vector else None, rows)[0]
+            if filter_mask is not None:
+                scores[~filter_mask[rows]] = -np.inf
+
+            matches.append(self.to_matches(scores, top_k, include_metadata, include_values, rows))
+        return matches
+
+    def compact_candidates(self,
+                           query: np.ndarray,
+                           sparse_vector: Optional[dict],
+                           rows: np.ndarray,
+                           n_candidates: int,
+                           filter_mask: Optional[np.ndarray]) -> np.ndarray:
+        """
+        First phase of a compact search: the n_candidates best rows (of all rows if rows is None) by approximate score.
+        """
+        scores = self.compact.score(query[None, :], rows)[0]
+        if rows is None:
+            rows = np.arange(len(scores))
+        if sparse_vector:
+            scores += self.sparse_scores([sparse_vector], len(self.ids))[0, rows]
+
+        scores[~self.alive_mask[rows]] = -np.inf
+        if filter_mask is not None:
+            scores[~filter_mask[rows]] = -np.inf
+
+        if len(rows) <= n_candidates:
+            return rows
+        return rows[np.argpartition(-scores, n_candidates - 1)[:n_candidates]]
+
+    def evaluate_recall(self, queries, top_k: int = 10, n_probe: int = None) -> dict:
+        """
+        Recall@k of the ann search against exact search over the same queries, with per query latency percentiles
+        of both, so the n_probe trade-off can be chosen explicitly.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+
+        def timed_search(**kwargs):
+            latencies, results = [], []
+            for query in queries:
+                start = time.perf_counter()
+                result = self.query_batch([query], top_k=top_k, include_metadata=False, **kwargs)[0]
+                latencies.append((time.perf_counter() - start) * 1000)
+                results.append({match["id"] for match in result})
+            return results, np.array(latencies)
+
+        exact_results, exact_latencies = timed_search(exact=True)
+        ann_results, ann_latencies = timed_search(n_probe=n_probe)
+
+        hits = sum(len(exact & approx) for exact, approx in zip(exact_results, ann_results))
+        total = sum(len(exact) for exact in exact_results)
+
+        return {
+            f"recall@{top_k}": hits / total if total else 1.0,
+            "n_probe": n_probe or (self.ann.n_probe if self.ann else None),
+            "ann_p50_ms": float(np.percentile(ann_latencies, 50)),
+            "ann_p99_ms": float(np.percentile(ann_latencies, 99)),
+            "exact_p50_ms": float(np.percentile(exact_latencies, 50)),
+            "exact_p99_ms": float(np.percentile(exact_latencies, 99)),
+            "search_memory_mb": (self.compact.nbytes if self.compact is not None
+                                 else len(self.ids) * self.dimension * 4) / 2 ** 20
+        }
+
+    def fetch(self, ids: List[str], namespace: str = None, **kwargs) -> dict:
+        vectors = {}
+        for _id in ids:
+            row = self.id_to_row.get(_id)
+            if row is None:
+                continue
+            vectors[_id] = {
+                "id": _id,
+                "values": self.vectors[row].tolist(),
+                "metadata": self.metadata[row],
+                "sparse_values": self.sparse_values[row]
+            }
+        return {"vectors": vectors, "namespace": namespace or ""}
+
+    def list(self, prefix: str = None, limit: int = 100, namespace: str = None, **kwargs) -> Iterator[List[str]]:
+        """
+        Yield pages of ids, like Pinecone's index.list().
+        """
+        ids = [_id for _id in self.id_to_row if prefix is None or _id.startswith(prefix)]
+        for start in range(0, len(ids), limit):
+            yield ids[start:start + limit]
+
+    def delete(self, ids: List[str] = None, delete_all: bool = False, namespace: str = None, **kwargs) -> dict:
+        ids = list(self.id_to_row) if delete_all else (ids or [])
+        rows = []
+        for _id in ids:
+            row = self.id_to_row.pop(_id, None)
+            if row is None:
+                continue
+            self.alive[row] = False
+            self.metadata[row] = None
+            self.sparse_values[row] = None
+            rows.append(row)
+
+        if rows:
+            self.append_log({"op": "delete", "rows": rows})
+            self.update_views(np.array(rows, dtype=np.int64))
+        return {}
+
+    def describe_index_stats(self, **kwargs) -> dict:
+        return {
+            "dimension": self.dimension,
+            "index_fullness": 0.0,
+            "total_vector_count": len(self.id_to_row),
+            "namespaces": {"": {"vector_count": len(self.id_to_row)}}
+        }
+
+    # ------------------------------------------------------------------
+    # Scoring helpers
+    # ------------------------------------------------------------------
+    def score(self, queries: np.ndarray, sparse_vectors: List[dict] = None, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Scores of every query against every stored row, or only against the given rows.
+        """
+        n_rows = len(self.ids)
+        if n_rows == 0:
+            return np.zeros((len(queries), 0), dtype=np.float32)
+
+        if rows is None:
+            rows = slice(0, n_rows)
+
+        scores = queries @ self.vectors[rows].T
+
+        if self.metric == "cosine":
+            query_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            scores /= np.where(query_norms == 0, 1.0, query_norms) * self.norms[rows]
+
+        # Pinecone dotproduct indexes score hybrid queries as dense dot product + sparse dot product.
+        if sparse_vectors:
+            scores += self.sparse_scores(sparse_vectors, n_rows)[:, rows]
+
+        scores[:, ~self.alive_mask[rows]] = -np.inf
+        return scores
+
+    def sparse_candidates(self, sparse_vector: dict) -> np.ndarray:
+        postings = self.sparse_postings if self.sparse_postings is not None else self.build_sparse_postings()
+        term_rows = [postings[term][0] for term in sparse_vector["indices"] if term in postings]
+        return np.unique(np.concatenate(term_rows)) if term_rows else np.zeros(0, dtype=np.int64)
+
+    def sparse_scores(self, sparse_vectors: List[dict], n_rows: int) -> np.ndarray:
+        postings = self.sparse_postings if self.sparse_postings is not None else self.build_sparse_postings()
+
+        scores = np.zeros((len(sparse_vectors), n_rows), dtype=np.float32)
+        for query_idx, sparse in enumerate(sparse_vectors):
+            if not sparse:
+                continue
+            for term, value in zip(sparse["indices"], sparse["values"]):
+                if term in postings:
+                    rows, values = postings[term]
+                    scores[query_idx, rows] += value * values
+        return scores
+
+    def filter_mask(self, filter: dict) -> np.ndarray:
+        """
+        Supports equality ({"key": value} / {"key": {"$eq": value}}) and {"key": {"$in": [...]}} filters.
+        """
+        def matches(metadata):
+            if metadata is None:
+                return False
+            for key, condition in filter.items():
+                value = metadata.get(key)
+                if isinstance(condition, dict):
+                    if "$eq" in condition and value != condition["$eq"]:
+                        return False
+                    if "$in" in condition and value not in condition["$in"]:
+                        return False
+                elif value != condition:
+                    return False
+            return True
+
+        return np.array([matches(metadata) for metadata in self.metadata], dtype=bool)
+
+    def to_matches(self,
+                   scores: np.ndarray,
+                   top_k: int,
+                   include_metadata: bool,
+                   include_values: bool,
+                   rows: np.ndarray = None) -> List[dict]:
+        """
+        Top_k matches of one query. When scores only cover a subset of rows, rows maps score positions to rows.
+        """
+        n_candidates = min(top_k, int(np.isfinite(scores).sum()))
+        if n_candidates == 0:
+            return []
+
+        # argpartition is O(n), we only sort the top_k candidates.
+        top_rows = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        top_rows = top_rows[np.argsort(-scores[top_rows])]
+
+        matches = []
+        for position in top_rows:
+            row = position if rows is None else rows[position]
+            match = {"id": self.ids[row], "score": float(scores[position])}
+            if include_metadata:
+                match["metadata"] = dict(self.metadata[row] or {})
+            if include_values:
+                match["values"] = self.vectors[row].tolist()
+            matches.append(match)
+        return matches
+
+    @staticmethod
+    def normalize_record(vector) -> dict:
+        if isinstance(vector, dict):
+            return {
+                "id": vector["id"],
+                "values": vector["values"],
+                "metadata": vector.get("metadata") or {},
+                "sparse_values": vector.get("sparse_values")
+            }
+
+        _id, values, *rest = vector
+        return {"id": _id, "values": values, "metadata": rest[0] if rest else {}, "sparse_values": None}
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = LocalIndex(directory=tmp_dir, dimension=4, metric="cosine")
+        index.upsert(vectors=[
+            {"id": "a", "values": [1, 0, 0, 0], "metadata": {"text": "first"}},
+            {"id": "b", "values": [0, 1, 0, 0], "metadata": {"text": "second"}},
+        ])
+        print(index.query(vector=[0.9, 0.1, 0, 0], top_k=1, include_metadata=True))
@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import mmh3
+import threading
+import numpy as np
+from pathlib import Path
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 128, shingle_size: int = 4, seed: int = 1) -> None:
+        """
+        MinHash signatures of texts over their word shingle_size-grams: the share of equal positions between two
+        signatures estimates the Jaccard similarity of the two shingle sets.
+        """
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        generator = np.random.RandomState(seed)
+        # a, b < 2^31 and hashes < 2^32, so a * hash + b fits in 64 bits.
+        self.a = generator.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self.b = generator.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+
+    def shingles(self, text: str) -> List[str]:
+        words = re.findall(r"\w+", text.lower())
+        if len(words) <= self.shingle_size:
+            return [" ".join(words)]
+        return [" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)]
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.array([mmh3.hash(shingle, signed=False) for shingle in set(self.shingles(text))], dtype=np.uint64)
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % MERSENNE_PRIME).min(axis=1)
+
+
+class NearDuplicateIndex:
+    def __init__(self,
+                 directory,
+                 threshold: float = 0.9,
+                 num_perm: int = 128
+                 ) -> None:
+        """
+        LSH index of the MinHash signatures of the chunks in a vector index, to find near duplicate chunks
+        (boilerplate, reference lists, several versions of the same paper) before they are embedded.
+
+        Signatures are split in bands: chunks sharing one band are candidates, a candidate is a duplicate when the
+        estimated Jaccard similarity is at least threshold. The bands are chosen so that pairs around the threshold
+        are very likely to share one.
+
+        self.duplicates maps every chunk dropped as a duplicate to the chunk kept in its place, for auditing.
+        """
+        self.directory = Path(directory)
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm=num_perm)
+        self.n_bands, self.band_size = self.lsh_parameters(threshold, num_perm)
+        self.lock = threading.Lock()
+
+        self.ids: List[Optional[str]] = []
+        self.sources: List[str] = []
+        # Grown by doubling, rows past len(self.ids) are unused.
+        self.signatures = np.zeros((1024, num_perm), dtype=np.uint64)
+        self.positions: Dict[str, int] = {}
+        self.buckets = [defaultdict(list) for _ in range(self.n_bands)]
+        self.duplicates: Dict[str, dict] = {}
+        self.excluded = set()
+
+        if (self.directory / "signatures.npy").exists():
+            with open(self.directory / "chunks.json", "r") as f:
+                chunks = json.load(f)
+            with open(self.directory / "duplicates.json", "r") as f:
+                self.duplicates = json.load(f)
+            self.add([_id for _id, _ in chunks], [source for _, source in chunks],
+                     np.load(self.directory / "signatures.npy"))
+
+    @staticmethod
+    def lsh_parameters(threshold: float, num_perm: int) -> Tuple[int, int]:
+        # The largest bands (fewest candidates to verify) that still catch 99% of the pairs at the threshold.
+        for rows in sorted((rows for rows in range(1, num_perm + 1) if num_perm % rows == 0), reverse=True):
+            n_bands = num_perm // rows
+            if 1 - (1 - threshold ** rows) ** n_bands >= 0.99:
+                return n_bands, rows
+        return num_perm, 1
+
+    def band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.band_size:(i + 1) * self.band_size].tobytes() for i in range(self.n_bands)]
+
+    def add(self, ids: List[str], sources: List[str], signatures: np.ndarray) -> None:
+        start = len(self.ids)
+        if start + len(ids) > len(self.signatures):
+            capacity = max(2 * len(self.signatures), start + len(ids))
+            grown = np.zeros((capacity, self.hasher.num_perm), dtype=np.uint64)
+            grown[:start] = self.signatures[:start]
+            self.signatures = grown
+        self.signatures[start:start + len(ids)] = signatures
+        for row, (_id, source, signature) in enumerate(zip(ids, sources, signatures), start=start):
+            self.ids.append(_id)
+            self.sources.append(source)
+            self.positions[_id] = row
+            for band, key in enumerate(self.band_keys(signature)):
+                self.buckets[band][key].append(row)
+
+    def remove(self, ids: List[str]) -> None:
+        """
+        Forget chunks deleted from the vector index (their bucket entries are skipped until the next load).
+        """
+        with self.lock:
+            for _id in ids:
+                row = self.positions.pop(_id, None)
+                if row is not None:
+                    self.ids[row] = None
+                self.duplicates.pop(_id, None)
+
+    def exclude(self, ids: List[str]) -> None:
+        """
+        Chunks that no duplicate can match for now, e.g. the current chunks of files being re-ingested: the new
+        version of a file must not be dropped as a duplicate of its old version.
+        """
+        with self.lock:
+            self.excluded = set(ids)
+
+    def query(self, signature: np.ndarray) -> Tuple[Optional[int], float]:
+        candidates = {row for band, key in enumerate(self.band_keys(signature))
+                      for row in self.buckets[band].get(key, ())
+                      if self.ids[row] is not None and self.ids[row] not in self.excluded}
+        if not candidates:
+            return None, 0.0
+
+        rows = np.fromiter(candidates, dtype=np.int64)
+        similarities = (self.signatures[rows] == signature).mean(axis=1)
+        best = int(np.argmax(similarities))
+        return int(rows[best]), float(similarities[best])
+
+    def deduplicate(self, texts: List[str], ids: List[str], sources: List[str]) -> List[bool]:
+        """
+        Whether each chunk must be kept. Kept chunks are added to the index, the others to self.duplicates. A chunk
+        already in the index under its own id (same content as in a previous run) is kept.
+        """
+        signatures = [self.hasher.signature(text) for text in texts]
+
+        keep = []
+        with self.lock:
+            for signature, _id, source in zip(signatures, ids, sources):
+                if _id in self.positions:
+                    keep.append(True)
+                    continue
+
+                match, similarity = self.query(signature)
+                if match is not None and similarity >= self.threshold:
+                    self.duplicates[_id] = {"source": source, "duplicate_of": self.ids[match],
+                                            "duplicate_of_source": self.sources[match],
+                                            "similarity": round(similarity, 4)}
+                    keep.append(False)
+                else:
+                    self.duplicates.pop(_id, None)
+                    self.add([_id], [source], signature[None, :])
+                    keep.append(True)
+        return keep
+
+    def orphans(self) -> Dict[str, dict]:
+        """
+        Duplicates whose kept chunk is no longer in the index: their content is missing from the vector index.
+        """
+        with self.lock:
+            return {_id: entry for _id, entry in self.duplicates.items() if entry["duplicate_of"] not in self.positions}
+
+    def save(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            rows = [row for row, _id in enumerate(self.ids) if _id is not None]
+            signatures = self.signatures[rows]
+            chunks = json.dumps([[self.ids[row], self.sources[row]] for row in rows])
+            duplicates = json.dumps(self.duplicates, indent=2)
+
+        for name, write in (("signatures.npy", lambda f: np.save(f, signatures)),
+                            ("chunks.json", lambda f: f.write(chunks.encode("utf-8"))),
+                            ("duplicates.json", lambda f: f.write(duplicates.encode("utf-8")))):
+            tmp_path = self.directory / f"{name}.tmp"
+            with open(tmp_path, "wb") as f:
+                write(f)
+            os.replace(tmp_path, self.directory / name)
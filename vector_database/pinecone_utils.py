@@ -1,9 +1,15 @@
-from uuid import uuid4
+import time
+import threading
 from pinecone import Pinecone, ServerlessSpec
 from langchain_core.documents import Document
 from langchain_pinecone import PineconeVectorStore
-from preprocessment.embedding.embedding_config import EmbeddingConfig
+from preprocessment.embedding.embedding_config import EmbeddingConfig, MODELS_VECTOR_DIMENSION
+from vector_database.local_index import LocalIndex, LOCAL_INDEXES_DIR
+from vector_database.bm25_index import BM25Index, SPARSE_INDEXES_DIR
+from vector_database.ingestion_manifest import MANIFESTS_DIR
+from vector_database.ingestion_journal import IngestionJournal
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 class PineconeUtils:
@@ -11,17 +17,53 @@ class PineconeUtils:
                  index_name: str,
                  embedding_model_name: str,
                  embedding_provider: str,
-                 metric: str
+                 metric: str,
+                 backend: str = "pinecone",
+                 ann: str = None,
+                 n_probe: int = 8,
+                 quantization: str = None,
+                 search_dimension: int = None,
+                 rescore_factor: int = 4
                  ):
         """
         This class is responsible for connecting to a Pinecone index and make operations on that.
+
+        With backend="local" the same operations run against an in-process LocalIndex stored under
+        vector_database/local_indexes/<index_name>, so nothing goes through the network. ann="ivf" turns on
+        approximate search in the local index, n_probe is its recall/latency knob. quantization, search_dimension and
+        rescore_factor set the compact copy of the vectors the local index searches first (see LocalIndex).
+
+        The BM25 stats of the index (see BM25Index) are kept next to it and updated on every encode_sparse call.
+        An index version counter is kept next to the manifest too: ingestions bump it when they change the index,
+        so retrievers know when their cached results are stale.
         """
+        self.check_backend(backend)
+        self.backend = backend
         self.index_name = index_name
         self.metric = metric
-        self.pc_client = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
         self.embedding_config = EmbeddingConfig(embedding_model=embedding_model_name, provider=embedding_provider)
         self.embedding_model = self.embedding_config.get_embedding_model()
 
+        self.sparse_index = None
+        # Guards the BM25 stats and LocalIndex writes when chunks are inserted from several threads.
+        self.write_lock = threading.Lock()
+        self.sparse_index_path = LOCAL_INDEXES_DIR / index_name / "sparse.bm25" if self.backend == "local" \
+                                                        else SPARSE_INDEXES_DIR / f"{index_name}.bm25"
+        self.manifest_path = LOCAL_INDEXES_DIR / index_name / "manifest.json" if self.backend == "local" \
+                                                        else MANIFESTS_DIR / f"{index_name}.json"
+        self.journal_path = self.manifest_path.with_name(f"{self.manifest_path.stem}.journal.sqlite")
+        self.near_duplicates_path = self.manifest_path.with_name(f"{self.manifest_path.stem}.near_duplicates")
+        self.version_path = self.manifest_path.with_name(f"{self.manifest_path.stem}.version")
+
+        if self.backend == "local":
+            self.local_index_options = {"ann": ann, "n_probe": n_probe, "quantization": quantization,
+                                        "search_dimension": search_dimension, "rescore_factor": rescore_factor}
+            self.index = self.open_local_index()
+            self.vector_store = None
+            return
+
+        self.pc_client = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
+
         if self.index_exists(self.index_name):
             print(f"Index {self.index_name} already exists, loaded.")
         else:
@@ -31,10 +73,195 @@ class PineconeUtils:
         self.index = self.pc_client.Index(index_name)
         self.vector_store = PineconeVectorStore(index=self.index, embedding=self.embedding_model)
 
-    def insert_documents(self, documents: List[Document]) -> None:
-        uuids = [str(uuid4()) for _ in range(len(documents))]
+    @staticmethod
+    def check_backend(backend: str) -> None:
+        if backend not in ["pinecone", "local"]:
+            raise ValueError("The vector backend must be 'pinecone' or 'local'.")
+
+    def count_terms(self, documents: List[Document], n_jobs: int = 1) -> list:
+        """
+        Tokenize the chunks for the BM25 stats (see BM25Index.count_terms), spread over n_jobs processes.
+        """
+        with self.write_lock:
+            sparse_index = self.load_sparse_index()
+        return sparse_index.count_terms([doc.page_content for doc in documents], n_jobs=n_jobs)
+
+    def encode_sparse(self,
+                      documents: List[Document],
+                      ids: List[str],
+                      n_jobs: int = 1,
+                      term_counts: list = None) -> List[dict]:
+        """
+        Add the chunks to the BM25 stats and return their sparse vectors. The stats are updated first, so the
+        new chunks are weighted with the avgdl they are part of. term_counts can be passed when the chunks were
+        already tokenized (see count_terms). Safe to call from several threads.
+        """
+        texts = [doc.page_content for doc in documents]
+        with self.write_lock:
+            sparse_index = self.load_sparse_index()
+        term_counts = term_counts if term_counts is not None else sparse_index.count_terms(texts, n_jobs=n_jobs)
+
+        with self.write_lock:
+            # Re-upserted ids must not be counted twice in the document frequencies.
+            sparse_index.remove_documents(ids)
+            sparse_index.add_documents(texts, ids=ids, metadatas=[doc.metadata for doc in documents],
+                                       term_counts=term_counts)
+            return sparse_index.encode_documents(texts, term_counts=term_counts)
+
+    def upsert_records(self,
+                       records: List[dict],
+                       batch_size: int = 50,
+                       upsert_workers: int = 8,
+                       journal: IngestionJournal = None) -> None:
+        if self.backend == "local":
+            # LocalIndex writes are in-process, a single call is already one vectorized write.
+            with self.write_lock:
+                self.index.upsert(vectors=records)
+            if journal is not None:
+                journal.mark_upserted([record["id"] for record in records])
+            return
+
+        def upsert_batch(batch):
+            self.index.upsert(vectors=batch)
+            if journal is not None:
+                journal.mark_upserted([record["id"] for record in batch])
+
+        batches = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+        with ThreadPoolExecutor(max_workers=upsert_workers) as executor:
+            list(executor.map(upsert_batch, batches))
+
+    def save_sparse_index(self) -> None:
+        with self.write_lock:
+            self.load_sparse_index().save(self.sparse_index_path)
+
+    def flush_index(self) -> None:
+        """
+        Fold the local index write log into its records snapshot (Pinecone writes need no flush).
+        """
+        if self.backend == "local":
+            with self.write_lock:
+                self.index.flush()
+
+    def delete_documents(self, ids: List[str], batch_size: int = 1000) -> None:
+        """
+        Delete chunks from the index (Pinecone accepts up to 1000 ids per delete) and from the BM25 stats.
+        """
+        for i in range(0, len(ids), batch_size):
+            self.index.delete(ids=ids[i:i + batch_size])
+
+        with self.write_lock:
+            self.load_sparse_index().remove_documents(ids)
+        self.save_sparse_index()
+
+    def index_version(self) -> int:
+        try:
+            return int(self.version_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump_index_version(self) -> int:
+        version = self.index_version() + 1
+        self.version_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.version_path.with_suffix(".tmp")
+        tmp_path.write_text(str(version))
+        os.replace(tmp_path, self.version_path)
+        return version
+
+    def open_local_index(self) -> LocalIndex:
+        return LocalIndex(
+            directory=LOCAL_INDEXES_DIR / self.index_name,
+            dimension=self.setup_dimension(self.embedding_config.embedding_model_name),
+            metric=self.metric,
+            **self.local_index_options
+        )
+
+    def reload_index(self):
+        """
+        Reopen the local index from its files, to see the writes of another process (its snapshot and write log
+        are replayed, the ann and compact views rebuilt). Pinecone indexes are always up to date.
+        """
+        if self.backend == "local":
+            with self.write_lock:
+                self.index = self.open_local_index()
+        return self.index
+
+    def reload_sparse_index(self) -> BM25Index:
+        """
+        Drop the BM25 stats loaded in memory and load the saved ones (after another process ingested documents).
+        """
+        with self.write_lock:
+            self.sparse_index = None
+            return self.load_sparse_index()
+
+    def load_sparse_index(self) -> BM25Index:
+        """
+        Load the BM25 stats of this index. Indexes created before the stats were maintained at ingestion time are
+        bootstrapped once from a crawl of the index and saved.
+        """
+        if self.sparse_index is not None:
+            return self.sparse_index
+
+        if self.sparse_index_path.exists():
+            self.sparse_index = BM25Index.load(self.sparse_index_path)
+            return self.sparse_index
+
+        if self.index.describe_index_stats()["total_vector_count"] == 0:
+            self.sparse_index = BM25Index()
+        else:
+            self.sparse_index = self.crawl_sparse_index()
+
+        self.sparse_index.save(self.sparse_index_path)
+        return self.sparse_index
 
-        self.vector_store.add_documents(documents=documents, ids=uuids)
+    def crawl_sparse_index(self) -> BM25Index:
+        """
+        Fit BM25 stats on every chunk already stored in the index. Only used once, for indexes populated before
+        the ingestion maintained the stats.
+        """
+        print(f"Index {self.index_name} has no BM25 stats yet, fitting them on the stored chunks...")
+
+        # put all document ids in a list
+        ids = []
+        for id_list in self.index.list():
+            ids.extend(id_list)
+
+        # define a chunker function because we can load all vectors at once, we receive a HTTP error message
+        def chunker(seq, size):
+            return (seq[i:i + size] for i in range(0, len(seq), size))
+
+        # We getting 100 documents per request
+        chunk_size = 100
+        all_vectors = {}
+
+        for chunk in chunker(ids, chunk_size):
+            result = self.index.fetch(ids=chunk)
+            all_vectors.update(result.get("vectors", {}))
+
+        # the corpus is basically the text of the documents (the rest of the metadata is kept for local search):
+        vectors = [v for v in all_vectors.values() if "metadata" in v and "text" in v["metadata"]]
+
+        return BM25Index.fit(
+            texts=[v["metadata"]["text"] for v in vectors],
+            ids=[v["id"] for v in vectors],
+            metadatas=[{key: value for key, value in v["metadata"].items() if key != "text"} for v in vectors]
+        )
+
+    def to_records(self, documents: List[Document], ids: List[str], sparse_vectors: List[dict]) -> List[dict]:
+        """
+        Embed the documents and build Pinecone records, keeping the chunk text under the "text" metadata key
+        (the same layout PineconeVectorStore uses, so retrievers read both backends the same way).
+        """
+        embeddings = self.embedding_model.embed_documents([doc.page_content for doc in documents])
+
+        records = []
+        for _id, values, sparse_values, doc in zip(ids, embeddings, sparse_vectors, documents):
+            record = {"id": _id, "values": values, "metadata": {**doc.metadata, "text": doc.page_content}}
+            # Pinecone rejects empty sparse vectors (chunks made only of stopwords/punctuation).
+            if sparse_values["indices"]:
+                record["sparse_values"] = sparse_values
+            records.append(record)
+
+        return records
 
     def create_index(self) -> None:
         self.pc_client.create_index(
@@ -62,13 +289,8 @@ class PineconeUtils:
         This function sets up the model dimensions for the model.
         """
 
-        models_vector_dimension = {
-            "text-embedding-ada-002": 1536,
-            "text-embedding-3-large": 3072
-        }
-
-        if model_name in models_vector_dimension:
-            return models_vector_dimension[model_name]
+        if model_name in MODELS_VECTOR_DIMENSION:
+            return MODELS_VECTOR_DIMENSION[model_name]
         else:
             raise ValueError("This embedding model is not supported in this application.")
 
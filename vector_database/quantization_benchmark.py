@@ -0,0 +1,85 @@
+import sys
+import tempfile
+import numpy as np
+from typing import List
+from vector_database.local_index import LocalIndex, LOCAL_INDEXES_DIR
+
+DEFAULT_SETTINGS = [
+    {},
+    {"search_dimension": 1024},
+    {"search_dimension": 256},
+    {"quantization": "int8"},
+    {"quantization": "int8", "search_dimension": 1024},
+    {"quantization": "binary"},
+    {"quantization": "binary", "search_dimension": 1024},
+]
+
+
+def benchmark(directory,
+              dimension: int,
+              queries: np.ndarray,
+              settings: List[dict] = None,
+              top_k: int = 10,
+              rescore_factor: int = 4,
+              metric: str = "dotproduct") -> List[dict]:
+    """
+    Open the local index stored in directory with each compact setting and measure, against exact float32 search
+    over the same queries: memory of the searched representation, recall@top_k after rescoring and latency.
+    """
+    results = []
+    for setting in settings or DEFAULT_SETTINGS:
+        index = LocalIndex(directory=directory, dimension=dimension, metric=metric, rescore_factor=rescore_factor,
+                           **setting)
+        evaluation = index.evaluate_recall(queries, top_k=top_k)
+        results.append({
+            "setting": ", ".join(f"{key}={value}" for key, value in setting.items()) or "float32",
+            "memory_mb": evaluation["search_memory_mb"],
+            f"recall@{top_k}": evaluation[f"recall@{top_k}"],
+            "p50_ms": evaluation["ann_p50_ms"],
+            "p99_ms": evaluation["ann_p99_ms"],
+            "exact_p50_ms": evaluation["exact_p50_ms"]
+        })
+    return results
+
+
+def print_results(results: List[dict]) -> None:
+    baseline_memory = results[0]["memory_mb"]
+    recall_key = next(key for key in results[0] if key.startswith("recall@"))
+    print(f"{'setting':<42} {'memory':>10} {'ratio':>7} {recall_key:>10} {'p50':>9} {'p99':>9}")
+    for result in results:
+        print(f"{result['setting']:<42} {result['memory_mb']:>8.1f}MB {baseline_memory / result['memory_mb']:>6.1f}x "
+              f"{result[recall_key]:>10.3f} {result['p50_ms']:>7.2f}ms {result['p99_ms']:>7.2f}ms")
+
+
+def synthetic_embeddings(n_vectors: int, dimension: int, seed: int = 0) -> np.ndarray:
+    """
+    Unit vectors whose variance decays along the dimensions, like Matryoshka embeddings where the first
+    dimensions carry most of the information.
+    """
+    generator = np.random.default_rng(seed)
+    decay = 1.0 / np.sqrt(1.0 + np.arange(dimension) / 64.0)
+    vectors = (generator.standard_normal((n_vectors, dimension)) * decay).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+if __name__ == "__main__":
+    # python -m vector_database.quantization_benchmark [local index name] [dimension]
+    # Queries are stored vectors with noise added. Without an index name, a synthetic index is used.
+    if len(sys.argv) > 1:
+        directory, dimension = LOCAL_INDEXES_DIR / sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 3072
+        stored = LocalIndex(directory=directory, dimension=dimension)
+        sample = np.random.default_rng(1).choice(len(stored.ids), size=min(200, len(stored.ids)), replace=False)
+        base_vectors = np.asarray(stored.vectors[np.sort(sample)])
+        print_results(benchmark(directory, dimension, base_vectors + np.random.default_rng(2).normal(
+            0, 0.01, base_vectors.shape).astype(np.float32)))
+    else:
+        dimension = 3072
+        vectors = synthetic_embeddings(20000, dimension)
+        queries = vectors[:200] + np.random.default_rng(2).normal(0, 0.01, (200, dimension)).astype(np.float32)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index = LocalIndex(directory=tmp_dir, dimension=dimension)
+            for start in range(0, len(vectors), 5000):
+                index.upsert(vectors=[{"id": str(i), "values": vectors[i]} for i in range(start, start + 5000)])
+            del index
+            print_results(benchmark(tmp_dir, dimension, queries))
@@ -0,0 +1,126 @@
+import numpy as np
+
+# Number of set bits of every byte value, to count differing bits of packed binary codes.
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint16)
+
+# Values decoded to float32 at once when scoring, about 8MB.
+BLOCK_VALUES = 1 << 21
+
+
+class QuantizedVectors:
+    def __init__(self,
+                 dimension: int,
+                 quantization: str = None,
+                 search_dimension: int = None
+                 ) -> None:
+        """
+        Compact in-memory copy of LocalIndex's vectors, only used to pick candidates that are then rescored with the
+        full float32 vectors.
+
+        search_dimension keeps the first dimensions of each vector (Matryoshka embeddings such as
+        text-embedding-3-* are trained so that a prefix, renormalized, is still a good embedding). quantization
+        stores each value as int8 (per dimension symmetric scale, 4x smaller) or as its sign bit ("binary", 32x
+        smaller, scored by Hamming distance).
+        """
+        self.check_quantization(quantization)
+        self.dimension = dimension
+        self.quantization = quantization
+        self.search_dimension = min(search_dimension or dimension, dimension)
+
+        self.scale = None
+        self.codes = None
+        self.n_rows = 0
+
+    @staticmethod
+    def check_quantization(quantization: str) -> None:
+        if quantization not in [None, "int8", "binary"]:
+            raise ValueError("The quantization must be None, 'int8' or 'binary'.")
+
+    @property
+    def nbytes(self) -> int:
+        codes_bytes = self.codes[:self.n_rows].nbytes if self.codes is not None else 0
+        return codes_bytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def truncate(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)[:, :self.search_dimension]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = self.truncate(vectors)
+
+        if self.quantization == "int8":
+            if len(vectors) == 0:
+                return np.zeros((0, self.search_dimension), dtype=np.int8)
+            if self.scale is None:
+                # Calibrated on the first rows encoded: all of them when the index is opened, later rows are clipped.
+                max_abs = np.abs(vectors).max(axis=0)
+                self.scale = (np.where(max_abs == 0, 1.0, max_abs) / 127).astype(np.float32)
+            return np.clip(np.round(vectors / self.scale), -127, 127).astype(np.int8)
+
+        if self.quantization == "binary":
+            return self.pack_bits(vectors)
+
+        return vectors
+
+    @staticmethod
+    def pack_bits(vectors: np.ndarray) -> np.ndarray:
+        # Sign bits packed in 64 bits words, so Hamming distances are counted a word at a time.
+        bits = np.packbits(vectors > 0, axis=1)
+        bits = np.pad(bits, ((0, 0), (0, -bits.shape[1] % 8)))
+        return np.ascontiguousarray(bits).view(np.uint64)
+
+    @staticmethod
+    def count_bits(words: np.ndarray) -> np.ndarray:
+        if hasattr(np, "bitwise_count"):
+            return np.bitwise_count(words).sum(axis=-1, dtype=np.int32)
+        return POPCOUNT[words.view(np.uint8)].sum(axis=-1, dtype=np.int32)
+
+    def build(self, vectors: np.ndarray) -> None:
+        """
+        (Re)encode all rows, calibrating the int8 scales on them.
+        """
+        self.scale = None
+        self.n_rows = 0
+        self.codes = None
+        self.update(np.arange(len(vectors)), vectors)
+
+    def update(self, rows: np.ndarray, vectors: np.ndarray) -> None:
+        codes = self.encode(vectors)
+        needed_rows = int(rows.max()) + 1 if len(rows) else 0
+
+        if self.codes is None or needed_rows > len(self.codes):
+            capacity = max(needed_rows, 1024, 2 * (len(self.codes) if self.codes is not None else 0))
+            grown = np.zeros((capacity, codes.shape[1]), dtype=codes.dtype)
+            if self.codes is not None:
+                grown[:self.n_rows] = self.codes[:self.n_rows]
+            self.codes = grown
+
+        self.codes[rows] = codes
+        self.n_rows = max(self.n_rows, needed_rows)
+
+    def score(self, queries: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Approximate scores of every query against every row (or the given rows), higher is closer.
+        """
+        queries = self.truncate(queries)
+        query_bits = self.pack_bits(queries) if self.quantization == "binary" else None
+        n_rows = self.n_rows if rows is None else len(rows)
+
+        scores = np.empty((len(queries), n_rows), dtype=np.float32)
+        # Blocks of rows small enough for their decoded values to stay in cache. Without rows the blocks are views of
+        # the codes, not copies.
+        block_rows = max(256, BLOCK_VALUES // self.search_dimension)
+        for start in range(0, n_rows, block_rows):
+            end = min(start + block_rows, n_rows)
+            block = self.codes[start:end] if rows is None else self.codes[rows[start:end]]
+
+            if self.quantization == "int8":
+                scores[:, start:end] = (queries * self.scale) @ block.T.astype(np.float32)
+            elif self.quantization == "binary":
+                for query_idx, bits in enumerate(query_bits):
+                    scores[query_idx, start:end] = self.search_dimension - 2.0 * self.count_bits(block ^ bits)
+            else:
+                scores[:, start:end] = queries @ block.T
+
+        return scores
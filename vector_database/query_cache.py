@@ -0,0 +1,60 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+def normalize_query(query: str) -> str:
+    """
+    Cache key of a query: lower case, single spaces, no surrounding punctuation, so "How HyDE works?" and
+    "how hyde works" share their entries.
+    """
+    return re.sub(r"\s+", " ", query.lower()).strip(" \t\n?!.,;:")
+
+
+class TTLCache:
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 3600.0) -> None:
+        """
+        Thread-safe LRU cache whose entries also expire ttl seconds after they were set (ttl=None never expires).
+        hits and misses count the get calls.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[0] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}